@@ -0,0 +1,78 @@
+"""
+Benchmark the vectorized fix_times against the original per-timestamp loop
+
+Usage: python benchmark_fix_times.py /path/to/xprecipradar_guc_volume_YYYYMMDD-HHMMSS.b1.nc
+
+Glued files written by sail_glue.py already have unique times, so by default the
+times are first truncated to whole seconds to recreate the duplicates found in a
+freshly glued 8-tilt volume.
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import xarray as xr
+
+from sail_glue import fix_times
+
+
+def fix_times_loop(ds):
+    """
+    The original fix_times, looping over every unique time
+    """
+    specific = set(ds.time.data)
+    for value in specific:
+        dt = np.arange(0, len(ds.sel(time=slice(value, value)).time.data))
+        dt = dt.astype('timedelta64[ms]')
+        new_times = ds.sel(time=slice(value, value)).time.data + dt
+        ds.sel(time=slice(value, value)).time.data[:] = new_times
+    return ds
+
+
+def main(args):
+    with xr.open_dataset(args.file, mask_and_scale=False) as ds:
+        ds = ds.load()
+    if not args.keep_times:
+        ds = ds.assign_coords(time=ds.time.values.astype('datetime64[s]').astype('datetime64[ns]'))
+
+    n_rays = ds.sizes['time']
+    n_unique = np.unique(ds.time.values).size
+    print(f"{args.file}: {n_rays} rays, {n_unique} unique times")
+
+    loop = min(timeit.repeat(lambda: fix_times_loop(ds.copy(deep=True)), number=1, repeat=args.repeat))
+    vectorized = min(timeit.repeat(lambda: fix_times(ds.copy(deep=True)), number=1, repeat=args.repeat))
+    print(f"loop:       {loop * 1000:10.2f} ms")
+    print(f"vectorized: {vectorized * 1000:10.2f} ms ({loop / vectorized:.1f}x faster)")
+
+    # The loop relies on writing through .sel(...).data, so check what it actually produced
+    looped = fix_times_loop(ds.copy(deep=True)).time.values
+    fixed = fix_times(ds.copy(deep=True)).time.values
+    print("loop times strictly increasing:      ", bool(np.all(np.diff(looped) > np.timedelta64(0))))
+    print("vectorized times strictly increasing:", bool(np.all(np.diff(fixed) > np.timedelta64(0))))
+    print("identical results:                   ", bool(np.array_equal(looped, fixed)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Benchmark fix_times on a glued volume")
+
+    parser.add_argument("file",
+                        type=str,
+                        help="Glued 8-tilt volume (.b1.nc)"
+    )
+    parser.add_argument("--repeat",
+                        default=5,
+                        dest='repeat',
+                        type=int,
+                        help="Number of timing repeats"
+    )
+    parser.add_argument("--keep-times",
+                        default=False,
+                        dest='keep_times',
+                        action='store_true',
+                        help="Do not truncate the times to whole seconds first"
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,194 @@
+"""
+Cached terrain beam blockage for the SAIL X-Band radar
+
+Partial and cumulative beam blockage (PBB/CBB) depend only on the DEM and on the
+scan geometry: site position and altitude, ray angles, range gates and beam
+width. The wradlib calculation of notebooks/qc/sail_beam_blockage.ipynb is done
+once per geometry and stored on disk (see sail_geometry_cache); each volume then
+looks its blockage up, and can carry it as fields or be masked where the beam is
+blocked.
+
+Usage (e.g. in the glue or SQUIRE pipelines):
+
+    blockage = sail_beam_blockage.get_beam_blockage(radar, 'sail.tif')
+    sail_beam_blockage.add_blockage_fields(radar, blockage)
+    sail_beam_blockage.mask_blocked_gates(radar, blockage)
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+import sail_geometry_cache
+
+# Directory holding the blockage maps between runs
+BLOCKAGE_CACHE_DIR = Path(os.getenv("SAIL_BLOCKAGE_CACHE", "cache/beam_blockage"))
+
+# Defaults of the notebook calculation
+RADAR_HEIGHT_OFFSET = 10.0  # meters of tower above the site altitude
+BEAM_WIDTH = 1.0  # degrees, half power
+
+# Maximum drift in the scan geometry before the cached blockage is recomputed
+ANGLE_TOLERANCE = sail_geometry_cache.ANGLE_TOLERANCE  # degrees
+RANGE_TOLERANCE = sail_geometry_cache.RANGE_TOLERANCE  # meters
+
+# Cumulative blockage above which a gate is flagged (and masked) as blocked
+COMPLETE_BLOCK_THRESHOLD = 0.95
+
+BLOCKAGE_FIELDS = {
+    'partial_beam_blockage': {
+        'coordinates': 'elevation azimuth range',
+        'units': '1',
+        'long_name': 'Partial Beam Block Fraction',
+        'comment': 'Partial beam block fraction due to terrain.'},
+    'cumulative_beam_blockage': {
+        'coordinates': 'elevation azimuth range',
+        'units': '1',
+        'long_name': 'Cumulative Beam Block Fraction',
+        'comment': 'Cumulative beam block fraction due to terrain.'},
+    'cbb_flag': {
+        'coordinates': 'elevation azimuth range',
+        'units': '1',
+        'long_name': 'Cumulative Beam Block Fraction Flag',
+        'comment': 'Cumulative beam block flag due to terrain.'},
+}
+
+# Blockage maps already loaded within this process, keyed by cache path
+_loaded_maps = {}
+
+
+def geometry_fingerprint(radar, dem_file, radar_height_offset=RADAR_HEIGHT_OFFSET,
+                         beam_width=BEAM_WIDTH):
+    """
+    Create a key describing the DEM and scan geometry of a radar volume
+    """
+    dem = Path(dem_file)
+    return sail_geometry_cache.fingerprint(radar, [dem.name, dem.stat().st_size,
+                                                   float(radar_height_offset), float(beam_width)])
+
+
+def compute_beam_blockage(radar, dem_file, radar_height_offset=RADAR_HEIGHT_OFFSET,
+                          beam_width=BEAM_WIDTH):
+    """
+    Calculate the partial and cumulative beam blockage of every gate with wradlib
+
+    Parameters
+    ----------
+    radar : Radar
+        Radar whose scan geometry is used.
+    dem_file : str
+        GeoTIFF of the terrain height.
+    radar_height_offset : float
+        Height added to the radar altitude for the radar tower.
+    beam_width : float
+        Half power beam width of the radar [deg].
+
+    Returns
+    -------
+    blockage : dict
+        (ray, gate) float32 'pbb' and 'cbb' fractions, NaN where the DEM does
+        not cover the gate, along with the scan geometry used to check whether
+        the map still applies to a new volume.
+
+    References
+    ----------
+    Bech, J., B. Codina, J. Lorente, and D. Bebbington, 2003: The sensitivity
+    of single polarization weather radar beam blockage correction to
+    variability in the vertical refractivity gradient. J. Atmos. Oceanic
+    Technol., 20, 845–855
+
+    Heistermann, M., Jacobi, S., and Pfaff, T., 2013: Technical Note: An open
+    source library for processing weather radar data (wradlib), Hydrol. Earth
+    Syst. Sci., 17, 863-871, doi:10.5194/hess-17-863-2013
+    """
+    import wradlib as wrl
+
+    data_raster = wrl.io.open_raster(str(dem_file))
+    rastervalues, rastercoords, proj = wrl.georef.extract_raster_dataset(data_raster, nodata=None)
+    del data_raster
+
+    sitecoords = (float(radar.longitude['data'][0]),
+                  float(radar.latitude['data'][0]),
+                  float(radar.altitude['data'][0] + radar_height_offset))
+    _range = radar.range['data']
+    beamradius = wrl.util.half_power_radius(_range, beam_width)
+
+    # Every ray of the volume at once; the blockage accumulates along range only
+    rg, azg = np.meshgrid(_range, radar.azimuth['data'])
+    rg, eleg = np.meshgrid(_range, radar.elevation['data'])
+    coords = wrl.georef.spherical_to_proj(rg, azg, eleg, sitecoords, proj=proj)
+    lon = coords[..., 0]
+    lat = coords[..., 1]
+    alt = coords[..., 2]
+    polcoords = coords[..., :2]
+
+    # Clip the DEM to the bounding box of the volume
+    rlimits = (lon.min(), lat.min(), lon.max(), lat.max())
+    ind = wrl.util.find_bbox_indices(rastercoords, rlimits)
+    rastercoords = rastercoords[ind[1]:ind[3], ind[0]:ind[2], ...]
+    rastervalues = rastervalues[ind[1]:ind[3], ind[0]:ind[2]]
+    polarvalues = wrl.ipol.cart_to_irregular_spline(rastercoords, rastervalues, polcoords,
+                                                    order=3, prefilter=False)
+
+    pbb = wrl.qual.beam_block_frac(polarvalues, alt, beamradius)
+    pbb = np.clip(np.ma.masked_invalid(pbb), 0.0, 1.0)
+    cbb = wrl.qual.cum_beam_block_frac(pbb)
+
+    return dict(sail_geometry_cache.scan_geometry(radar),
+                pbb=np.ma.filled(pbb, np.nan).astype(np.float32),
+                cbb=np.ma.filled(np.ma.masked_invalid(cbb), np.nan).astype(np.float32))
+
+
+def get_beam_blockage(radar, dem_file,
+                      radar_height_offset=RADAR_HEIGHT_OFFSET,
+                      beam_width=BEAM_WIDTH,
+                      cache_dir=BLOCKAGE_CACHE_DIR,
+                      angle_tolerance=ANGLE_TOLERANCE,
+                      range_tolerance=RANGE_TOLERANCE):
+    """
+    Load the blockage map for this scan geometry, computing it if missing or out of tolerance
+    """
+    fingerprint = geometry_fingerprint(radar, dem_file, radar_height_offset, beam_width)
+    return sail_geometry_cache.get_cached(
+        Path(cache_dir) / f"beam_blockage_{fingerprint}.npz", _loaded_maps, radar,
+        lambda: compute_beam_blockage(radar, dem_file, radar_height_offset, beam_width),
+        angle_tolerance, range_tolerance)
+
+
+def blockage_flags(cbb, complete_block_threshold=COMPLETE_BLOCK_THRESHOLD):
+    """
+    Flag gates whose cumulative blockage is above the threshold with 1, others with 0
+
+    As in the notebook, gates without a blockage value (outside the DEM) are
+    flagged as blocked.
+    """
+    return (~(np.asarray(cbb) < complete_block_threshold)).astype(np.int8)
+
+
+def add_blockage_fields(radar, blockage, complete_block_threshold=COMPLETE_BLOCK_THRESHOLD,
+                        replace_existing=True):
+    """
+    Add the partial_beam_blockage, cumulative_beam_blockage and cbb_flag fields to a radar
+    """
+    data = {'partial_beam_blockage': np.ma.masked_invalid(blockage['pbb']),
+            'cumulative_beam_blockage': np.ma.masked_invalid(blockage['cbb']),
+            'cbb_flag': blockage_flags(blockage['cbb'], complete_block_threshold)}
+    for name, values in data.items():
+        field = dict(BLOCKAGE_FIELDS[name], data=values)
+        radar.add_field(name, field, replace_existing=replace_existing)
+    return radar
+
+
+def mask_blocked_gates(radar, blockage, fields=None,
+                       complete_block_threshold=COMPLETE_BLOCK_THRESHOLD):
+    """
+    Mask the gates of the given fields (all by default) where the beam is blocked
+    """
+    blocked = blockage_flags(blockage['cbb'], complete_block_threshold).astype(bool)
+    for field in fields or list(radar.fields):
+        data = np.ma.asarray(radar.fields[field]['data'])
+        data[blocked] = np.ma.masked
+        radar.fields[field]['data'] = data
+    return radar
+
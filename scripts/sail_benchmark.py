@@ -0,0 +1,334 @@
+"""
+End-to-end benchmark of the SAIL X-Band processing on synthetic volumes
+
+Usage: python sail_benchmark.py [--volumes 3] [--output results.json] [--baseline old.json]
+
+Synthetic 8-tilt PPI sweeps are built with Py-ART's test radar builders, with
+the range gates and field metadata of the CMAC DOD in data/meta, and written
+with the file names of the raw CSU X-Band sweeps. Each volume then goes
+through the stages of the processing:
+
+    read, glue, fix, write                      sail_glue
+    grid, lowest_level, surface_only,
+    dod_conform, squire_write                   run_squire_march_2022
+    column_extract                              sail_radclss
+
+The wall time, peak RSS and bytes read and written of every stage are
+recorded with sail_telemetry.measure. Nothing is read from /gpfs or the
+network, so it runs on a laptop; compare against a saved run with --baseline
+to catch regressions before a monthly reprocess.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pyart
+
+import sail_dod
+import sail_glue
+import sail_output
+import sail_radclss
+import sail_telemetry
+import sail_volume_index
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "vap" / "gucxprecipradarsquire.c1"))
+import run_squire_march_2022 as squire
+import snow_rate
+
+# Elevation of each synthetic tilt [deg], one per sail_volume_index.VOLUME_TILTS
+SWEEP_ELEVATIONS = (1., 2., 4., 6., 8., 10., 12., 15.)
+
+# Scan timing of the synthetic volumes
+SWEEP_SECONDS = 30
+VOLUME_INTERVAL = datetime.timedelta(minutes=5)
+START_TIME = datetime.datetime(2022, 3, 1)
+
+# Location of the synthetic radar, near the SAIL sites
+SITE = {'latitude': 38.8983, 'longitude': -106.9429, 'altitude': 2886.}
+
+# Raw value of missing gates in the sweep files, masked by sail_glue.apply_glue_fill
+RAW_MISSING = -99900.
+
+# Relative slowdown of a stage, against the baseline, reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+STAGES = ['read', 'glue', 'fix', 'write', 'grid', 'lowest_level', 'surface_only',
+          'dod_conform', 'squire_write', 'column_extract']
+
+
+def field_metadata(name, schema):
+    """
+    Attributes of a field from the CMAC DOD, as a Py-ART field dictionary
+    """
+    attrs = schema['variables'].get(name, {}).get('attrs', {})
+    return {key: value for key, value in attrs.items() if key in ('units', 'long_name', 'standard_name')}
+
+
+def make_sweep(elevation, start, rays, gates, rng, schema):
+    """
+    Build a single synthetic PPI sweep with the raw fields of the CSU X-Band radar
+
+    A band of precipitation crosses the sweep, weakening with height, over
+    noisy background gates that are written as missing.
+    """
+    radar = pyart.testing.make_empty_ppi_radar(gates, rays, 1)
+    attrs = schema['variables']['range']['attrs']
+    radar.range['data'] = (float(attrs['meters_to_center_of_first_gate']) +
+                           float(attrs['meters_between_gates']) * np.arange(gates)).astype('float32')
+    radar.range['meters_between_gates'] = float(attrs['meters_between_gates'])
+    radar.latitude['data'] = np.array([SITE['latitude']])
+    radar.longitude['data'] = np.array([SITE['longitude']])
+    radar.altitude['data'] = np.array([SITE['altitude']])
+    radar.fixed_angle['data'][:] = elevation
+    radar.elevation['data'][:] = elevation
+    radar.azimuth['data'][:] = np.arange(rays) * 360. / rays
+    # The raw sweeps store whole-second ray times, so rays share times
+    radar.time['units'] = start.strftime('seconds since %Y-%m-%dT%H:%M:%SZ')
+    radar.time['data'] = np.floor(np.linspace(0., SWEEP_SECONDS, rays, endpoint=False))
+
+    azimuth = np.deg2rad(radar.azimuth['data'])[:, np.newaxis]
+    distance = radar.range['data'][np.newaxis, :] / 1000.
+    band = np.exp(-((distance * np.sin(azimuth) - 5.) / 8.) ** 2)
+    dbz = 45. * band - 0.8 * elevation + rng.normal(0., 2., (rays, gates)) - 5.
+    missing = dbz < 0.
+
+    values = {'DBZ': dbz,
+              'VEL': 12. * np.cos(azimuth) * np.ones_like(dbz) + rng.normal(0., 1., dbz.shape),
+              'WIDTH': 1. + 2. * band,
+              'ZDR': 0.5 + 1.5 * band,
+              'PHIDP': np.cumsum(0.2 * band, axis=1),
+              'RHOHV': 0.99 - 0.05 * rng.random(dbz.shape),
+              'NCP': 0.5 + 0.5 * band,
+              'DBZhv': dbz - 30.}
+    for name, data in values.items():
+        field = field_metadata(name, schema)
+        field['data'] = np.where(missing, RAW_MISSING, data).astype('float32')
+        radar.add_field(name, field)
+    return radar
+
+
+def write_synthetic_sweeps(sweep_dir, n_volumes, rays, gates, seed=0):
+    """
+    Write the sweep files of n_volumes synthetic volumes, returning them grouped by volume
+    """
+    schema = sail_dod.load_dod('xprecipradarcmacppi.c1')
+    rng = np.random.default_rng(seed)
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for volume in range(n_volumes):
+        volume_start = START_TIME + volume * VOLUME_INTERVAL
+        for sweep, (tilt, elevation) in enumerate(zip(sail_volume_index.VOLUME_TILTS, SWEEP_ELEVATIONS)):
+            start = volume_start + sweep * datetime.timedelta(seconds=SWEEP_SECONDS)
+            stamp = start.strftime('%Y%m%d-%H%M%S')
+            path = sweep_dir / ('gucxprecipradarS2.00.%s.raw.csu.sail-%s_%d_22_%d_PPI.nc'
+                                % (start.strftime('%Y%m%d.%H%M%S'), stamp, 1000 + volume, tilt))
+            pyart.io.write_cfradial(str(path), make_sweep(elevation, start, rays, gates, rng, schema))
+            paths.append(str(path))
+
+    # Group the sweeps the way sail_glue does
+    index = sail_volume_index.open_index(':memory:')
+    sail_volume_index.update_index(index, paths)
+    volumes, incomplete = sail_volume_index.build_volumes(index)
+    index.close()
+    return volumes
+
+
+def write_cmac_volume(radar, path):
+    """
+    Add the fields used by SQUIRE and RadCLss to a glued volume and write it as a CMAC file
+    """
+    times = np.asarray(radar.time['data'], dtype='float64')
+    start = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=int(times[0]))
+    radar.time['data'] = (times - times[0]) / 1000.
+    radar.time['units'] = start.strftime('seconds since %Y-%m-%dT%H:%M:%SZ')
+
+    dbz = radar.fields['DBZ']['data']
+    schema = sail_dod.load_dod('xprecipradarcmacppi.c1')
+    extra = {'corrected_reflectivity': dbz,
+             'rain_rate_A': 0.036 * (10. ** (dbz / 10.)) ** 0.625,
+             'gate_id': np.ma.masked_array(np.where(np.ma.getmaskarray(dbz), 0., 1.).astype('float32'))}
+    for name, data in extra.items():
+        field = field_metadata(name, schema)
+        field['data'] = data
+        radar.add_field(name, field, replace_existing=True)
+    snow_rate.add_snow_fields(radar)
+    pyart.io.write_cfradial(str(path), radar)
+    return path
+
+
+def run_volume(sweeps, work_dir, results, lookup_cache):
+    """
+    Run one volume through every stage, appending the measurements to results
+    """
+    stamp = Path(sweeps[0]).name.split('sail-')[1][:15].replace('-', '.')
+
+    with sail_telemetry.measure('read', results):
+        radars = sail_glue.read_sweeps(sweeps)
+    with sail_telemetry.measure('glue', results):
+        radar = sail_glue.radar_glue(radars[0], radars[1:])
+    del radars
+    with sail_telemetry.measure('fix', results):
+        sail_glue.fix_radar_times(radar)
+        sail_glue.apply_glue_fill(radar)
+    with sail_telemetry.measure('write', results):
+        sail_glue.write_volume(str(work_dir / 'glue_files' / ('xprecipradar_guc_volume_%s.b1.nc' % stamp)), radar)
+
+    cmac_file = str(write_cmac_volume(radar, work_dir / 'cmac' / ('gucxprecipradarcmacS2.c1.%s.nc' % stamp)))
+    del radar
+
+    with sail_telemetry.measure('grid', results):
+        ds = squire.grid_radar(cmac_file, fields=squire.SQUIRE_FIELDS)
+    with sail_telemetry.measure('lowest_level', results):
+        out_ds = squire.subset_lowest_vertical_level(ds)
+    del ds
+    with sail_telemetry.measure('surface_only', results):
+        squire.grid_lowest_level(cmac_file)
+    with sail_telemetry.measure('dod_conform', results):
+        compliant_ds = squire.setup_output_dataset(out_ds)
+    with sail_telemetry.measure('squire_write', results):
+        encoding = sail_output.output_encoding(compliant_ds, sail_dod.load_dod(squire.DATASTREAM),
+                                               sail_output.OUTPUT_CHUNKS[squire.DATASTREAM])
+        sail_output.write_netcdf(compliant_ds, str(work_dir / 'squire' / ('%s.gridded.nc' % stamp)), encoding)
+    with sail_telemetry.measure('column_extract', results):
+        sail_radclss.subset_points(cmac_file, sail_radclss.lats, sail_radclss.lons, sail_radclss.sites,
+                                   lookup_cache=lookup_cache)
+
+
+def summarize(results):
+    """
+    Summarize the measurements of each stage over all volumes
+
+    The first volume includes one-off costs (e.g. building the grid index
+    cache), so it is reported separately from the mean of the others.
+    """
+    summary = {}
+    for stage in STAGES:
+        runs = [result for result in results if result['stage'] == stage]
+        if not runs:
+            continue
+        warm = runs[1:] or runs
+        summary[stage] = {'first_wall': runs[0]['wall'],
+                          'mean_wall': float(np.mean([run['wall'] for run in warm])),
+                          'peak_rss': max(run['peak_rss'] for run in runs)}
+        for key in ('bytes_read', 'bytes_written'):
+            values = [run[key] for run in warm if run[key] is not None]
+            summary[stage][key] = float(np.mean(values)) if values else None
+    return summary
+
+
+def print_summary(summary, baseline=None, tolerance=REGRESSION_TOLERANCE):
+    """
+    Print the summary table, returning the stages slower than the baseline
+    """
+    megabyte = 1024. * 1024.
+    print(f"{'stage':<16}{'first [s]':>11}{'mean [s]':>11}{'peak RSS [MB]':>15}"
+          f"{'read [MB]':>11}{'written [MB]':>14}" + ('   vs baseline' if baseline else ''))
+    regressions = []
+    for stage, stats in summary.items():
+        read = '-' if stats['bytes_read'] is None else '%.1f' % (stats['bytes_read'] / megabyte)
+        written = '-' if stats['bytes_written'] is None else '%.1f' % (stats['bytes_written'] / megabyte)
+        line = (f"{stage:<16}{stats['first_wall']:>11.3f}{stats['mean_wall']:>11.3f}"
+                f"{stats['peak_rss'] / megabyte:>15.1f}{read:>11}{written:>14}")
+        if baseline and stage in baseline:
+            ratio = stats['mean_wall'] / baseline[stage]['mean_wall']
+            line += f"   {ratio:6.2f}x"
+            if ratio > 1. + tolerance:
+                line += ' SLOWER'
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+
+def main(args):
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='sail_benchmark_')).resolve()
+    for sub_dir in ('nc_files', 'glue_files', 'cmac', 'squire'):
+        (work_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+    # The SQUIRE grid index cache is relative to the working directory
+    os.chdir(work_dir)
+    print(f"benchmarking {args.volumes} volumes of {len(SWEEP_ELEVATIONS)} x {args.rays} rays x "
+          f"{args.gates} gates in {work_dir}")
+
+    volumes = write_synthetic_sweeps(work_dir / 'nc_files', args.volumes, args.rays, args.gates, args.seed)
+    results = []
+    lookup_cache = {}
+    for sweeps in volumes:
+        run_volume(sweeps, work_dir, results, lookup_cache)
+
+    summary = summarize(results)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['stages']
+    regressions = print_summary(summary, baseline, args.tolerance)
+
+    if args.output:
+        config = {'volumes': args.volumes, 'rays': args.rays, 'gates': args.gates, 'seed': args.seed,
+                  'date': datetime.datetime.now().isoformat(timespec='seconds')}
+        with open(args.output, 'w') as f:
+            json.dump({'config': config, 'stages': summary, 'runs': results}, f, indent=1)
+    if regressions:
+        print('slower than the baseline:', ' '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Benchmark the SAIL processing stages on synthetic volumes")
+
+    parser.add_argument("--volumes",
+                        default=3,
+                        dest='volumes',
+                        type=int,
+                        help="Number of synthetic volumes"
+    )
+    parser.add_argument("--rays",
+                        default=360,
+                        dest='rays',
+                        type=int,
+                        help="Rays per sweep"
+    )
+    parser.add_argument("--gates",
+                        default=668,
+                        dest='gates',
+                        type=int,
+                        help="Range gates per ray"
+    )
+    parser.add_argument("--seed",
+                        default=0,
+                        dest='seed',
+                        type=int,
+                        help="Seed of the synthetic fields"
+    )
+    parser.add_argument("--work-dir",
+                        default=None,
+                        dest='work_dir',
+                        type=str,
+                        help="Directory for the synthetic and output files (default: a new temporary directory)"
+    )
+    parser.add_argument("--output",
+                        default=None,
+                        dest='output',
+                        type=str,
+                        help="Save the measurements to this JSON file"
+    )
+    parser.add_argument("--baseline",
+                        default=None,
+                        dest='baseline',
+                        type=str,
+                        help="JSON file of an earlier run to compare the mean stage times against"
+    )
+    parser.add_argument("--tolerance",
+                        default=REGRESSION_TOLERANCE,
+                        dest='tolerance',
+                        type=float,
+                        help="Relative slowdown reported as a regression"
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,94 @@
+"""
+Data Object Definitions (DODs) for the SAIL X-Band radar datastreams
+
+Each DOD is read once per process and kept as a lightweight schema (global
+attributes plus the attributes, dimensions and encoding of each variable), so
+outputs can be made compliant without reopening a template file or copying
+data arrays. The DODs bundled in data/meta are used by default, which keeps
+the processing jobs independent of network access.
+"""
+
+import functools
+from pathlib import Path
+
+import xarray as xr
+
+# Directory holding the bundled DOD files
+DOD_DIR = Path(__file__).resolve().parents[1] / "data" / "meta"
+
+# Bundled DOD file for each datastream
+DOD_FILES = {'xprecipradarsquire.c1': 'sail_squire_dod_v1.nc',
+             'xprecipradarcmacppi.c1': 'sail_cmac_dod_v3.nc',
+             }
+
+# Encoding keys worth keeping from the DOD variables
+ENCODING_KEYS = ['dtype', '_FillValue']
+
+# Attributes that xarray manages through the encoding of datetime variables
+CF_TIME_KEYS = ['units', 'calendar']
+
+
+def dod_path(datastream, dod_dir=None):
+    """
+    Return the path of the bundled DOD file for a datastream
+    """
+    if datastream not in DOD_FILES:
+        raise KeyError(f"No bundled DOD for {datastream}; available: {list(DOD_FILES)}")
+    return Path(dod_dir or DOD_DIR) / DOD_FILES[datastream]
+
+
+def schema_from_dataset(dod):
+    """
+    Extract the attribute/encoding schema from a DOD dataset
+    """
+    variables = {}
+    for name, variable in dod.variables.items():
+        variables[name] = {'dims': variable.dims,
+                           'attrs': dict(variable.attrs),
+                           'encoding': {key: variable.encoding[key] for key in ENCODING_KEYS
+                                        if key in variable.encoding}}
+    return {'attrs': dict(dod.attrs), 'variables': variables}
+
+
+@functools.lru_cache(maxsize=None)
+def load_dod(datastream, dod_dir=None):
+    """
+    Load the schema of a bundled DOD, once per process
+    """
+    with xr.open_dataset(dod_path(datastream, dod_dir)) as dod:
+        return schema_from_dataset(dod)
+
+
+@functools.lru_cache(maxsize=None)
+def load_dod_from_arm(datastream, dims, version='1.0'):
+    """
+    Load the schema of a DOD from the ARM DOD service, once per process
+
+    dims is a tuple of (dimension, size) pairs. This requires network access;
+    prefer load_dod with the bundled files inside processing jobs.
+    """
+    import act
+
+    dod = act.io.create_obj_from_arm_dod(datastream, set_dims=dict(dims), version=version)
+    return schema_from_dataset(dod)
+
+
+def apply_dod(ds, schema):
+    """
+    Subset a dataset to the DOD variables and apply the DOD attributes
+
+    The data arrays are shared with the input dataset, not copied.
+    """
+    new_ds = ds[list(schema['variables'])].copy(deep=False)
+    for name, variable in schema['variables'].items():
+        attrs = dict(variable['attrs'])
+        # xarray writes units/calendar of datetime variables from the encoding
+        if new_ds[name].dtype.kind == 'M':
+            for key in CF_TIME_KEYS:
+                if key in attrs:
+                    new_ds[name].encoding[key] = attrs.pop(key)
+        new_ds[name].attrs = attrs
+
+    # Make sure the attributes match
+    new_ds.attrs = dict(schema['attrs'])
+    return new_ds
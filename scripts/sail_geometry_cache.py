@@ -0,0 +1,131 @@
+"""
+Caching of products that depend only on the scan geometry of the SAIL X-Band radar
+
+The scan strategy at S2 barely changes between volumes, so anything derived
+from the gate positions alone (gate-to-grid index maps, terrain beam blockage,
+the gates above the RadCLss sites) can be computed once and reused. A cached
+product is keyed by a fingerprint of the coarse geometry (site, fixed angles,
+rays per sweep and range gates) and stores the exact ray angles and ranges it
+was built from, which are checked against tolerances before it is reused.
+
+Usage:
+
+    fingerprint = sail_geometry_cache.fingerprint(radar, extra_key)
+    product = sail_geometry_cache.get_cached(cache_dir / f"product_{fingerprint}.npz", _loaded,
+                                             radar, lambda: build_product(radar))
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Default maximum drift in the scan geometry before a cached product is rebuilt
+ANGLE_TOLERANCE = 0.5  # degrees
+RANGE_TOLERANCE = 1.0  # meters
+
+
+def geometry_key(radar):
+    """
+    Return the coarse scan geometry of a radar volume as a list of plain values
+    """
+    rays_per_sweep = (radar.sweep_end_ray_index['data'] -
+                      radar.sweep_start_ray_index['data'] + 1)
+    gate_spacing = np.diff(radar.range['data'][:2])
+    return [np.round(radar.latitude['data'], 4).tolist(),
+            np.round(radar.longitude['data'], 4).tolist(),
+            np.round(radar.altitude['data'], 0).tolist(),
+            np.round(radar.fixed_angle['data'], 1).tolist(),
+            rays_per_sweep.tolist(),
+            radar.ngates,
+            np.round(radar.range['data'][0], 0).tolist(),
+            np.round(gate_spacing, 1).tolist()]
+
+
+def fingerprint(radar, extra=()):
+    """
+    Create a key describing the scan geometry of a radar volume and anything else the product depends on
+
+    Only the coarse geometry goes into the key; the exact angles are checked
+    against the tolerances with geometry_matches when the product is loaded.
+    """
+    key = geometry_key(radar) + list(extra)
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def scan_geometry(radar):
+    """
+    Ray angles and ranges of a radar volume, stored with a product to check it against later volumes
+    """
+    return {'azimuth': np.array(radar.azimuth['data'], dtype='float64'),
+            'elevation': np.array(radar.elevation['data'], dtype='float64'),
+            'range': np.array(radar.range['data'], dtype='float64')}
+
+
+def geometry_matches(product, radar, angle_tolerance=ANGLE_TOLERANCE, range_tolerance=RANGE_TOLERANCE):
+    """
+    Check whether a product still describes the scan geometry of a radar
+    """
+    if (product['azimuth'].shape != radar.azimuth['data'].shape or
+            product['range'].shape != radar.range['data'].shape):
+        return False
+
+    # Wrap the azimuth differences so 359.9 and 0.1 degrees are close
+    azimuth_diff = (product['azimuth'] - radar.azimuth['data'] + 180.) % 360. - 180.
+    elevation_diff = product['elevation'] - radar.elevation['data']
+    range_diff = product['range'] - radar.range['data']
+
+    return bool(np.abs(azimuth_diff).max() <= angle_tolerance and
+                np.abs(elevation_diff).max() <= angle_tolerance and
+                np.abs(range_diff).max() <= range_tolerance)
+
+
+def save_npz(path, product):
+    """
+    Save a product, through a temporary file so other workers never load a partial one
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, **product)
+    os.replace(tmp_path, path)
+    return path
+
+
+def get_cached(path, loaded, radar, build,
+               angle_tolerance=ANGLE_TOLERANCE,
+               range_tolerance=RANGE_TOLERANCE):
+    """
+    Return the product cached at path for this scan geometry, building and saving it if missing or out of tolerance
+
+    Parameters
+    ----------
+    path : str or Path
+        .npz file of the product, named after its fingerprint.
+    loaded : dict
+        Products already loaded within this process, keyed by path.
+    radar : Radar
+        Volume the product is for.
+    build : callable
+        Called without arguments to compute the product, a dictionary of
+        arrays including the scan_geometry of the radar.
+
+    Returns
+    -------
+    product : dict
+        The cached or newly built product.
+    """
+    path = Path(path)
+    product = loaded.get(path)
+    if product is None and path.exists():
+        with np.load(path) as cached:
+            product = {key: cached[key] for key in cached.files}
+
+    if product is None or not geometry_matches(product, radar, angle_tolerance, range_tolerance):
+        # Either a new scan strategy or the geometry drifted; build it again
+        product = build()
+        save_npz(path, product)
+
+    loaded[path] = product
+    return product
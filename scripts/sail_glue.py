@@ -2,20 +2,35 @@ import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", category=UserWarning)
 
+import contextlib
 import glob
+import os
 import time
 import datetime
+import netCDF4
 import numpy as np
-import xarray as xr
 import tempfile
 from pathlib import Path
-import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-from dask.distributed import Client, LocalCluster, progress, wait
+from dask.distributed import Client, LocalCluster, wait
 
 import pyart
 
+import sail_beam_blockage
+import sail_telemetry
+import sail_volume_index
+
+# Fill value and time units of the glued .b1 files
+GLUE_FILL_VALUE = -32768.0
+GLUE_FILL_FIELDS = ['DBZ', 'VEL', 'WIDTH', 'ZDR', 'PHIDP', 'RHOHV', 'NCP', 'DBZhv']
+GLUE_TIME_UNITS = 'milliseconds since 1970-01-01T00:00:00Z'
+
+# Threads reading sweep files ahead of decoding, and the read-ahead limit for the next volume
+READ_THREADS = 4
+PREFETCH_BUDGET_MB = 512
+
 #-----------------
 # Define Functions
 #-----------------
@@ -41,118 +56,409 @@ def glue_fix(ds):
     
     return ds
 
+def _concatenate(dicts):
+    """
+    Concatenate the data of per-ray or per-sweep dictionaries, keeping the first's metadata
+    """
+    if any(dic is None for dic in dicts):
+        return None
+    out = {key: value for key, value in dicts[0].items() if key != 'data'}
+    if any(np.ma.isMaskedArray(dic['data']) for dic in dicts):
+        out['data'] = np.ma.concatenate([dic['data'] for dic in dicts])
+    else:
+        out['data'] = np.concatenate([dic['data'] for dic in dicts])
+    return out
+
+def _glue_instrument_parameters(radars):
+    """
+    Concatenate the per-ray and per-sweep instrument parameters of each sweep
+    """
+    base = radars[0].instrument_parameters
+    if base is None:
+        return None
+
+    params = {}
+    for key, value in base.items():
+        dicts = [(radar.instrument_parameters or {}).get(key) for radar in radars]
+        if any(dic is None for dic in dicts):
+            params[key] = value
+            continue
+        lengths = [np.shape(dic['data'])[:1] for dic in dicts]
+        if (lengths == [(radar.nrays,) for radar in radars] or
+                lengths == [(radar.nsweeps,) for radar in radars]):
+            params[key] = _concatenate(dicts)
+        else:
+            # Scalar parameters are the same for the whole volume
+            params[key] = value
+    return params
+
+def glue_sweeps(radars):
+    """
+    Glue a list of single sweep radars, in time order, into one volume
+
+    Every variable is sized once and filled with a single concatenation,
+    instead of growing the volume one sweep at a time with
+    pyart.util.join_radar (which copies the whole volume on each join).
+    Sweeps with fewer gates are padded with masked values.
+    """
+    base = radars[0]
+    nrays = [radar.nrays for radar in radars]
+    ray_offsets = np.concatenate([[0], np.cumsum(nrays)])
+    ngates = max(radar.ngates for radar in radars)
+
+    # Ray times relative to the start of the base sweep
+    start = datetime.datetime.strptime(base.time['units'][14:], '%Y-%m-%dT%H:%M:%SZ')
+    time_dict = {key: value for key, value in base.time.items() if key != 'data'}
+    time_dict['data'] = np.concatenate(
+        [radar.time['data'] +
+         (datetime.datetime.strptime(radar.time['units'][14:], '%Y-%m-%dT%H:%M:%SZ') - start).total_seconds()
+         for radar in radars])
+
+    longest = max(radars, key=lambda radar: radar.ngates)
+    _range = {key: value for key, value in longest.range.items()}
+
+    # Only fields present in every sweep can be glued
+    field_names = [name for name in base.fields
+                   if all(name in radar.fields for radar in radars)]
+    fields = {}
+    for name in field_names:
+        field = {key: value for key, value in base.fields[name].items() if key != 'data'}
+        data = np.ma.masked_all((ray_offsets[-1], ngates), dtype=base.fields[name]['data'].dtype)
+        for radar, ray_start, ray_end in zip(radars, ray_offsets[:-1], ray_offsets[1:]):
+            data[ray_start:ray_end, :radar.ngates] = radar.fields[name]['data']
+        field['data'] = data
+        fields[name] = field
+
+    sweep_number = {key: value for key, value in base.sweep_number.items() if key != 'data'}
+    sweep_number['data'] = np.arange(len(radars), dtype=base.sweep_number['data'].dtype)
+
+    sweep_start_ray_index = {key: value for key, value in base.sweep_start_ray_index.items() if key != 'data'}
+    sweep_start_ray_index['data'] = np.concatenate(
+        [radar.sweep_start_ray_index['data'] + offset for radar, offset in zip(radars, ray_offsets[:-1])])
+    sweep_end_ray_index = {key: value for key, value in base.sweep_end_ray_index.items() if key != 'data'}
+    sweep_end_ray_index['data'] = np.concatenate(
+        [radar.sweep_end_ray_index['data'] + offset for radar, offset in zip(radars, ray_offsets[:-1])])
+
+    return pyart.core.Radar(time_dict, _range, fields, dict(base.metadata), base.scan_type,
+                            base.latitude, base.longitude, base.altitude,
+                            sweep_number,
+                            _concatenate([radar.sweep_mode for radar in radars]),
+                            _concatenate([radar.fixed_angle for radar in radars]),
+                            sweep_start_ray_index, sweep_end_ray_index,
+                            _concatenate([radar.azimuth for radar in radars]),
+                            _concatenate([radar.elevation for radar in radars]),
+                            altitude_agl=base.altitude_agl,
+                            target_scan_rate=_concatenate([radar.target_scan_rate for radar in radars]),
+                            rays_are_indexed=_concatenate([radar.rays_are_indexed for radar in radars]),
+                            ray_angle_res=_concatenate([radar.ray_angle_res for radar in radars]),
+                            scan_rate=_concatenate([radar.scan_rate for radar in radars]),
+                            antenna_transition=_concatenate([radar.antenna_transition for radar in radars]),
+                            instrument_parameters=_glue_instrument_parameters(radars),
+                            radar_calibration=base.radar_calibration)
+
 def radar_glue(b_radar, radar_list):
     if radar_list is not None:
-        for rad in radar_list:
-            b_radar = pyart.util.join_radar(b_radar, rad)
-            del rad
+        b_radar = glue_sweeps([b_radar] + list(radar_list))
     else:
         b_radar = None
     return b_radar
 
-def volume_from_list(base_radar, vlist):
+def prefetch_file(path, chunk_size=8 * 1024 * 1024):
+    """
+    Read a file once so it is cached by the filesystem before it is decoded
+    """
+    with open(path, 'rb') as f:
+        while f.read(chunk_size):
+            pass
+    return path
+
+def prefetch_volume(vlist, pool, prefetched):
+    """
+    Start reading the sweep files of a volume in the background
+    """
+    for sweep in vlist:
+        if sweep not in prefetched:
+            prefetched[sweep] = pool.submit(prefetch_file, sweep)
+    return prefetched
+
+def read_sweeps(vlist, pool=None, prefetched=None):
+    """
+    Read and decode a list of sweep files, overlapping the file I/O with decoding
+
+    The raw files are read by a small thread pool while the sweeps are decoded
+    one at a time, in order, in the calling thread, since the netCDF/HDF5
+    libraries are not thread-safe. At most one volume of decoded sweeps is held.
+    Returns None if any of the sweeps cannot be read; the error is kept in the
+    telemetry record.
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=READ_THREADS)
+    if prefetched is None:
+        prefetched = {}
     try:
-        radars = [pyart.io.read(sw) for sw in vlist[1::]]
-    except:
-        radars = None
+        prefetch_volume(vlist, pool, prefetched)
+        radars = []
+        for sweep in vlist:
+            with sail_telemetry.stage('read'):
+                prefetched.pop(sweep).result()
+                radars.append(pyart.io.read(sweep))
+        return radars
+    except Exception as error:
+        print('FAILURE reading', vlist[0], error)
+        sail_telemetry.record_error(error)
+        return None
+    finally:
+        if own_pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+def volume_from_list(base_radar, vlist, pool=None, prefetched=None):
+    radars = read_sweeps(vlist[1::], pool, prefetched)
     return radar_glue(base_radar, radars)
 
+def deduplicate_times(times, offset=None):
+    """
+    Offset repeated times so the times come out unique and strictly increasing
+
+    The n-th repeat of a value gets n offsets added, with the repeat count of
+    every group computed at once from a single stable sort. Any time that would
+    still not be after its predecessor is then pushed forward, so the result is
+    strictly monotonic. Works on datetime64 arrays (default offset of 1 ms) and
+    on numeric arrays (default offset of 1).
+    """
+    times = np.asarray(times)
+    if offset is None:
+        offset = np.timedelta64(1, 'ms') if times.dtype.kind == 'M' else 1
+    if times.size == 0:
+        return times.copy()
+
+    # Rank of each time within its group of equal values
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+    positions = np.arange(times.size)
+    is_first = np.ones(times.size, dtype=bool)
+    is_first[1:] = sorted_times[1:] != sorted_times[:-1]
+    group_start = np.maximum.accumulate(np.where(is_first, positions, 0))
+    rank = np.empty(times.size, dtype='int64')
+    rank[order] = positions - group_start
+
+    new_times = times + rank * offset
+
+    # Enforce new_times[i] >= new_times[i - 1] + offset
+    steps = positions * offset
+    return np.maximum.accumulate(new_times - steps) + steps
+
 def fix_times(ds):
-    # Determine number of specific times within the file
-    specific = set(ds.time.data)
-    # Loop through the specific times, and add offset
-    for value in specific:
-        dt = np.arange(0, len(ds.sel(time=slice(value, value)).time.data))
-        dt = dt.astype('timedelta64[ms]')
-        # add the time offset to the original times
-        new_times = ds.sel(time=slice(value, value)).time.data + dt
-        ds.sel(time=slice(value, value)).time.data[:] = new_times
-    # Send back to the main
-    return ds
+    """
+    Offset duplicate ray times of a glued volume by milliseconds
+    """
+    return ds.assign_coords(time=deduplicate_times(ds.time.values))
+
+def fix_radar_times(radar):
+    """
+    Express ray times in milliseconds since 1970 and offset duplicate times
+
+    This is the in-memory equivalent of fix_times plus the millisecond time
+    encoding, applied before the volume is written.
+    """
+    radar.time['data'] = deduplicate_times(epoch_milliseconds(radar.time))
+    radar.time['units'] = GLUE_TIME_UNITS
+    return radar
+
+def epoch_milliseconds(time_dict):
+    """
+    Return the times of a radar time dictionary as integer milliseconds since 1970
+    """
+    unit, reference = time_dict['units'].split(' since ')
+    reference = np.datetime64(reference.strip().rstrip('Z').replace(' ', 'T'), 'ms')
+    scale = {'seconds': 1000., 'milliseconds': 1.}[unit.strip()]
+    milliseconds = np.round(np.asarray(time_dict['data'], dtype='float64') * scale).astype('int64')
+    return milliseconds + reference.astype('int64')
 
-def granule(Dvolume):
-    print('in granule')
-    n_tilts = 8
+def apply_glue_fill(radar):
+    """
+    Mask missing values of the glued fields and set their fill value
+
+    This is the in-memory equivalent of glue_fix; raw values at or below
+    -99800 (and non-finite values) are masked, and every masked gate is
+    written as -32768.
+    """
+    for var in GLUE_FILL_FIELDS:
+        if var not in radar.fields:
+            continue
+        field = radar.fields[var]
+        raw = np.ma.getdata(field['data'])
+        field['data'] = np.ma.masked_where(~np.isfinite(raw) | (raw <= -99800), field['data'], copy=False)
+        field['_FillValue'] = GLUE_FILL_VALUE
+    return radar
+
+def write_volume(filename, radar):
+    """
+    Write a glued volume, moving it into place only once it is complete
+
+    The ARM base_time and time_offset variables are written relative to the
+    whole second of the first ray, as in the sweep files, and only the time
+    variable is encoded in milliseconds since 1970.
+    """
+    times = epoch_milliseconds(radar.time)
+    base_time = times[0] // 1000 * 1000
+    reference = np.datetime64(int(base_time), 'ms').astype(datetime.datetime)
+    radar_time = radar.time
+    radar.time = dict(radar_time, data=(times - base_time) / 1000.,
+                      units=reference.strftime('seconds since %Y-%m-%dT%H:%M:%SZ'))
+
+    out_dir = Path(filename).parent
+    with tempfile.NamedTemporaryFile(dir=out_dir, suffix='.tmp', delete=False) as tmp:
+        tmp_path = tmp.name
+    try:
+        pyart.io.write_cfradial(tmp_path, radar, arm_time_variables=True)
+        with netCDF4.Dataset(tmp_path, 'a') as dataset:
+            dataset['time'][:] = times
+            dataset['time'].units = GLUE_TIME_UNITS
+        os.replace(tmp_path, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    finally:
+        radar.time = radar_time
+
+def granule(Dvolume, pool=None, prefetched=None, dem_file=None):
+    """
+    Glue one volume of sweep files into the glue_files directory of its month
+
+    A volume without one sweep for each of sail_volume_index.VOLUME_TILTS is
+    skipped and reported, and recorded as failed in the telemetry.
+    """
     #data_dir = "/gpfs/wolf/atm124/proj-shared/gucxprecipradarS2.00/nc_files/" + month + "_nc/"
     #out_dir = "/gpfs/wolf/atm124/proj-shared/gucxprecipradarS2.00/glue_files/" + month + "_glued/"
     month = Dvolume[0].split('/')[-2].split('_')[0]
     out_dir = Dvolume[0].split('nc_files')[0] + "glue_files/" + month + "_glued/"
 
-    # Read the base scan to determine if it can be read in
-    if len(Dvolume) == 8:
-        try:
-            base_rad = pyart.io.read(Dvolume[0])
-        except:
-            base_rad = None
-        # Read all scans and join with base scan
-        if base_rad is not None:
-            out_radar = volume_from_list(base_rad, Dvolume)
-            if out_radar is not None:
-                # Define the filename time from the radar object
-                ff = time.strptime(out_radar.time['units'][14:], '%Y-%m-%dT%H:%M:%SZ')
-                dt = datetime.datetime.fromtimestamp(time.mktime(ff)) + datetime.timedelta(seconds= int(out_radar.time['data'][0]))
-                strform = dt.strftime(out_dir + 'xprecipradar_guc_volume_%Y%m%d-%H%M%S.b1.nc')
-                #FIX for join issue.. to be fixed in Py-ART
-                out_radar.sweep_mode['data']=np.tile(base_rad.sweep_mode['data'], n_tilts)
-                try:
-                    pyart.io.write_cfradial(strform, out_radar, arm_time_variables=True)
-                    print('SUCCESS', strform)
-                except:
-                    print('FAILURE', strform)
-                # Delete the radars to free up memory
-                del base_rad
-                del out_radar
-            # Fix the times and encodings of the generated file
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tmp_path = Path(tmpdir)
-                with xr.open_dataset(strform, mask_and_scale=False) as ds:
-                    ds = ds.load()
-                    ds = fix_times(ds)
-                    ds = glue_fix(ds)
-                    out_path = str(tmp_path) + '/' + strform.split('/')[-1]
-                    # set time encoding for miliseconds
-                    ds.time.encoding['units'] = 'milliseconds since 1970-01-01'
-                    ds.to_netcdf(path=out_path)
-                shutil.copy(out_path, strform)
+    with sail_telemetry.file_record(Dvolume[0], 'glue', sweeps=len(Dvolume)):
+        n_tilts = len(sail_volume_index.VOLUME_TILTS)
+        if len(Dvolume) != n_tilts:
+            error = ValueError(f"{len(Dvolume)} sweeps, expected one per tilt ({n_tilts})")
+            print('SKIPPED', Dvolume[0], error)
+            sail_telemetry.record_error(error)
+            return
+        glue_volume(Dvolume, out_dir, pool, prefetched, dem_file)
+
+def glue_volume(Dvolume, out_dir, pool=None, prefetched=None, dem_file=None):
+    """
+    Read, glue, fix and write one volume, timing each stage
+    """
+    # Read every sweep; the files are prefetched in the background while earlier sweeps decode
+    radars = read_sweeps(Dvolume, pool, prefetched)
+    base_rad = radars[0] if radars is not None else None
+    # Join all scans with the base scan
+    if base_rad is None:
+        return
+    with sail_telemetry.stage('glue'):
+        out_radar = radar_glue(base_rad, radars[1:])
+    del radars
+    if out_radar is None:
+        return
+    # Define the filename time from the radar object
+    ff = time.strptime(out_radar.time['units'][14:], '%Y-%m-%dT%H:%M:%SZ')
+    dt = datetime.datetime.fromtimestamp(time.mktime(ff)) + datetime.timedelta(seconds= int(out_radar.time['data'][0]))
+    strform = dt.strftime(out_dir + 'xprecipradar_guc_volume_%Y%m%d-%H%M%S.b1.nc')
+    # Apply the final times and encodings in memory, then write once
+    with sail_telemetry.stage('fix'):
+        fix_radar_times(out_radar)
+        apply_glue_fill(out_radar)
+    if dem_file is not None:
+        # Blockage is looked up from the cache for every volume with this scan strategy
+        with sail_telemetry.stage('blockage'):
+            blockage = sail_beam_blockage.get_beam_blockage(out_radar, dem_file)
+            sail_beam_blockage.add_blockage_fields(out_radar, blockage)
+    try:
+        with sail_telemetry.stage('write'):
+            write_volume(strform, out_radar)
+        print('SUCCESS', strform)
+    except Exception as error:
+        print('FAILURE', strform, error)
+        sail_telemetry.record_error(error)
+    # Delete the radars to free up memory
+    del base_rad
+    del out_radar
+
+def volume_size(volume):
+    """
+    Total size in bytes of the sweep files of a volume, or None if any cannot be found
+    """
+    try:
+        return sum(os.path.getsize(sweep) for sweep in volume)
+    except OSError:
+        return None
+
+def granule_batch(volumes, read_threads=READ_THREADS, prefetch_budget_mb=PREFETCH_BUDGET_MB,
+                  dem_file=None):
+    """
+    Glue a sequence of volumes, reading the next volume while the current one is glued and written
+
+    The next volume is only prefetched when its files fit within the prefetch
+    budget, which caps the raw bytes read ahead of decoding. With dem_file,
+    the terrain beam blockage fields are added to every volume. A volume that
+    fails is reported and the rest of the batch carries on.
+    """
+    prefetched = {}
+    with ThreadPoolExecutor(max_workers=read_threads) as pool:
+        for index, volume in enumerate(volumes):
+            if index + 1 < len(volumes):
+                next_volume = volumes[index + 1]
+                next_size = volume_size(next_volume)
+                if next_size is not None and next_size <= prefetch_budget_mb * 1024 * 1024:
+                    prefetch_volume(next_volume, pool, prefetched)
+            try:
+                granule(volume, pool, prefetched, dem_file=dem_file)
+            except Exception as error:
+                print('FAILURE', volume[0], error)
+            finally:
+                # Skipped or failed volumes leave their reads behind
+                for sweep in volume:
+                    future = prefetched.pop(sweep, None)
+                    if future is not None:
+                        future.cancel()
 
 def main(args):
     print("process start time: ", time.strftime("%H:%M:%S"))
+    # Workers started from here on log a JSON line per volume
+    run = sail_telemetry.configure(args.telemetry) if args.telemetry else None
     # Define directories
     month = args.month
     path = '/gpfs/wolf/atm124/proj-shared/gucxprecipradarS2.00/nc_files/%s_nc/*.nc' % month
     out_path = '/gpfs/wolf/atm124/proj-shared/gucxprecipradarS2.00/glue_files/%s_glued/' % month
 
-    # Define files and determine volumes
-    all_files = sorted(glob.glob(path))
-    base_scan_ppi = '1_PPI.nc'
-    ppi_pattern = 'PPI.nc'
-    base_scans = []
-    volumes = []
-    ppis = []
-    in_volume = False
-    for nfile in all_files:
-        if ppi_pattern in nfile:
-            ppis.append(nfile)
-        if base_scan_ppi in nfile:
-            base_scans.append(nfile)
-    
-    n_tilts = 8
+    # Index any new sweep files, then group the month's sweeps into complete volumes
+    index = sail_volume_index.open_index(args.index or out_path + '../sweep_index.sqlite')
+    n_new = sail_volume_index.update_index(index, glob.glob(path))
+    volumes, incomplete = sail_volume_index.build_volumes(index, prefix=month)
+    index.close()
+    print(f"indexed {n_new} new sweeps; {len(volumes)} complete volumes, {len(incomplete)} incomplete")
+    os.makedirs(out_path, exist_ok=True)
+    with open(out_path + 'incomplete_volumes_%s.txt' % month, 'w') as report:
+        for sweeps, reason in incomplete:
+            print('INCOMPLETE', reason, sweeps[0])
+            report.write('%s\t%s\n' % (reason, ' '.join(sweeps)))
 
-    volumes = []
-    for base in base_scans:
-        base_scan_index = np.where(np.array(ppis) == base)[0][0]
-        volume = ppis[base_scan_index: base_scan_index+n_tilts]
-        volumes.append(volume)
-    
     if args.serial is True:
-        granule(volumes[0])
+        granule(volumes[0], dem_file=args.dem)
     else:
+        # Each task glues a short run of consecutive volumes, pipelining their reads
+        batches = [volumes[i:i + args.batch_size] for i in range(0, len(volumes), args.batch_size)]
         cluster = LocalCluster(n_workers=20, processes=True, threads_per_worker=1)
-        with Client(cluster) as c:
-            results = c.map(granule, volumes)
+        with Client(cluster) as c, sail_telemetry.performance_report(args.performance_report):
+            results = c.map(granule_batch, batches,
+                            read_threads=args.read_threads,
+                            prefetch_budget_mb=args.prefetch_budget_mb,
+                            dem_file=args.dem)
             wait(results)
         print("processing finished: ", time.strftime("%H:%M:%S"))
 
+    if run is not None:
+        sail_telemetry.print_summary(sail_telemetry.summarize(sail_telemetry.read_records(args.telemetry, run)))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
             description="Creation of .b1 glue files for SAIL")
@@ -169,6 +475,48 @@ if __name__ == "__main__":
                         type=bool,
                         help="Process in Serial"
     )
+    parser.add_argument("--index",
+                        default=None,
+                        dest='index',
+                        type=str,
+                        help="Sweep index database (default: sweep_index.sqlite next to the monthly glue directories)"
+    )
+    parser.add_argument("--read-threads",
+                        default=READ_THREADS,
+                        dest='read_threads',
+                        type=int,
+                        help="Threads reading sweep files ahead of decoding, per worker"
+    )
+    parser.add_argument("--batch-size",
+                        default=4,
+                        dest='batch_size',
+                        type=int,
+                        help="Consecutive volumes glued per task, with the next volume read ahead"
+    )
+    parser.add_argument("--prefetch-budget-mb",
+                        default=PREFETCH_BUDGET_MB,
+                        dest='prefetch_budget_mb',
+                        type=float,
+                        help="Maximum size of the next volume's files to read ahead, in MB"
+    )
+    parser.add_argument("--dem",
+                        default=None,
+                        dest='dem',
+                        type=str,
+                        help="DEM GeoTIFF; adds cached terrain beam blockage fields to each volume"
+    )
+    parser.add_argument("--telemetry",
+                        default=None,
+                        dest='telemetry',
+                        type=str,
+                        help="Append per-volume stage timings, memory and I/O to this JSON lines file"
+    )
+    parser.add_argument("--performance-report",
+                        default=None,
+                        dest='performance_report',
+                        type=str,
+                        help="Write a Dask performance report of the run to this HTML file"
+    )
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,306 @@
+"""
+Tiled parallel gridding of the glued SAIL X-Band volumes
+
+The inventory grids (notebooks/gluing_and_inventory) map each glued volume to
+a 17 x 601 x 601 Cartesian grid with pyart.map.grid_from_radars and Barnes2
+weighting, in a single call on one core. Here the horizontal domain is split
+into tiles that are gridded in a process pool and stitched back together.
+Each tile is gridded by Py-ART itself, with every gate outside the tile's
+halo excluded: a gate is only kept if the tile lies within its radius of
+influence plus one grid step, so each tile receives all the gates, in the same
+order, that the monolithic call maps to its grid points and the tiles join
+without seams. The tiles differ from the monolithic grid only at the odd gate
+lying right at the edge of a radius of influence, which float32 rounding of
+the grid point positions can put on either side.
+
+The workers are forked from the process reading the volume, so they inherit
+it without pickling, and report their peak RSS, which is added to the
+telemetry of the gridding stage.
+
+Usage:
+
+    python sail_grid.py --files '/gpfs/.../glue_files/202203_glued/*.b1.nc' --out-dir grids --tiles 4 4
+"""
+
+import argparse
+import copy
+import glob
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyart
+
+import sail_telemetry
+
+# Grid of the inventory notebook, (z, y, x) points and limits in meters from the radar
+INVENTORY_GRID_SHAPE = (17, 601, 601)
+INVENTORY_GRID_LIMITS = ((0., 8000.), (-30000., 30000.), (-30000., 30000.))
+
+# Tiles along y and x, and processes gridding them
+TILES = (4, 4)
+PROCESSES = min(TILES[0] * TILES[1], os.cpu_count() or 1)
+
+# Radius of influence defaults of pyart.map.map_gates_to_grid
+ROI_DEFAULTS = {'roi_func': 'dist_beam', 'constant_roi': None, 'min_radius': 250.,
+                'h_factor': (1., 1., 1.), 'nb': 1., 'bsp': 1.}
+
+# Radar, gates excluded by the caller and gate radius of influence of the
+# volume being gridded, inherited by the forked workers instead of being
+# pickled for every tile
+_volume = {}
+
+
+def tile_slices(npoints, ntiles):
+    """
+    Split npoints grid points into ntiles contiguous slices of nearly equal size
+    """
+    bounds = np.linspace(0, npoints, ntiles + 1).round().astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def gate_roi(radar, **kwargs):
+    """
+    Return the radius of influence [m] of each gate of a radar, to select the gates reaching a tile
+
+    Evaluates the ConstantRoI and DistBeamRoI functions of pyart.map, with the
+    map_gates_to_grid defaults and a grid centered on the radar, at the gates,
+    and returns None for any other radius of influence. Py-ART may evaluate the
+    radius at the grid points instead. The distance dependent radius grows by
+    tan(nb * bsp) = 0.017 m per meter from the radar with the defaults, so at
+    any grid point a gate reaches it exceeds the gate's own by under 2 %: about
+    10 m at the 30 km edge of the inventory grid, well within the one grid step
+    of margin _grid_tile adds.
+    """
+    options = {key: kwargs.get(key, value) for key, value in ROI_DEFAULTS.items()}
+    if options['constant_roi'] is not None or options['roi_func'] == 'constant':
+        constant_roi = options['constant_roi'] if options['constant_roi'] is not None else 500.
+        return np.full((radar.nrays, radar.ngates), constant_roi, dtype='float32')
+    if options['roi_func'] != 'dist_beam':
+        return None
+
+    # ARM SACR and SAPR radars get a smaller minimum radius, as in Py-ART
+    min_radius = options['min_radius']
+    platform = radar.metadata.get('platform_id')
+    if isinstance(platform, str) and any(name in platform.lower() for name in ['sacr', 'sapr']):
+        min_radius = 100.
+
+    h_factor = np.asarray(options['h_factor'], dtype='float32')
+    gate_z = (radar.gate_altitude['data'] - radar.altitude['data'][0]).astype('float32')
+    distance = np.sqrt((h_factor[0] * gate_z)**2 +
+                       (h_factor[1] * radar.gate_y['data'].astype('float32'))**2 +
+                       (h_factor[2] * radar.gate_x['data'].astype('float32'))**2)
+    roi = distance * np.float32(np.tan(np.deg2rad(options['nb'] * options['bsp'])))
+    return np.maximum(roi, np.float32(min_radius))
+
+
+def _tile_radar(radar, rays, ngates):
+    """
+    Return a view of a radar holding only some of its rays and its first ngates gates
+    """
+    tile_radar = copy.copy(radar)
+    for name in ['time', 'azimuth', 'elevation']:
+        setattr(tile_radar, name, dict(getattr(radar, name), data=getattr(radar, name)['data'][rays]))
+    for name in ['gate_x', 'gate_y', 'gate_z', 'gate_altitude', 'gate_latitude', 'gate_longitude']:
+        setattr(tile_radar, name, dict(getattr(radar, name), data=getattr(radar, name)['data'][rays, :ngates]))
+    tile_radar.range = dict(radar.range, data=radar.range['data'][:ngates])
+    tile_radar.fields = {name: dict(field, data=field['data'][rays, :ngates])
+                         for name, field in radar.fields.items()}
+    tile_radar.nrays = len(rays)
+    tile_radar.ngates = ngates
+    return tile_radar
+
+
+def _grid_tile(task):
+    """
+    Grid the gates of _volume within the halo of one tile, returning the grid, process id and its peak RSS [bytes]
+    """
+    tile_shape, tile_limits, kwargs = task
+    radar = _volume['radar']
+    excluded = _volume['excluded']
+    roi = _volume['roi']
+
+    if roi is not None:
+        # Keep the gates whose radius of influence reaches the tile, with one
+        # grid step of margin for rounding
+        (_, _), (y0, y1), (x0, x1) = tile_limits
+        margin = roi + max(_volume['steps'])
+        gate_x = radar.gate_x['data']
+        gate_y = radar.gate_y['data']
+        outside = ((gate_x < x0 - margin) | (gate_x > x1 + margin) |
+                   (gate_y < y0 - margin) | (gate_y > y1 + margin))
+        excluded = excluded | outside
+
+        # Only hand the rays and gates reaching the tile to Py-ART, which
+        # copies every field of the radar it grids. The first ray is always
+        # kept as it sets the grid time, and the gate order is unchanged so
+        # every grid point sums the same gates in the same order.
+        kept = ~outside
+        rays = np.flatnonzero(kept.any(axis=1) | (np.arange(radar.nrays) == 0))
+        ngates = max(int(np.flatnonzero(kept.any(axis=0)).max(initial=0)) + 1, 1)
+        radar = _tile_radar(radar, rays, ngates)
+        excluded = excluded[rays, :ngates]
+
+    gatefilter = pyart.filters.GateFilter(radar)
+    gatefilter.exclude_gates(excluded)
+    grid = pyart.map.grid_from_radars((radar,), tile_shape, tile_limits,
+                                      gatefilters=(gatefilter,), **kwargs)
+    # ru_maxrss is in kilobytes on Linux
+    return grid, os.getpid(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def tiled_grid_from_radar(radar, grid_shape=INVENTORY_GRID_SHAPE, grid_limits=INVENTORY_GRID_LIMITS,
+                          tiles=TILES, processes=PROCESSES, gatefilter=None, **kwargs):
+    """
+    Grid a radar like pyart.map.grid_from_radars, one horizontal tile per task
+
+    Parameters
+    ----------
+    radar : Radar
+        Radar volume to grid.
+    grid_shape, grid_limits : tuple
+        (z, y, x) number of points and limits [m] of the grid, centered on
+        the radar.
+    tiles : tuple
+        Number of tiles along y and x.
+    processes : int
+        Processes gridding the tiles; 1 grids them one after the other.
+    gatefilter : GateFilter, optional
+        Gates to leave out of the grid. Every gate is used by default, as in
+        grid_from_radars.
+    **kwargs
+        Passed to grid_from_radars (weighting_function, fields, roi_func...).
+
+    Returns
+    -------
+    grid : Grid
+        The grid, equal to the grid_from_radars one up to float32 rounding of
+        the grid point positions.
+    """
+    if 'grid_origin' in kwargs or 'grid_origin_alt' in kwargs:
+        raise ValueError("tiled gridding only supports grids centered on the radar")
+    if 'gatefilters' in kwargs:
+        raise ValueError("pass a single gatefilter to tiled gridding")
+
+    nz, ny, nx = grid_shape
+    z_limits, (y0, y1), (x0, x1) = grid_limits
+    y = np.linspace(y0, y1, ny)
+    x = np.linspace(x0, x1, nx)
+    y_slices = tile_slices(ny, tiles[0])
+    x_slices = tile_slices(nx, tiles[1])
+
+    # Tile grid points are taken from the full grid so that they coincide
+    tasks = [((nz, y_slice.stop - y_slice.start, x_slice.stop - x_slice.start),
+              (z_limits, (y[y_slice][0], y[y_slice][-1]), (x[x_slice][0], x[x_slice][-1])),
+              kwargs)
+             for y_slice in y_slices for x_slice in x_slices]
+
+    _volume['radar'] = radar
+    _volume['excluded'] = (gatefilter.gate_excluded if gatefilter is not None
+                           else np.zeros((radar.nrays, radar.ngates), dtype=bool))
+    _volume['roi'] = gate_roi(radar, **kwargs)
+    _volume['steps'] = ((y1 - y0) / max(ny - 1, 1), (x1 - x0) / max(nx - 1, 1))
+    try:
+        if processes > 1:
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+                results = list(pool.map(_grid_tile, tasks))
+            # The workers may peak at different times, so their sum is an upper bound
+            worker_rss = {}
+            for _, pid, rss in results:
+                worker_rss[pid] = max(worker_rss.get(pid, 0), rss)
+            sail_telemetry.add_worker_rss(sum(worker_rss.values()))
+        else:
+            results = list(map(_grid_tile, tasks))
+    finally:
+        _volume.clear()
+    tile_grids = [result[0] for result in results]
+
+    # Stitch the tiles, row by row
+    template = tile_grids[0]
+    fields = {}
+    for name, field in template.fields.items():
+        rows = [np.ma.concatenate([tile_grids[row * len(x_slices) + column].fields[name]['data']
+                                   for column in range(len(x_slices))], axis=2)
+                for row in range(len(y_slices))]
+        fields[name] = dict(field, data=np.ma.concatenate(rows, axis=1))
+
+    grid_x = dict(template.x, data=x)
+    grid_y = dict(template.y, data=y)
+    return pyart.core.Grid(template.time, fields, template.metadata,
+                           template.origin_latitude, template.origin_longitude, template.origin_altitude,
+                           grid_x, grid_y, template.z,
+                           radar_latitude=template.radar_latitude, radar_longitude=template.radar_longitude,
+                           radar_altitude=template.radar_altitude, radar_time=template.radar_time,
+                           radar_name=template.radar_name)
+
+
+def granule(path, out_dir, tiles=TILES, processes=PROCESSES):
+    """
+    Grid a glued volume on the inventory grid and write it to out_dir, returning the output path
+    """
+    with sail_telemetry.file_record(path, 'grid', tiles=list(tiles), processes=processes):
+        with sail_telemetry.stage('read'):
+            radar = pyart.io.read(path)
+        with sail_telemetry.stage('grid'):
+            grid = tiled_grid_from_radar(radar, tiles=tiles, processes=processes,
+                                         weighting_function='Barnes2')
+        with sail_telemetry.stage('write'):
+            xgrid = grid.to_xarray()
+            gtime = xgrid.time.data[0]
+            out_path = os.path.join(out_dir, gtime.strftime('xprecipradar_guc_grid_%Y%m%d-%H%M%S.b1.nc'))
+            xgrid.to_netcdf(out_path)
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Tiled parallel gridding of glued SAIL X-Band volumes on the inventory grid")
+
+    parser.add_argument("--files",
+                        required=True,
+                        dest='files',
+                        type=str,
+                        help="Glob of the glued .b1 volumes to grid"
+    )
+    parser.add_argument("--out-dir",
+                        default="grids",
+                        dest='out_dir',
+                        type=str,
+                        help="Directory to write the grids to"
+    )
+    parser.add_argument("--tiles",
+                        default=list(TILES),
+                        dest='tiles',
+                        type=int,
+                        nargs=2,
+                        help="Number of tiles along y and x"
+    )
+    parser.add_argument("--processes",
+                        default=PROCESSES,
+                        dest='processes',
+                        type=int,
+                        help="Processes gridding the tiles of each volume"
+    )
+    parser.add_argument("--telemetry",
+                        default=None,
+                        dest='telemetry',
+                        type=str,
+                        help="Append per-volume stage timings, memory and I/O to this JSON lines file"
+    )
+    args = parser.parse_args()
+
+    run = sail_telemetry.configure(args.telemetry) if args.telemetry else None
+    os.makedirs(args.out_dir, exist_ok=True)
+    for path in sorted(glob.glob(args.files)):
+        start = time.perf_counter()
+        try:
+            out_path = granule(path, args.out_dir, tiles=tuple(args.tiles), processes=args.processes)
+            print('SUCCESS', out_path, '%.1f s' % (time.perf_counter() - start))
+        except Exception as error:
+            print('FAILURE', path, error)
+    if run is not None:
+        sail_telemetry.print_summary(sail_telemetry.summarize(sail_telemetry.read_records(args.telemetry, run)))
@@ -0,0 +1,81 @@
+"""
+Field-selective reading of the CF/Radial files of the SAIL X-Band pipelines
+
+pyart.io.read decodes every field of a file into masked arrays, while each
+pipeline needs only part of them: SQUIRE uses the snow fields and a few
+others, and RadCLss only the gates above its sites. read_radar decodes just an
+allow-list of fields, optionally as float32. With lazy=True the fields stay in
+the file until they are used, and read_gates reads only the rays holding the
+requested gates, so untouched data is never read from disk.
+"""
+
+import functools
+
+import numpy as np
+import pyart
+
+
+def _load_as(loader, dtype):
+    """
+    Load a lazy field and cast it
+    """
+    return np.ma.asarray(loader(), dtype=dtype)
+
+
+def _lazy_variable(field):
+    """
+    Return the NetCDF variable of a field that has not been loaded yet, or None
+    """
+    loader = getattr(field, '_lazyload', {}).get('data')
+    return getattr(loader, 'ncvar', None)
+
+
+def read_radar(path, fields=None, dtype=None, lazy=False):
+    """
+    Read a CF/Radial file, decoding only the given fields
+
+    Parameters
+    ----------
+    path : str
+        CF/Radial file (CMAC volume or raw sweep).
+    fields : list, optional
+        Fields to read; fields missing from the file are skipped. Every field
+        is read by default.
+    dtype : str or numpy.dtype, optional
+        Cast the fields to this type (e.g. 'float32') as they are decoded.
+    lazy : bool
+        Keep the fields in the file and decode each one on first access. The
+        file stays open as long as the radar is referenced.
+
+    Returns
+    -------
+    radar : Radar
+        The Py-ART radar.
+    """
+    radar = pyart.io.read_cfradial(path, include_fields=fields, delay_field_loading=lazy)
+    if dtype is not None:
+        for field in radar.fields.values():
+            loader = getattr(field, '_lazyload', {}).get('data')
+            if loader is not None:
+                field.set_lazy('data', functools.partial(_load_as, loader, dtype))
+            else:
+                field['data'] = np.ma.asarray(field['data'], dtype=dtype)
+    return radar
+
+
+def read_gates(radar, field, rays, gates):
+    """
+    Return the values of a field at (ray, gate) pairs
+
+    A field that is still lazy is not loaded: only the rays holding the
+    requested gates are read from the file.
+    """
+    rays = np.asarray(rays)
+    gates = np.asarray(gates)
+    ncvar = _lazy_variable(radar.fields[field])
+    if ncvar is None:
+        return radar.fields[field]['data'][rays, gates]
+
+    unique_rays, ray_index = np.unique(rays, return_inverse=True)
+    data = np.ma.asarray(ncvar[unique_rays, :])
+    return data[ray_index.reshape(rays.shape), gates]
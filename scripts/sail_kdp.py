@@ -0,0 +1,215 @@
+"""
+KDP and PHIDP processing of the glued SAIL X-Band volumes
+
+The gate filter of notebooks/dual-pol (velocity and PHIDP texture) is computed
+once for the whole volume. The volume is then split into its sweeps, and each
+sweep is processed as one vectorized batch of rays in a process pool: the
+Maesaka et al. (2012) variational KDP retrieval (pyart.retrieve.kdp_maesaka)
+or the LP phase processing (pyart.correct.phase_proc_lp, which needs cvxopt).
+The sweeps are put back together as kdp_<method> and phidp_<method> fields
+covering every sweep of the volume.
+
+Usage:
+
+    python sail_kdp.py --files '/gpfs/.../glue_files/202203_glued/*.b1.nc' --out-dir kdp --processes 8
+"""
+
+import argparse
+import copy
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyart
+
+import sail_glue
+import sail_telemetry
+
+# Gate filter thresholds of notebooks/dual-pol
+VELOCITY_TEXTURE_THRESHOLD = 10.
+PHIDP_TEXTURE_THRESHOLD = 30.
+
+# Fields each method reads, besides PHIDP
+METHOD_FIELDS = {'maesaka': [],
+                 'lp': ['DBZ', 'NCP', 'RHOHV']}
+
+# Processes working on the sweeps of a volume
+PROCESSES = min(8, os.cpu_count() or 1)
+
+
+def texture_gatefilter(radar, vel_field='VEL', phidp_field='PHIDP',
+                       velocity_texture_threshold=VELOCITY_TEXTURE_THRESHOLD,
+                       phidp_texture_threshold=PHIDP_TEXTURE_THRESHOLD):
+    """
+    Return the gate filter excluding high velocity or PHIDP texture
+
+    The textures are computed on a shallow copy of the volume, so they are
+    not added to its fields. The Nyquist velocity is taken from the instrument
+    parameters, or from the largest velocity as in the notebooks.
+    """
+    nyquist = None
+    if radar.instrument_parameters and 'nyquist_velocity' in radar.instrument_parameters:
+        nyquist = float(np.max(radar.instrument_parameters['nyquist_velocity']['data']))
+    if nyquist is None:
+        nyquist = float(np.ma.max(np.ma.abs(radar.fields[vel_field]['data'])))
+
+    texture_radar = copy.copy(radar)
+    texture_radar.fields = dict(radar.fields)
+    vel_texture = pyart.retrieve.calculate_velocity_texture(texture_radar, vel_field=vel_field, nyq=nyquist,
+                                                            check_nyq_uniform=False)
+    texture_radar.add_field('velocity_texture', vel_texture, replace_existing=True)
+    phidp_texture = pyart.retrieve.texture_of_complex_phase(texture_radar, phidp_field=phidp_field,
+                                                            phidp_texture_field='phidp_texture')
+    texture_radar.add_field('phidp_texture', phidp_texture, replace_existing=True)
+
+    gatefilter = pyart.filters.GateFilter(texture_radar)
+    gatefilter.exclude_above('phidp_texture', phidp_texture_threshold)
+    gatefilter.exclude_above('velocity_texture', velocity_texture_threshold)
+    return gatefilter
+
+
+def sweep_kdp(sweep_radar, excluded, method='maesaka', phidp_field='PHIDP'):
+    """
+    Retrieve KDP and PHIDP for all the rays of one sweep at once
+
+    Parameters
+    ----------
+    sweep_radar : Radar
+        Single sweep radar holding the fields the method needs.
+    excluded : numpy.ndarray
+        (ray, gate) gates excluded by the volume gate filter.
+    method : str
+        'maesaka' or 'lp'.
+
+    Returns
+    -------
+    kdp, phidp : numpy.ma.MaskedArray
+        KDP [deg/km] and processed PHIDP [deg], masked at the excluded gates.
+    """
+    if method == 'maesaka':
+        gatefilter = pyart.filters.GateFilter(sweep_radar)
+        gatefilter.exclude_gates(excluded)
+        kdp, phidp, _ = pyart.retrieve.kdp_maesaka(sweep_radar, gatefilter=gatefilter,
+                                                   psidp_field=phidp_field)
+    elif method == 'lp':
+        # phase_proc_lp takes no gate filter, but leaves masked PHIDP gates
+        # out of the unfolding like its own NCP and RHOHV checks
+        field = sweep_radar.fields[phidp_field]
+        sweep_radar.fields[phidp_field] = dict(field, data=np.ma.masked_where(excluded, field['data']))
+        phidp, kdp = pyart.correct.phase_proc_lp(sweep_radar, 0.0, refl_field='DBZ',
+                                                 ncp_field='NCP', rhv_field='RHOHV',
+                                                 phidp_field=phidp_field)
+    else:
+        raise ValueError(f"unknown KDP method {method}, use one of {list(METHOD_FIELDS)}")
+    return (np.ma.masked_where(excluded, kdp['data']),
+            np.ma.masked_where(excluded, phidp['data']))
+
+
+def _sweep_task(task):
+    """
+    Process pool entry point for sweep_kdp
+    """
+    return sweep_kdp(*task)
+
+
+def volume_kdp(radar, gatefilter=None, method='maesaka', pool=None, phidp_field='PHIDP'):
+    """
+    Add kdp_<method> and phidp_<method> fields for every sweep of a volume
+
+    The gate filter (texture_gatefilter by default) is computed once for the
+    volume, and the sweeps are processed in parallel on the process pool if
+    one is given, otherwise one after the other.
+    """
+    if gatefilter is None:
+        gatefilter = texture_gatefilter(radar, phidp_field=phidp_field)
+    excluded = gatefilter.gate_excluded
+
+    # Send only the fields the method reads to the workers
+    fields = [phidp_field] + METHOD_FIELDS[method]
+    all_fields = radar.fields
+    radar.fields = {name: all_fields[name] for name in fields}
+    try:
+        tasks = [(radar.extract_sweeps([sweep]), excluded[radar.get_slice(sweep)], method, phidp_field)
+                 for sweep in range(radar.nsweeps)]
+    finally:
+        radar.fields = all_fields
+    results = list(pool.map(_sweep_task, tasks) if pool is not None else map(_sweep_task, tasks))
+
+    kdp = pyart.config.get_metadata('specific_differential_phase')
+    kdp['data'] = np.ma.concatenate([result[0] for result in results]).astype('float32')
+    kdp['comment'] = f"Retrieved per sweep with the {method} method"
+    phidp = pyart.config.get_metadata('differential_phase')
+    phidp['data'] = np.ma.concatenate([result[1] for result in results]).astype('float32')
+    phidp['comment'] = f"Processed per sweep with the {method} method"
+    radar.add_field(f"kdp_{method}", kdp, replace_existing=True)
+    radar.add_field(f"phidp_{method}", phidp, replace_existing=True)
+    return radar
+
+
+def process_volume(path, out_dir, method='maesaka', pool=None):
+    """
+    Add KDP and PHIDP to a glued volume and write it to out_dir, returning the output path
+    """
+    out_path = os.path.join(out_dir, os.path.basename(path))
+    with sail_telemetry.file_record(path, 'kdp', method=method):
+        with sail_telemetry.stage('read'):
+            radar = pyart.io.read(path)
+        with sail_telemetry.stage('gatefilter'):
+            gatefilter = texture_gatefilter(radar)
+        with sail_telemetry.stage('kdp'):
+            volume_kdp(radar, gatefilter, method=method, pool=pool)
+        with sail_telemetry.stage('write'):
+            sail_glue.write_volume(out_path, radar)
+    return out_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="KDP and PHIDP processing of glued SAIL X-Band volumes")
+
+    parser.add_argument("--files",
+                        required=True,
+                        dest='files',
+                        type=str,
+                        help="Glob of the glued .b1 volumes to process"
+    )
+    parser.add_argument("--out-dir",
+                        default="kdp",
+                        dest='out_dir',
+                        type=str,
+                        help="Directory to write the volumes with KDP to"
+    )
+    parser.add_argument("--method",
+                        default="maesaka",
+                        dest='method',
+                        choices=list(METHOD_FIELDS),
+                        help="KDP retrieval: maesaka (variational) or lp (LP phase processing, needs cvxopt)"
+    )
+    parser.add_argument("--processes",
+                        default=PROCESSES,
+                        dest='processes',
+                        type=int,
+                        help="Processes working on the sweeps of each volume"
+    )
+    parser.add_argument("--telemetry",
+                        default=None,
+                        dest='telemetry',
+                        type=str,
+                        help="Append per-volume stage timings, memory and I/O to this JSON lines file"
+    )
+    args = parser.parse_args()
+
+    run = sail_telemetry.configure(args.telemetry) if args.telemetry else None
+    os.makedirs(args.out_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        for path in sorted(glob.glob(args.files)):
+            start = time.perf_counter()
+            try:
+                out_path = process_volume(path, args.out_dir, method=args.method, pool=pool)
+                print('SUCCESS', out_path, '%.1f s' % (time.perf_counter() - start))
+            except Exception as error:
+                print('FAILURE', path, error)
+    if run is not None:
+        sail_telemetry.print_summary(sail_telemetry.summarize(sail_telemetry.read_records(args.telemetry, run)))
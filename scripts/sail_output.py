@@ -0,0 +1,204 @@
+"""
+Output writers for the SAIL X-Band radar products
+
+Encodings are derived from the DOD of each datastream (dtype and _FillValue),
+with compression and chunk shapes chosen for the common access patterns:
+single-time maps for SQUIRE and time series at a site for RadCLss. NetCDF
+files are written to a temporary file and moved into place, so readers never
+see a partial file. A month of output can also be written to one consolidated
+Zarr store, either at once or by appending each volume as it is processed.
+"""
+
+import contextlib
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+# Compression applied to every non-scalar numeric variable in NetCDF output
+COMPRESSION = {'zlib': True, 'shuffle': True, 'complevel': 4}
+
+# Chunk size of the time coordinate in appendable stores, so opening a month
+# reads a few chunks of times rather than one per volume
+TIME_INDEX_CHUNK = 4096
+
+# Fixed time encoding of appendable stores; otherwise xarray derives the units
+# from the first volume written
+STORE_TIME_ENCODING = {'units': 'milliseconds since 1970-01-01T00:00:00',
+                       'calendar': 'proleptic_gregorian',
+                       'dtype': 'int64'}
+
+# Chunk size per dimension for each datastream; dimensions not listed are
+# stored whole within a chunk
+OUTPUT_CHUNKS = {'xprecipradarsquire.c1': {'time': 1},
+                 'xprecipradarradclss.c2': {'site': 1},
+                 }
+
+
+def chunk_shape(variable, chunks):
+    """
+    Return the chunk shape of a variable, clipping the chunk sizes to its dimensions
+    """
+    return tuple(min(chunks.get(dim, size), size) or 1
+                 for dim, size in zip(variable.dims, variable.shape))
+
+
+def output_encoding(ds, schema=None, chunks=None, compression=COMPRESSION):
+    """
+    Build the NetCDF encoding of a dataset
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Dataset to write.
+    schema : dict, optional
+        DOD schema (from sail_dod.load_dod); its dtype and _FillValue are used
+        for every variable it defines.
+    chunks : dict, optional
+        Chunk size per dimension, see OUTPUT_CHUNKS.
+    compression : dict
+        NetCDF compression settings for non-scalar numeric variables.
+
+    Returns
+    -------
+    encoding : dict
+        Encoding per variable, for xarray's to_netcdf.
+    """
+    chunks = chunks or {}
+    dod_variables = schema['variables'] if schema is not None else {}
+    encoding = {}
+    for name, variable in ds.variables.items():
+        var_encoding = {}
+        if variable.dtype.kind not in 'Mm':
+            # Datetime variables are encoded by xarray from their units
+            var_encoding.update(dod_variables.get(name, {}).get('encoding', {}))
+        if variable.ndim > 0 and variable.dtype.kind in 'biufMm':
+            var_encoding.update(compression)
+            var_encoding['chunksizes'] = chunk_shape(variable, chunks)
+        if var_encoding:
+            encoding[name] = var_encoding
+    return encoding
+
+
+def zarr_encoding(encoding):
+    """
+    Translate a NetCDF encoding into a Zarr encoding, using Zarr's default compressor
+    """
+    out = {}
+    for name, var_encoding in encoding.items():
+        out[name] = {key: value for key, value in var_encoding.items()
+                     if key in ('dtype', '_FillValue')}
+        if 'chunksizes' in var_encoding:
+            out[name]['chunks'] = var_encoding['chunksizes']
+    return out
+
+
+def write_netcdf(ds, path, encoding=None):
+    """
+    Write a dataset to NetCDF through a temporary file in the same directory
+    """
+    out_dir = Path(path).parent
+    with tempfile.NamedTemporaryFile(dir=out_dir, suffix='.tmp', delete=False) as tmp:
+        tmp_path = tmp.name
+    try:
+        ds.to_netcdf(tmp_path, encoding=encoding)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def write_zarr(ds, store, encoding=None):
+    """
+    Write a dataset to a new consolidated Zarr store, replacing any existing one
+    """
+    ds = ds.chunk({dim: -1 for dim in ds.dims})
+    if encoding is not None:
+        encoding = zarr_encoding(encoding)
+        # Match the dask chunks to the Zarr chunks so every chunk is written once
+        for name, var_encoding in encoding.items():
+            if 'chunks' in var_encoding and name in ds.variables:
+                ds[name] = ds[name].chunk(dict(zip(ds[name].dims, var_encoding['chunks'])))
+    ds.to_zarr(store, mode='w', consolidated=True, encoding=encoding)
+    return store
+
+
+def combine_month(paths, store, schema=None, chunks=None):
+    """
+    Combine a month of NetCDF outputs along time into one consolidated Zarr store
+    """
+    with xr.open_mfdataset(sorted(paths), combine='nested', concat_dim='time',
+                           data_vars='minimal', coords='minimal', compat='override') as ds:
+        return write_zarr(ds, store, output_encoding(ds, schema, chunks))
+
+
+def append_to_store(ds, store, encoding=None, lock=None):
+    """
+    Append a dataset along time to a consolidated Zarr store
+
+    The store is created on the first call. A time that is already in the store
+    is overwritten in place instead of appended, so reprocessing a volume does
+    not duplicate it. Writers on different processes must share a lock (e.g. a
+    dask.distributed.Lock named after the store); encoding only applies when
+    the store is created.
+    """
+    ds = ds.copy(deep=False)
+    ds['time'].encoding = {}
+    with lock or contextlib.nullcontext():
+        if not os.path.exists(store):
+            encoding = zarr_encoding(encoding or {})
+            encoding['time'] = dict(STORE_TIME_ENCODING, chunks=(TIME_INDEX_CHUNK,))
+            ds.to_zarr(store, mode='w', consolidated=True, encoding=encoding)
+            return store
+
+        with xr.open_zarr(store, consolidated=True) as existing:
+            times = existing['time'].values
+
+        # Only the time-dependent variables are written after the first volume
+        ds = ds.drop_vars([name for name, variable in ds.variables.items()
+                           if 'time' not in variable.dims])
+        stored = np.isin(ds['time'].values, times)
+        for index in np.nonzero(stored)[0]:
+            position = int(np.nonzero(times == ds['time'].values[index])[0][-1])
+            ds.isel(time=[index]).to_zarr(store, region={'time': slice(position, position + 1)})
+        if not stored.all():
+            ds.isel(time=np.nonzero(~stored)[0]).to_zarr(store, append_dim='time', consolidated=True)
+    return store
+
+
+def open_store(store):
+    """
+    Open a time-indexed Zarr store lazily, in time order
+
+    Volumes are appended in the order they finish, so the time coordinate is
+    used as the index: only it is read when opening, and selections read only
+    the chunks of the selected times.
+    """
+    ds = xr.open_zarr(store, consolidated=True)
+    if not ds.indexes['time'].is_monotonic_increasing:
+        ds = ds.sortby('time')
+    return ds
+
+
+def select_times(ds, start=None, end=None):
+    """
+    Select the volumes between two times (inclusive) from an opened store
+    """
+    return ds.sel(time=slice(start, end))
+
+
+def select_point(ds, latitude, longitude):
+    """
+    Select the grid column nearest to a latitude and longitude from an opened store
+    """
+    lat = np.asarray(ds['lat'].values)
+    lon = np.asarray(ds['lon'].values)
+    if lat.ndim == 1:
+        lat, lon = np.meshgrid(lat, lon, indexing='ij')
+    distance = (lat - latitude) ** 2 + ((lon - longitude) * np.cos(np.deg2rad(latitude))) ** 2
+    y, x = np.unravel_index(np.nanargmin(distance), distance.shape)
+    return ds.isel(y=y, x=x)
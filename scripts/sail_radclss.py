@@ -2,58 +2,204 @@
 Script to process a month of the Extracted Radar Columns and In-Situ Sensors (RadCLss)
 
 Written: Joe O'Brien <obrienj@anl.gov> - 26 Sept 2022
+
+Each day is one task: the radar columns are extracted from that day's CMAC
+files in batches (themselves spread over the cluster), each ground datastream
+is read once, and the matched dataset is written as a daily file.
+
+Usage: python sail_radclss.py 202203 /path/to/output_dir [--workers 16]
 """
 
+import argparse
 import glob
 import os
-import datetime
-import sys
+import time
 
 import numpy as np
-import matplotlib.pyplot as plt
 import xarray as xr
-import pandas as pd
-from matplotlib.dates import DateFormatter
-from matplotlib import colors
 from calendar import monthrange
+from scipy.interpolate import interp1d
+from dask.distributed import Client, LocalCluster, as_completed
 
 import pyart
 import act
 
+import sail_geometry_cache
+import sail_io
+import sail_output
+import sail_telemetry
+
 #-----------------
 # Define Functions
 #-----------------
-# Define syntax. 
-def help_message():
-  print('\n')
-  print('Syntax: sail_radclss.py input_month output_dir\n\n')
-  print('PURPOSE:                                                    ')
-  print('     To Create RadCLss Dataset for input month \n')
-  print('  INPUT:                                                    ')
-  print('     input_month [YYYYMM] - SAIL CMAC2.0 Data Month to Process')
-  print('     output_dir           - Directory to hold the RadCLss dataset\n')
-  print('  Example: python sail_radclss.py 202203/ /202203/glued \n')
-
-def subset_points(file, lats, lons, sites):
-    """Subset a radar file for a set of latitudes and longitudes"""
-    
-    # Read in the file
-    radar = pyart.io.read(file)
+# Largest ray angle change for which a cached column lookup is reused
+COLUMN_ANGLE_TOLERANCE = 0.1  # degrees
+COLUMN_RANGE_TOLERANCE = 1.0  # meters
+
+# Ground observations in (radar time, radar time + window] are matched to a volume
+MATCH_WINDOW = np.timedelta64(5, 'm')
+
+# Metadata copied from the radar fields onto the extracted columns
+COLUMN_FIELD_META = ["units", "standard_name", "long_name", "valid_max", "valid_min", "coordinates"]
+
+
+def site_distance_azimuth(radar, lats, lons):
+    """
+    Great-circle distance [m] and forward azimuth [deg] from the radar to each site
+
+    Vectorized form of pyart.util.columnsect.sphere_distance and for_azimuth.
+    """
+    rlat = np.deg2rad(radar.latitude['data'][0])
+    rlon = np.deg2rad(radar.longitude['data'][0])
+    lat = np.deg2rad(np.asarray(lats, dtype='float64'))
+    lon = np.deg2rad(np.asarray(lons, dtype='float64'))
+
+    numerator = (np.sin((lat - rlat) / 2.0) ** 2.0 +
+                 np.cos(rlat) * np.cos(lat) * np.sin((lon - rlon) / 2.0) ** 2.0)
+    distance = 2 * 6371000 * np.arcsin(np.sqrt(numerator))
+
+    azimuth = np.rad2deg(np.arctan2(np.sin(lon - rlon) * np.cos(lat),
+                                    np.cos(rlat) * np.sin(lat) -
+                                    np.sin(rlat) * np.cos(lat) * np.cos(lon - rlon)))
+    return distance, azimuth % 360.
+
+def column_lookup(radar, lats, lons):
+    """
+    Find the ray and gate above each site in every sweep of a radar volume
+
+    Matches pyart.util.columnsect.get_field_location: the ray closest in azimuth
+    to the site in each sweep, and along it the gate closest in ground distance,
+    for all sites at once.
+
+    Returns
+    -------
+    lookup : dict
+        rays, gates and height (gate height above sea level), each shaped
+        (site, sweep), plus the azimuth, elevation and range they were found
+        from.
+    """
+    distance, azimuth = site_distance_azimuth(radar, lats, lons)
+
+    rays = np.empty((len(distance), radar.nsweeps), dtype='int64')
+    for i, sweep in enumerate(radar.iter_slice()):
+        sweep_azi = radar.azimuth['data'][sweep]
+        rays[:, i] = np.argmin(np.abs(sweep_azi[np.newaxis, :] - azimuth[:, np.newaxis]), axis=1) + sweep.start
+
+    # Gate centers of the selected rays only
+    x, y, z = pyart.core.transforms.antenna_vectors_to_cartesian(
+        radar.range['data'], radar.azimuth['data'][rays.ravel()],
+        radar.elevation['data'][rays.ravel()], edges=False)
+    ground = (np.sqrt(x ** 2 + y ** 2) * np.sign(z)).reshape(rays.shape + (-1,))
+    # Same gate choice as get_field_location, which searches from the second gate
+    # on but uses the index within that search as the gate
+    gates = np.argmin(np.abs(ground[..., 1:] - distance[:, np.newaxis, np.newaxis]), axis=-1)
+    height = np.take_along_axis(z.reshape(ground.shape), gates[..., np.newaxis], axis=-1)[..., 0]
+
+    return dict(sail_geometry_cache.scan_geometry(radar),
+                rays=rays,
+                gates=gates,
+                height=height + radar.altitude['data'][0])
+
+def get_column_lookup(radar, lats, lons, cache=None):
+    """
+    Return the column lookup for a radar volume, reusing a cached one if possible
+
+    cache is a dictionary kept by the caller across volumes. A cached lookup is
+    reused when the site list and radar location match and every ray angle is
+    within COLUMN_ANGLE_TOLERANCE of the volume it was built from.
+    """
+    if cache is None:
+        return column_lookup(radar, lats, lons)
+
+    key = (tuple(np.round(lats, 6)), tuple(np.round(lons, 6)),
+           round(float(radar.latitude['data'][0]), 4), round(float(radar.longitude['data'][0]), 4),
+           round(float(radar.altitude['data'][0]), 1))
+    lookup = cache.get(key)
+    if (lookup is not None and lookup['rays'].shape[1] == radar.nsweeps and
+            sail_geometry_cache.geometry_matches(lookup, radar, COLUMN_ANGLE_TOLERANCE, COLUMN_RANGE_TOLERANCE)):
+        return lookup
+
+    lookup = column_lookup(radar, lats, lons)
+    cache[key] = lookup
+    return lookup
+
+def _interp_columns(height, values, new_height):
+    """
+    Linearly interpolate (site, sweep) columns onto common heights, NaN outside
+    """
+    out = np.full(values.shape[:-1] + (new_height.size,), np.nan)
+    for i in range(height.shape[0]):
+        # Sort by height like xarray's interp, keeping sweep order for ties
+        order = np.argsort(height[i], kind='stable')
+        out[i] = interp1d(height[i][order], values[i][..., order], axis=-1,
+                          bounds_error=False, fill_value=np.nan, assume_sorted=True)(new_height)
+    return out
+
+def extract_columns(radar, lookup, lats, lons, sites):
+    """
+    Extract the (site, height) radar columns for all sites of a radar volume
+
+    Produces the same dataset as calling get_field_location for each site,
+    interpolating to 100 m heights and concatenating along site. Fields still
+    lazy in the radar (sail_io.read_radar with lazy=True) are read only for
+    the rays holding the column gates.
+    """
+    rays, gates = lookup['rays'], lookup['gates']
+    new_height = np.arange(np.round(radar.altitude['data'][0]), 10100, 100)
+    dims = ('site', 'height')
+
+    # Gather every field at the column gates, masked gates becoming NaN
+    names = list(radar.fields)
+    values = np.stack([np.ma.filled(np.ma.asarray(sail_io.read_gates(radar, name, rays, gates), dtype='float64'),
+                                    np.nan) for name in names])
+    columns = _interp_columns(lookup['height'], np.moveaxis(values, 0, 1), new_height)
+
+    data_vars = {}
+    for i, name in enumerate(names):
+        attrs = {tag: radar.fields[name][tag] for tag in COLUMN_FIELD_META if tag in radar.fields[name]}
+        data_vars[name] = (dims, columns[:, i], attrs)
+
+    # Time at the center of each column gate, relative to the volume start
+    base_time = np.datetime64(pyart.util.datetime_from_radar(radar).isoformat(), "ns")
+    offsets = _interp_columns(lookup['height'], np.asarray(radar.time['data'], dtype='float64')[rays],
+                              new_height)
+    time_offset = base_time + (offsets * 1e9).astype('timedelta64[ns]')
+    time_offset[np.isnan(offsets)] = np.datetime64('NaT')
+    data_vars['base_time'] = (('site',), np.full(len(sites), base_time),
+                              dict(long_name="UTC Reference Time", units="seconds"))
+    data_vars['time_offset'] = (dims, time_offset,
+                                dict(long_name="Time in Seconds Since Volume Start", units="seconds",
+                                     description=("Time in Seconds Since Volume Start that Cooresponds"
+                                                  + " to the Center of Each Height Gate"
+                                                  + " Above the Target Location")))
+    data_vars['latitude'] = (('site',), np.asarray(lats, dtype='float64'))
+    data_vars['longitude'] = (('site',), np.asarray(lons, dtype='float64'))
+
+    # Time is based off the start of the radar volume
+    ds = xr.Dataset(data_vars,
+                    coords=dict(site=list(sites), height=new_height, time=[base_time]))
+    ds.height.attrs.update(long_name="Height of Radar Beam", units="m", standard_name="height",
+                           description=("Height Above Sea Level [in meters] for the Center of Each"
+                                        + " Radar Gate Above the Target Location"))
+    return ds
+
+def subset_points(file, lats, lons, sites, lookup_cache=None):
+    """
+    Subset a radar file for a set of latitudes and longitudes
+
+    The gate geolocation is computed once for all sites. Pass the same
+    lookup_cache dictionary for every file to reuse the gate lookup across
+    volumes with the same scan geometry.
+    """
     
-    column_list = []
-    for lat, lon in zip(lats, lons):
-        # Make sure we are interpolating from the radar's location above sea level
-        # NOTE: interpolating throughout Troposphere to match sonde to in the future
-        da = pyart.util.columnsect.get_field_location(radar, lat, lon).interp(height=np.arange(np.round(radar.altitude['data'][0]), 10100, 100))
-        # Add the latitude and longitude of the extracted column
-        da["latitude"], da["longitude"] = lat, lon
-        # Time is based off the start of the radar volume
-        dt = pd.to_datetime(radar.time["data"], unit='s')[-1]
-        da["time"] = [dt]
-        column_list.append(da)
-    # Concatenate the extracted radar columns for this scan across all sites    
-    ds = xr.concat(column_list, dim='site')
-    ds["site"] = sites
+    # Read in the file, leaving the fields on disk until the column gates are extracted
+    with sail_telemetry.stage('read'):
+        radar = sail_io.read_radar(file, lazy=True)
+
+    with sail_telemetry.stage('extract'):
+        lookup = get_column_lookup(radar, lats, lons, cache=lookup_cache)
+        ds = extract_columns(radar, lookup, lats, lons, sites)
+
     # Add attributes for Time, Latitude, Longitude, and Sites
     ds.time.attrs.update(long_name=('Time in Seconds that Cooresponds to the Start'
                                     + " of each Individual Radar Volume Scan before"
@@ -67,7 +213,98 @@ def subset_points(file, lats, lons, sites):
                              units='Degrees East')
     return ds
 
-def match_datasets_act(column, ground, site, discard, resample='sum', DataSet=False):
+def window_bounds(times, targets, window=MATCH_WINDOW):
+    """
+    Index bounds of the observations in the window (target, target + window]
+
+    Returns (left, right) so that times[left[i]:right[i]] falls in the window of
+    targets[i]. times must be sorted.
+    """
+    times = np.asarray(times).astype('datetime64[ns]')
+    targets = np.asarray(targets).astype('datetime64[ns]')
+    left = np.searchsorted(times, targets, side='right')
+    right = np.searchsorted(times, targets + window, side='right')
+    return left, right
+
+def window_reduce(values, left, right, how='sum'):
+    """
+    Reduce values (time first) over the windows [left, right), ignoring NaN
+
+    how is 'sum', 'mean' or 'max'. Windows without valid observations are NaN.
+    """
+    if how not in ('sum', 'mean', 'max'):
+        raise ValueError("Unknown reduction %s; use 'sum', 'mean' or 'max'" % how)
+    values = np.asarray(values, dtype='float64')
+    valid = ~np.isnan(values)
+    # Interleave the bounds so every other reduceat segment is a window; the
+    # padding row keeps the bounds valid indices
+    pad = np.zeros((1,) + values.shape[1:])
+    bounds = np.column_stack([left, right]).ravel()
+    empty = (np.asarray(right) <= np.asarray(left)).reshape((-1,) + (1,) * (values.ndim - 1))
+
+    if valid.all():
+        count = (np.asarray(right) - np.asarray(left)).reshape(empty.shape)
+    else:
+        count = np.add.reduceat(np.concatenate([valid, pad.astype(bool)]), bounds, axis=0, dtype='int64')[::2]
+        count = np.where(empty, 0, count)
+    if how == 'max':
+        out = np.fmax.reduceat(np.concatenate([values, pad + np.nan]), bounds, axis=0)[::2]
+    else:
+        out = np.add.reduceat(np.concatenate([np.where(valid, values, 0.), pad]), bounds, axis=0)[::2]
+        if how == 'mean':
+            out = out / np.where(count > 0, count, 1)
+    return np.where(count > 0, out, np.nan)
+
+def bin_to_radar_times(grd_ds, times, resample='sum', window=MATCH_WINDOW):
+    """
+    Bin the time series of a ground dataset onto the radar volume times
+
+    Each radar time gets the observations in (time, time + window], the same
+    windows the 5 minute right-closed resampling used. Only the numeric time
+    series are read, and only over the span of the radar times.
+
+    Parameters
+    ----------
+    grd_ds : Xarray DataSet
+        Ground instrumentation dataset, may be lazily loaded.
+    times : array
+        Radar volume times.
+    resample : str or dict
+        Reduction ('sum', 'mean' or 'max') for every variable, or a dictionary
+        of variable name to reduction; variables not in the dictionary are summed.
+    window : numpy.timedelta64
+        Length of the matching window after each radar time.
+
+    Returns
+    -------
+    matched : Xarray DataSet
+        Dataset of the binned variables on the radar time axis.
+    """
+    grd_times = grd_ds['time'].values
+    left, right = window_bounds(grd_times, times, window)
+    # Read only the span of observations that falls in any window
+    start, stop = left.min(), max(right.max(), left.min())
+    left, right = left - start, right - start
+
+    data_vars = {}
+    for name, var in grd_ds.data_vars.items():
+        if 'time' not in var.dims:
+            data_vars[name] = var
+            continue
+        if var.dtype.kind not in 'biuf':
+            continue
+        how = resample.get(name, 'sum') if isinstance(resample, dict) else resample
+        values = var.transpose('time', ...).isel(time=slice(start, stop)).values
+        data_vars[name] = xr.Variable(var.transpose('time', ...).dims,
+                                      window_reduce(values, left, right, how),
+                                      attrs=var.attrs)
+
+    coords = {name: coord for name, coord in grd_ds.coords.items() if 'time' not in coord.dims}
+    coords['time'] = np.asarray(times).astype('datetime64[ns]')
+    return xr.Dataset(data_vars, coords=coords, attrs=grd_ds.attrs)
+
+def match_datasets_act(column, ground, site, discard, resample='sum', DataSet=False,
+                       window=MATCH_WINDOW):
     """
     Time synchronization of a Ground Instrumentation Dataset to 
     a Radar Column for Specific Locations using the ARM ACT package
@@ -90,13 +327,17 @@ def match_datasets_act(column, ground, site, discard, resample='sum', DataSet=Fa
         List containing the desired input ground instrumentation variables to be 
         removed from the xarray DataSet. 
     
-    resample : str
-        Mathematical operational for resampling ground instrumentation to the radar time.
-        Default is to sum the data across the resampling period. Checks for mean. 
+    resample : str or dict
+        Mathematical operation for binning ground instrumentation to the radar time,
+        'sum', 'mean' or 'max'. Default is to sum the data across the window.
+        A dictionary sets the operation per variable (others are summed).
     
     DataSet : boolean
         Boolean flag to determine if ground input is an Xarray Dataset.
         Set to True if ground input is Xarray DataSet. 
+
+    window : numpy.timedelta64
+        Length of the matching window following each radar time.
              
     Returns
     -------
@@ -108,35 +349,28 @@ def match_datasets_act(column, ground, site, discard, resample='sum', DataSet=Fa
     if DataSet == True:
         grd_ds = ground
     else:
-        # Read in the file using ACT
+        # Read in the file using ACT; arrays stay lazy until the matched span is read
         grd_ds = act.io.armfiles.read_netcdf(ground, cleanup_qc=True, drop_variables=discard)
-        # Default are Lazy Arrays; convert for matching with column
-        grd_ds = grd_ds.compute()
         
-    # Remove Base_Time before Resampling Data since you can't force 1 datapoint to 5 min sum
+    # Remove Base_Time before binning since you can't force 1 datapoint to 5 min sum
     if 'base_time' in grd_ds.data_vars:
-        del grd_ds['base_time']
-        
+        grd_ds = grd_ds.drop_vars('base_time')
+
+    # Bin the ground data onto the CSU X-Band volume times in one pass.
+    # Keep data variable attributes to help distingish between instruments/locations
+    if isinstance(resample, str):
+        resample = resample.split('=')[-1]
+    matched = bin_to_radar_times(grd_ds, column.time.values, resample=resample, window=window)
+
     # Check to see if height is a dimension within the ground instrumentation. 
-    # If so, first interpolate heights to match radar, before interpolating time.
-    if 'height' in grd_ds.dims:
-        grd_ds = grd_ds.interp(height=np.arange(column['height'].data[0], 10100, 100), method='linear')
+    # If so, interpolate the binned profiles to the radar heights.
+    if 'height' in matched.dims:
+        matched = matched.interp(height=column['height'].values, method='linear')
         
     # Check to see if ground instrumentation is the RWP, as it has conflicting variable names
     # with the CMAC2.0 extracted radar columns
-    if 'signal_to_noise_ratio' in grd_ds.data_vars:
-        grd_ds = grd_ds.rename_vars(signal_to_noise_ratio='rwp_signal_to_noise_ratio')
-
-    # Resample the ground data to 5 min and interpolate to the CSU X-Band time. 
-    # Keep data variable attributes to help distingish between instruments/locations
-    if resample.split('=')[-1] == 'mean':
-        matched = grd_ds.resample(time='5Min', 
-                                  closed='right').mean(keep_attrs=True).interp(time=column.time, 
-                                                                               method='linear') 
-    else:
-        matched = grd_ds.resample(time='5Min', 
-                                  closed='right').sum(keep_attrs=True).interp(time=column.time, 
-                                                                              method='linear')
+    if 'signal_to_noise_ratio' in matched.data_vars:
+        matched = matched.rename_vars(signal_to_noise_ratio='rwp_signal_to_noise_ratio')
     
     # Add SAIL site location as a dimension for the Pluvio data
     matched = matched.assign_coords(coords=dict(site=site))
@@ -177,21 +411,11 @@ RWP_DIR = '/gpfs/wolf/atm124/proj-shared/guc915rwpprecipmomenthighM1.a0/'
 ARM_USERNAME = os.getenv("ARM_USERNAME")
 ARM_TOKEN = os.getenv("ARM_TOKEN")
 
-#-----------------
-# Input Parameters
-#-----------------
-# Check input parameters. 
-for param in sys.argv:
-  if param.startswith('-h') | param.startswith('-help') | param.startswith('--h'):
-    help_message()
-    exit()
-# Check to make sure correct number of input parameters are sent. 
-if (len(sys.argv) > 2):
-  INPUT_MONTH = sys.argv[-2]
-  OUTPUT_DIR = sys.argv[-1]
-else:
-  help_message()
-  exit()
+# Datastream of the RadCLss output files
+DATASTREAM = 'xprecipradarradclss.c2'
+
+# Radar files extracted per task; the column lookup is reused within a batch
+RADAR_BATCH_SIZE = 24
 
 #-------------------------------
 # Define Location of SAIL Sites
@@ -241,159 +465,220 @@ discard_var = {'LD' : ['base_time', 'time_offset', 'equivalent_radar_reflectivit
                        ]
               }
 
-#------------------------------------------------------------------------------
-# Loop through each day within the month directory, making daily RadCLss files
-#------------------------------------------------------------------------------
-mrange = monthrange(int(INPUT_MONTH[0:4]), int(INPUT_MONTH[4:]))
-for i in range(1, mrange[1]+1):
-    print(i)
+# Ground datastreams matched to the radar columns, in merge order:
+# (name, file pattern, site, discard_var key, resample)
+GROUND_DATASTREAMS = [('Pluvio', PLUVIO_DIR + 'gucwbpluvio2M1.a1.%s*', 'M1', 'Pluvio', 'sum'),
+                      ('Met', MET_DIR + 'gucmetM1.b1.%s*', 'M1', 'Met', 'sum'),
+                      ('LD_M1', LD_M1_DIR + 'gucldM1.b1.%s*', 'M1', 'LD', 'sum'),
+                      ('LD_S2', LD_S2_DIR + 'gucldS2.b1.%s*', 'S2', 'LD', 'sum'),
+                      ('RWP', RWP_DIR + 'guc915rwpprecipmomenthighM1.a0.%s*', 'M1', 'RWP', 'mean'),
+                      ('Sonde', SONDE_DIR + 'gucsondewnpnM1.b1.%s*', 'M1', 'Sonde', 'sum'),
+                      ]
+
+#--------------------
+# Daily Pipeline
+#--------------------
+def radar_files(date):
+    """
+    Return the CMAC files for a day (YYYYMMDD)
+    """
+    return sorted(glob.glob(RADAR_DIR + date + '/' + 'gucxprecipradarcmacS2.c1.' + date + '*.nc'))
+
+def extract_batch(files, lats=lats, lons=lons, sites=sites):
+    """
+    Extract the site columns from a run of radar files, sharing one column lookup
+    """
+    lookup_cache = {}
+    columns = []
+    for file in files:
+        try:
+            with sail_telemetry.file_record(file, 'radclss_columns'):
+                columns.append(subset_points(file, lats, lons, sites, lookup_cache=lookup_cache))
+        except Exception as error:
+            print('FAILURE', file, error)
+    return columns
+
+def read_ground(name, pattern, discard):
+    """
+    Read one ground datastream for a day, or return None if there are no files
+    """
+    files = sorted(glob.glob(pattern))
+    if len(files) == 0:
+        print('No %s files found: %s' % (name, pattern))
+        return None
+
+    if name == 'Sonde':
+        # Open each individual Sonde File, keeping successful launches (e.g. time > 1 obs)
+        sonde_list = []
+        for nfile in files:
+            sonde = act.io.armfiles.read_netcdf(nfile, drop_variables=discard)
+            if sonde.time.shape[0] > 1:
+                sonde_list.append(sonde)
+        if len(sonde_list) == 0:
+            return None
+        return xr.concat(sonde_list, dim='time')
+
+    # Arrays stay lazy; matching reads only the variables and times it needs
+    return act.io.armfiles.read_netcdf(files, cleanup_qc=True, drop_variables=discard)
+
+def load_ground_data(date):
+    """
+    Read every ground datastream for a day once, keyed by datastream name
+    """
+    return {name: read_ground(name, pattern % date, discard_var[discard])
+            for name, pattern, site, discard, resample in GROUND_DATASTREAMS}
 
-    # Define the date.
-    if i < 10:
-        NDATE = INPUT_MONTH + '0' + str(i)
+def radclss_day(date, columns, output_dir):
+    """
+    Build and write the RadCLss file for one day
+
+    Parameters
+    ----------
+    date : str
+        Day to process, YYYYMMDD.
+    columns : list
+        Lists of extracted column datasets (as returned by extract_batch).
+    output_dir : str
+        Directory to hold the RadCLss dataset.
+
+    Returns
+    -------
+    out_path : str or None
+        The written file, or None if the day has no radar columns.
+    """
+    with sail_telemetry.file_record(date, 'radclss_day'):
+        ds_list = [column for batch in columns for column in batch]
+        if len(ds_list) == 0:
+            print('No radar columns for', date)
+            return None
+
+        # Concatenate all extracted columns across time dimension to form daily timeseries
+        with sail_telemetry.stage('concat'):
+            ds = xr.concat(ds_list, dim='time')
+
+        # Remove Global Attributes from the Column Extraction
+        # Attributes make sense for single location, but not collection of sites. 
+        ds.attrs = {}
+
+        # Remove the Base_Time variable from extracted column
+        del ds['base_time']
+        # xarray encodes the units of datetime variables itself
+        ds['time_offset'].attrs.pop('units', None)
+
+        # Each ground datastream is read once and matched to the columns of every site
+        with sail_telemetry.stage('ground'):
+            ground = load_ground_data(date)
+        with sail_telemetry.stage('match'):
+            for name, pattern, site, discard, resample in GROUND_DATASTREAMS:
+                if ground[name] is not None:
+                    ds = match_datasets_act(ds, ground[name], site, discard=discard_var[discard],
+                                            resample=resample, DataSet=True)
+
+        #------------------
+        # Save the Dataset
+        #------------------
+        out_path = os.path.join(output_dir, DATASTREAM + '.' + date + '.000000.nc')
+        encoding = sail_output.output_encoding(ds, chunks=sail_output.OUTPUT_CHUNKS[DATASTREAM])
+        with sail_telemetry.stage('write'):
+            sail_output.write_netcdf(ds, out_path, encoding)
+        print('output: ', out_path)
+        return out_path
+
+def month_dates(month):
+    """
+    Return the days (YYYYMMDD) of a month (YYYYMM)
+    """
+    mrange = monthrange(int(month[0:4]), int(month[4:]))
+    return ['%s%02d' % (month, day) for day in range(1, mrange[1] + 1)]
+
+def main(args):
+    print("process start time: ", time.strftime("%H:%M:%S"))
+    # Workers started from here on log a JSON line per radar file and per day
+    run = sail_telemetry.configure(args.telemetry) if args.telemetry else None
+    os.makedirs(args.output_dir, exist_ok=True)
+    dates = month_dates(args.input_month.strip('/'))
+    if args.day is not None:
+        dates = [date for date in dates if date.endswith('%02d' % args.day)]
+
+    if args.serial is True:
+        for date in dates:
+            files = radar_files(date)
+            batches = [files[i:i + RADAR_BATCH_SIZE] for i in range(0, len(files), RADAR_BATCH_SIZE)]
+            radclss_day(date, [extract_batch(batch) for batch in batches], args.output_dir)
     else:
-        NDATE =  INPUT_MONTH + str(i)
-
-    #-------------------------------------------------------------
-    # Grab all the CMAC processed files and Extract Radar Columns
-    #-------------------------------------------------------------
-    # With the user defined RADAR_DIR, grab all the XPRECIPRADAR CMAC files for the defined DATE
-    file_list = sorted(glob.glob(RADAR_DIR + NDATE + '/' + 'gucxprecipradarcmacS2.c1.' + NDATE + '*.nc'))
-
-    ##ds_list = []
-    ##for file in file_list[:]:
-    ##    print(file)
-    ##    ds_list.append(subset_points(file, lats, lons, sites))
-
-    # Concatenate all extracted columns across time dimension to form daily timeseries
-    ##ds = xr.concat(ds_list, dim='time')
-
-    ##ds.sel(site='M1').sel(height=slice(3300, 4500)).corrected_reflectivity.plot(x='time',
-    ##                                                                            cmap='pyart_HomeyerRainbow')
-
-    # Remove Global Attributes from the Column Extraction
-    # Attributes make sense for single location, but not collection of sites. 
-    ##ds.attrs = {}
-
-    # Remove the Base_Time variable from extracted column
-    ##del ds['base_time']
-
-    #------------------------------------------
-    # 1) Add in the Pluvio Weighing Bucket Data
-    #------------------------------------------
-    # Define the file path
-    npluvio = sorted(glob.glob(PLUVIO_DIR + 'gucwbpluvio2M1.a1.' + NDATE + '*'))
-    print(npluvio[:])
-    # Define the site location based on the filename
-    PLUV_SITE = 'M1'
-
-    # Call Match Datasets ACT 
-    ##ds = match_datasets_act(ds, npluvio[0], PLUV_SITE, discard=discard_var['Pluvio'])
-
-    #-----------------------------------------------
-    # 2) Add in the Surface Meteorological Station
-    #-----------------------------------------------
-    # Define the file path
-    nmet = sorted(glob.glob(MET_DIR + 'gucmetM1.b1.' + NDATE + '*'))
-    print(nmet)
-    # Define the site location based on the filename
-    MET_SITE = 'M1'
-
-    # Call Match Datasets ACT
-    ##ds = match_datasets_act(ds, nmet[0], MET_SITE, discard=discard_var['Met'])
-
-    #----------------------------------------
-    # 3) Add the Laser Disdrometer - M1 Site
-    #----------------------------------------
-    # Define the file path
-    nld = sorted(glob.glob(LD_M1_DIR + 'gucldM1.b1.' + NDATE + '*'))
-    print(nld)
-    # Define the site location based on the filename
-    LD_M1_SITE = 'M1'
-
-    # Call Match Datasets ACT
-    ##ds = match_datasets_act(ds, nld[0], LD_M1_SITE, discard=discard_var['LD'])
-
-    #----------------------------------------
-    # 4) Add the Laser Disdrometer - S2 Site
-    #----------------------------------------
-    # Define the file path
-    ld_2 = sorted(glob.glob(LD_S2_DIR + 'gucldS2.b1.' + NDATE + '*'))
-    print(ld_2)
-    # Define the site location based on the filename
-    LD_S2_SITE = 'S2'
-
-    # Call Match Datasets ACT
-    ##ds = match_datasets_act(ds, ld_2[0], LD_S2_SITE, discard=discard_var['LD'])
-
-    #--------------------------------
-    # 5) Add the Radar Wind Profiler
-    #--------------------------------
-    # Define the file path
-    nrwp = sorted(glob.glob(RWP_DIR+ 'guc915rwpprecipmomenthighM1.a0.' + NDATE + '*'))
-    print(nrwp)
-    if len(nrwp) > 0:
-        # Define the site location based on the filename
-        RWP_SITE = 'M1'
-
-        # Call Match Datasets ACT
-        #ds = match_datasets_act(ds, nrwp[0], RWP_SITE, resample='mean', discard=discard_var['RWP'])
-
-        # Check to make sure the RWP datastream merged in correctly
-        #ds.sel(site='M1').doppler_velocity.plot(x='time')
-
-    #----------------------------
-    # 6) Add the Radiosonde Data
-    #----------------------------
-    # Search for all sonde files
-    nsonde = sorted(glob.glob(SONDE_DIR+ "gucsondewnpnM1.b1." + NDATE + '*'))
-    print(nsonde)
-
-    # Open each individual Sonde File and Merge together
-    sonde_list = []
-    #for nfile in nsonde:
-        #sonde = act.io.armfiles.read_netcdf(nfile)
-        # Check to make sure launch was successful (e.g. time > 1 obs)
-        #if sonde.time.shape[0] > 1:
-         #   sonde_list.append(sonde)
-    # Concatenate together the sonde xarray DataSets
-    #ds_sonde = xr.concat(sonde_list, dim='time').compute()
-    # Define the site location based on the filename
-    SONDE_SITE = 'M1'
-
-    #ds = match_datasets_act(ds, ds_sonde, sonde_site, DataSet=True, discard=discard_var['Sonde'])
-
-    #-----------------------------------------------
-    # Define Meta Data Standards for Matched Dataset
-    #-----------------------------------------------
-    # Call the Data Object Definitions for this datastream. 
-    # Will create an xarray dataset which will contain the necessary meta data and variables. 
-    #mdims = {"time": ds['time'].data.shape[0], "height": 70, "site": 8, "particle_size": 32, "raw_fall_velocity": 32}
-    #out_ds = act.io.create_obj_from_arm_dod('xprecipradarradclss.c2', mdims, version='1.0')
-
-    # Transform the matched dataset for consistent dimensions
-    #ds = ds.transpose('time', 'height', 'site', 'particle_size', 'raw_fall_velocity')
-
-    # Output Dataset has correct data attributes, supplied by the DOD. 
-    # Update the output dataset variable values with the matched dataset. 
-    #for var in out_ds.variables:
-    #    if var not in out_ds.dims:
-            # check to see if variable is within the matched dataset
-            # note: it may not be if file is missing.
-     #       if var in ds.variables:
-    #            out_ds[var].data = ds[var].data
-
-    # Update the coordinates with the matched dataset values
-    #out_ds = out_ds.assign_coords(time = ds['time'].data, 
-    #                              height = ds['height'].data, 
-    #                              site = ds['site'].data, 
-    #                              particle_size = ds['particle_size'].data,
-    #                              raw_fall_velocity = ds['raw_fall_velocity'].data)
-
-    #------------------
-    # Save the Dataset
-    #------------------
-    # define a filename
-    nout = 'xprecipradarradclss.c2.' + NDATE + '.000000.nc'
-    print('output: ', nout)
-    #out_ds.to_netcdf('xprecipradarradclss.c2.' + DATE.replace('-', '') + '.000000.nc')
\ No newline at end of file
+        cluster = LocalCluster(n_workers=args.workers, processes=True, threads_per_worker=1)
+        with Client(cluster) as c, sail_telemetry.performance_report(args.performance_report):
+            # Radar batches of every day go to the cluster first; each day task
+            # starts as soon as its own batches are done
+            days = []
+            for date in dates:
+                files = radar_files(date)
+                batches = [files[i:i + RADAR_BATCH_SIZE] for i in range(0, len(files), RADAR_BATCH_SIZE)]
+                columns = c.map(extract_batch, batches, key=['extract-%s-%d' % (date, i) for i in range(len(batches))])
+                days.append(c.submit(radclss_day, date, columns, args.output_dir, key='radclss-%s' % date))
+            for future in as_completed(days):
+                if future.status == 'error':
+                    print('FAILURE', future.key, future.exception())
+        print("processing finished: ", time.strftime("%H:%M:%S"))
+
+    if args.zarr:
+        month = args.input_month.strip('/')
+        store = sail_output.combine_month(glob.glob(os.path.join(args.output_dir, DATASTREAM + '.' + month + '*.nc')),
+                                          os.path.join(args.output_dir, DATASTREAM + '.' + month + '.zarr'),
+                                          chunks=sail_output.OUTPUT_CHUNKS[DATASTREAM])
+        print("wrote", store)
+
+    if run is not None:
+        sail_telemetry.print_summary(sail_telemetry.summarize(sail_telemetry.read_records(args.telemetry, run)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Create the daily RadCLss files for a month of SAIL CMAC2.0 data")
+
+    parser.add_argument("input_month",
+                        type=str,
+                        help="SAIL CMAC2.0 data month to process, YYYYMM"
+    )
+    parser.add_argument("output_dir",
+                        type=str,
+                        help="Directory to hold the RadCLss dataset"
+    )
+    parser.add_argument("--day",
+                        default=None,
+                        dest='day',
+                        type=int,
+                        help="Only process this day of the month"
+    )
+    parser.add_argument("--workers",
+                        default=16,
+                        dest='workers',
+                        type=int,
+                        help="Number of Dask worker processes"
+    )
+    parser.add_argument("--serial",
+                        default=False,
+                        dest='serial',
+                        action='store_true',
+                        help="Process in serial, without a Dask cluster"
+    )
+    parser.add_argument("--zarr",
+                        default=False,
+                        dest='zarr',
+                        action='store_true',
+                        help="Also combine the month's daily files into one Zarr store"
+    )
+    parser.add_argument("--telemetry",
+                        default=None,
+                        dest='telemetry',
+                        type=str,
+                        help="Append per-file and per-day stage timings, memory and I/O to this JSON lines file"
+    )
+    parser.add_argument("--performance-report",
+                        default=None,
+                        dest='performance_report',
+                        type=str,
+                        help="Write a Dask performance report of the run to this HTML file"
+    )
+    args = parser.parse_args()
+
+    main(args)
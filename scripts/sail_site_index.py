@@ -0,0 +1,398 @@
+"""
+Time series of gridded SAIL X-Band products at the SAIL/SPLASH sites
+
+The point placemarks of data/site-locations/*.kml are resolved once per grid
+to their nearest (y, x) grid point. As each gridded volume (e.g. a SQUIRE
+file) is produced, its values at those points are sampled and stored in a
+small SQLite side-car database, so the time series of a month at every site is
+read with one indexed query instead of opening every file. Sites falling in
+the same grid cell share their samples. An index may hold several grids (e.g.
+products on different domains); their volumes are kept apart and a query reads
+one grid at a time.
+
+Only one process writes to the database: the workers return their samples and
+the process scheduling the work stores them, as with the SQUIRE manifest.
+
+Usage:
+
+    sites = sail_site_index.read_kml_sites()
+    sample = sail_site_index.sample_file('....gridded.nc', sites)
+    conn = sail_site_index.open_index('squire_sites.sqlite')
+    sail_site_index.store_sample(conn, sample)
+    ds = sail_site_index.query(conn, sites=['DOE AMF'], start='2022-03-14', end='2022-03-15')
+"""
+
+import argparse
+import glob
+import hashlib
+import sqlite3
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Directory holding the KML files of the site locations
+SITE_LOCATIONS_DIR = Path(__file__).resolve().parents[1] / "data" / "site-locations"
+
+KML_NAMESPACE = {'kml': 'http://www.opengis.net/kml/2.2'}
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111195.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    site_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    source TEXT,
+    latitude REAL,
+    longitude REAL
+);
+CREATE TABLE IF NOT EXISTS points (
+    point_id INTEGER PRIMARY KEY,
+    grid TEXT,
+    y INTEGER,
+    x INTEGER,
+    UNIQUE (grid, y, x)
+);
+CREATE TABLE IF NOT EXISTS site_points (
+    site_id INTEGER,
+    grid TEXT,
+    point_id INTEGER,
+    distance REAL,
+    PRIMARY KEY (site_id, grid)
+);
+CREATE TABLE IF NOT EXISTS fields (
+    field_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS volumes (
+    time INTEGER,
+    grid TEXT,
+    path TEXT,
+    PRIMARY KEY (time, grid)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    point_id INTEGER,
+    field_id INTEGER,
+    time INTEGER,
+    value REAL,
+    PRIMARY KEY (point_id, field_id, time)
+) WITHOUT ROWID;
+"""
+
+# Grid points of each site, already resolved in this process, keyed by grid fingerprint
+_resolved = {}
+
+
+def read_kml_sites(paths=None):
+    """
+    Read the point placemarks of KML files as sites
+
+    Every KML file of data/site-locations is read by default. Placemarks
+    without a point (areas, lines) are skipped, as are repeats of a site with
+    the same name and location; other repeated names get a ' #2', ' #3', ...
+    suffix so site names are unique.
+
+    Returns
+    -------
+    sites : list
+        Dictionaries with the name, source (KML file stem), latitude and
+        longitude of each site.
+    """
+    paths = sorted(glob.glob(str(SITE_LOCATIONS_DIR / '*.kml'))) if paths is None else paths
+    sites = []
+    seen = set()
+    names = {}
+    for path in paths:
+        root = ET.parse(path).getroot()
+        for placemark in root.iter(f"{{{KML_NAMESPACE['kml']}}}Placemark"):
+            coordinates = placemark.find('.//kml:Point/kml:coordinates', KML_NAMESPACE)
+            name = placemark.findtext('kml:name', default='', namespaces=KML_NAMESPACE).strip()
+            if coordinates is None or not name:
+                continue
+            lon, lat = (float(value) for value in coordinates.text.strip().split(',')[:2])
+            if (name, round(lat, 6), round(lon, 6)) in seen:
+                continue
+            seen.add((name, round(lat, 6), round(lon, 6)))
+            names[name] = names.get(name, 0) + 1
+            sites.append({'name': name if names[name] == 1 else f"{name} #{names[name]}",
+                          'source': Path(path).stem,
+                          'latitude': lat,
+                          'longitude': lon})
+    return sites
+
+
+def grid_fingerprint(ds):
+    """
+    Create a key describing the horizontal grid of a gridded dataset
+    """
+    lat = np.asarray(ds['lat'].values)
+    lon = np.asarray(ds['lon'].values)
+    key = [lat.shape,
+           np.round(lat[[0, -1], [0, -1]], 5).tolist(),
+           np.round(lon[[0, -1], [0, -1]], 5).tolist()]
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def resolve_sites(ds, sites):
+    """
+    Find the nearest grid point of each site
+
+    Sites further from their nearest grid point than the grid spacing are
+    outside the grid and get a y and x of -1.
+
+    Returns
+    -------
+    y, x : numpy.ndarray
+        Grid indices of each site.
+    distance : numpy.ndarray
+        Distance from each site to its grid point [m].
+    """
+    lat = np.asarray(ds['lat'].values, dtype='float64')
+    lon = np.asarray(ds['lon'].values, dtype='float64')
+    spacing = float(np.abs(np.diff(ds['x'].values[:2]))[0])
+
+    site_lat = np.array([site['latitude'] for site in sites])
+    site_lon = np.array([site['longitude'] for site in sites])
+    dy = (lat.ravel()[np.newaxis] - site_lat[:, np.newaxis]) * METERS_PER_DEGREE
+    dx = ((lon.ravel()[np.newaxis] - site_lon[:, np.newaxis]) * METERS_PER_DEGREE *
+          np.cos(np.deg2rad(site_lat[:, np.newaxis])))
+    squared = dx ** 2 + dy ** 2
+    nearest = np.argmin(squared, axis=1)
+    distance = np.sqrt(squared[np.arange(len(sites)), nearest])
+
+    y, x = np.unravel_index(nearest, lat.shape)
+    outside = distance > spacing
+    return np.where(outside, -1, y), np.where(outside, -1, x), distance
+
+
+def sample_dataset(ds, sites, fields=None, path=None):
+    """
+    Sample a gridded volume at the grid points of the sites
+
+    The sites are resolved once per grid and process. Every (time, y, x)
+    variable is sampled by default.
+
+    Returns
+    -------
+    sample : dict
+        Volume time [s since 1970], grid fingerprint, the sites and their grid
+        points, and the values of each field at the unique points inside the grid.
+    """
+    grid = grid_fingerprint(ds)
+    key = (grid, tuple((site['name'], site['latitude'], site['longitude']) for site in sites))
+    if key not in _resolved:
+        _resolved[key] = resolve_sites(ds, sites)
+    y, x, distance = _resolved[key]
+
+    if fields is None:
+        fields = [name for name, variable in ds.data_vars.items() if variable.dims == ('time', 'y', 'x')]
+    points = sorted({(int(j), int(i)) for j, i in zip(y, x) if j >= 0})
+    point_y = np.array([point[0] for point in points], dtype=int)
+    point_x = np.array([point[1] for point in points], dtype=int)
+    values = {field: np.asarray(ds[field].values[0][point_y, point_x], dtype='float64')
+              for field in fields}
+
+    return {'time': int(np.datetime64(ds['time'].values[0], 's').astype('int64')),
+            'grid': grid,
+            'path': path,
+            'sites': sites,
+            'y': y,
+            'x': x,
+            'distance': distance,
+            'points': points,
+            'values': values}
+
+
+def sample_file(path, sites, fields=None):
+    """
+    Sample a gridded file (e.g. a SQUIRE output) at the grid points of the sites
+    """
+    with xr.open_dataset(path) as ds:
+        return sample_dataset(ds, sites, fields, path=str(path))
+
+
+def open_index(path):
+    """
+    Open (creating if needed) the site index database
+    """
+    conn = sqlite3.connect(str(path), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    conn.commit()
+    return conn
+
+
+def store_sample(conn, sample):
+    """
+    Store the values of a sampled volume, replacing any earlier sample of the same time and grid
+    """
+    conn.executemany("INSERT OR IGNORE INTO sites (name, source, latitude, longitude) "
+                     "VALUES (:name, :source, :latitude, :longitude)", sample['sites'])
+    site_ids = dict(conn.execute("SELECT name, site_id FROM sites"))
+    site_ids = [site_ids[site['name']] for site in sample['sites']]
+
+    grid = sample['grid']
+    conn.executemany("INSERT OR IGNORE INTO points (grid, y, x) VALUES (?, ?, ?)",
+                     [(grid, y, x) for y, x in sample['points']])
+    point_ids = dict(((y, x), point_id) for point_id, y, x in
+                     conn.execute("SELECT point_id, y, x FROM points WHERE grid = ?", (grid,)))
+    conn.executemany("INSERT OR REPLACE INTO site_points VALUES (?, ?, ?, ?)",
+                     [(site_id, grid, point_ids[(int(y), int(x))], float(distance))
+                      for site_id, y, x, distance in zip(site_ids, sample['y'], sample['x'], sample['distance'])
+                      if y >= 0])
+
+    conn.executemany("INSERT OR IGNORE INTO fields (name) VALUES (?)",
+                     [(field,) for field in sample['values']])
+    field_ids = dict(conn.execute("SELECT name, field_id FROM fields"))
+    field_ids = [field_ids[field] for field in sample['values']]
+    time = sample['time']
+    conn.execute("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?)", (time, grid, sample['path']))
+
+    # Missing values are not stored; they come back as NaN from query
+    rows = [(point_ids[point], field_id, time, float(value))
+            for field_id, values in zip(field_ids, sample['values'].values())
+            for point, value in zip(sample['points'], values)
+            if np.isfinite(value)]
+    conn.execute("DELETE FROM samples WHERE time = ? AND point_id IN "
+                 "(SELECT point_id FROM points WHERE grid = ?)", (time, grid))
+    conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+
+
+def _seconds(time):
+    """
+    Seconds since 1970 of a time (string, datetime or datetime64)
+    """
+    return int(np.datetime64(time, 's').astype('int64'))
+
+
+def query(conn, sites=None, fields=None, start=None, end=None, grid=None):
+    """
+    Read the time series of the sites on one grid from the index
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Site index (from open_index).
+    sites : list, optional
+        Site names; all sites by default.
+    fields : list, optional
+        Field names; all fields by default.
+    start, end : str or datetime, optional
+        Time range (inclusive).
+    grid : str, optional
+        Grid fingerprint (see grid_fingerprint); required when the index
+        holds more than one grid.
+
+    Returns
+    -------
+    ds : xarray.Dataset
+        One (time, site) variable per field, with NaN where the volume has no
+        valid value, and the site latitude, longitude and distance to its
+        grid point as coordinates.
+    """
+    if grid is None:
+        grids = [row[0] for row in conn.execute("SELECT DISTINCT grid FROM volumes ORDER BY grid")]
+        if len(grids) > 1:
+            raise ValueError(f"The index holds {len(grids)} grids ({', '.join(grids)}); pass one as grid")
+        grid = grids[0] if grids else None
+
+    start = _seconds(start) if start is not None else np.iinfo('int64').min
+    end = _seconds(end) if end is not None else np.iinfo('int64').max
+    times = [row[0] for row in conn.execute(
+        "SELECT time FROM volumes WHERE grid = ? AND time BETWEEN ? AND ? ORDER BY time", (grid, start, end))]
+
+    site_filter = ''
+    field_filter = ''
+    params = [grid, start, end]
+    if sites is not None:
+        site_filter = f" AND s.name IN ({', '.join('?' * len(sites))})"
+        params += list(sites)
+    if fields is not None:
+        field_filter = f" AND f.name IN ({', '.join('?' * len(fields))})"
+        params += list(fields)
+
+    if (sites is not None and len(sites) == 0) or (fields is not None and len(fields) == 0):
+        # Nothing to select; skip the query rather than build an empty IN ()
+        samples = pd.DataFrame({'site': [], 'time': [], 'field': [], 'value': []})
+    else:
+        samples = pd.read_sql_query(
+            "SELECT s.name AS site, v.time AS time, f.name AS field, v.value AS value "
+            "FROM samples v "
+            "JOIN fields f ON f.field_id = v.field_id "
+            "JOIN site_points sp ON sp.point_id = v.point_id AND sp.grid = ? "
+            "JOIN sites s ON s.site_id = sp.site_id "
+            f"WHERE v.time BETWEEN ? AND ?{site_filter}{field_filter}",
+            conn, params=params)
+    site_rows = pd.read_sql_query(
+        "SELECT s.name AS site, s.latitude, s.longitude, sp.distance AS distance "
+        "FROM sites s LEFT JOIN site_points sp ON sp.site_id = s.site_id AND sp.grid = ? "
+        "ORDER BY s.site_id", conn, params=[grid]).set_index('site')
+    if sites is not None:
+        site_rows = site_rows.reindex(list(sites))
+    if fields is None:
+        fields = [row[0] for row in conn.execute("SELECT name FROM fields ORDER BY field_id")]
+
+    values = samples.pivot_table(index=['time', 'site'], columns='field', values='value', aggfunc='first')
+    index = pd.MultiIndex.from_product([times, site_rows.index], names=['time', 'site'])
+    values = values.reindex(index=index, columns=list(fields))
+
+    ds = xr.Dataset({field: (('time', 'site'), values[field].values.reshape(len(times), len(site_rows)))
+                     for field in fields},
+                    coords={'time': np.array(times, dtype='datetime64[s]').astype('datetime64[ns]'),
+                            'site': site_rows.index.values,
+                            'latitude': ('site', site_rows['latitude'].values),
+                            'longitude': ('site', site_rows['longitude'].values),
+                            'distance': ('site', site_rows['distance'].values.astype('float64'),
+                                         dict(long_name='Distance from the site to its grid point',
+                                              units='m'))})
+    return ds
+
+
+def index_files(conn, paths, sites=None, fields=None):
+    """
+    Sample existing gridded files into the index, skipping volumes already stored
+    """
+    sites = read_kml_sites() if sites is None else sites
+    stored = {row[0] for row in conn.execute("SELECT path FROM volumes")}
+    count = 0
+    for path in sorted(paths):
+        if str(path) in stored:
+            continue
+        store_sample(conn, sample_file(path, sites, fields))
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Index the values of gridded files at the SAIL/SPLASH sites")
+
+    parser.add_argument("--index",
+                        default="squire_sites.sqlite",
+                        dest='index',
+                        type=str,
+                        help="Site index database"
+    )
+    parser.add_argument("--files",
+                        default="data/*.gridded.nc",
+                        dest='files',
+                        type=str,
+                        help="Glob of the gridded files to index"
+    )
+    parser.add_argument("--kml",
+                        default=None,
+                        dest='kml',
+                        nargs='+',
+                        type=str,
+                        help="KML files of the sites (default: data/site-locations/*.kml)"
+    )
+    args = parser.parse_args()
+
+    conn = open_index(args.index)
+    count = index_files(conn, glob.glob(args.files), read_kml_sites(args.kml))
+    print(f"{count} files added to {args.index}")
+    conn.close()
@@ -0,0 +1,395 @@
+"""
+Per-stage telemetry of the SAIL X-Band processing scripts
+
+Each input file (a sweep volume, a CMAC file, a day) is processed inside a
+file_record; the stages within it (reading, gridding, conforming, writing, ...)
+are timed with the stage context manager or the timed decorator, from any
+depth of the call stack. Every stage records its wall time, peak RSS and the
+bytes read and written, and the record of each file is appended as one JSON
+line to the telemetry log. The RSS is sampled by a single thread per file,
+whose samples all of its stages track their peaks from. At the end of a run
+the log is aggregated into percentiles per stage.
+
+Telemetry is off unless configure() is called, which sets the log path in the
+environment so the Dask workers started afterwards log to the same file.
+Stage times are also passed to Dask's fine performance metrics, so they show
+up in the dashboard and in performance reports.
+
+Usage:
+
+    run = sail_telemetry.configure('telemetry.jsonl')
+    with sail_telemetry.file_record(path, 'squire'):
+        with sail_telemetry.stage('read'):
+            radar = pyart.io.read(path)
+    sail_telemetry.print_summary(sail_telemetry.summarize(
+        sail_telemetry.read_records('telemetry.jsonl', run)))
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+import numpy as np
+import psutil
+from distributed import performance_report as dask_performance_report
+from distributed.metrics import context_meter
+
+# Environment variables holding the telemetry log and run id, inherited by the workers
+TELEMETRY_LOG_ENV = 'SAIL_TELEMETRY_LOG'
+TELEMETRY_RUN_ENV = 'SAIL_TELEMETRY_RUN'
+
+# Interval between samples of the resident memory
+RSS_SAMPLE_INTERVAL = 0.01  # seconds
+
+# Percentiles of the stage times reported at the end of a run
+PERCENTILES = (50, 90, 99)
+
+# Record of the file being processed in the current thread or task
+_current_record = contextvars.ContextVar('sail_telemetry_record', default=None)
+
+# Resident memory sampler of that file, shared by all its stages
+_current_sampler = contextvars.ContextVar('sail_telemetry_sampler', default=None)
+
+# Locks of the samplers running in this process, held while it forks so no
+# sampler thread is in the middle of a sample
+_sampler_locks = set()
+_sampler_locks_lock = threading.Lock()
+_held_sampler_locks = []
+
+
+def configure(log_path, run=None):
+    """
+    Turn telemetry on for this process and the workers it starts, returning the run id
+    """
+    run = run or time.strftime('%Y%m%dT%H%M%S') + '-%d' % os.getpid()
+    os.environ[TELEMETRY_LOG_ENV] = os.path.abspath(log_path)
+    os.environ[TELEMETRY_RUN_ENV] = run
+    return run
+
+
+def log_path():
+    """
+    Path of the telemetry log, or None when telemetry is off
+    """
+    return os.environ.get(TELEMETRY_LOG_ENV)
+
+
+def io_bytes(process):
+    """
+    Bytes read and written by the process so far, or (None, None) where not reported
+
+    The character counts include reads served from the page cache.
+    """
+    if not hasattr(process, 'io_counters'):
+        return None, None
+    counters = process.io_counters()
+    return (getattr(counters, 'read_chars', counters.read_bytes),
+            getattr(counters, 'write_chars', counters.write_bytes))
+
+
+@contextlib.contextmanager
+def rss_sampler(interval=RSS_SAMPLE_INTERVAL):
+    """
+    Sample the resident memory from one background thread for the enclosed block
+
+    Yields the sampler, from which every measure() within the block tracks
+    its peak, instead of starting a thread of its own.
+    """
+    process = psutil.Process()
+    sampler = {'process': process, 'peaks': {}, 'lock': threading.Lock()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            with sampler['lock']:
+                rss = process.memory_info().rss
+                for peak in sampler['peaks'].values():
+                    peak[0] = max(peak[0], rss)
+
+    with _sampler_locks_lock:
+        _sampler_locks.add(sampler['lock'])
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield sampler
+    finally:
+        done.set()
+        thread.join()
+        with _sampler_locks_lock:
+            _sampler_locks.discard(sampler['lock'])
+
+
+def _hold_samplers():
+    """
+    Wait for the running samplers to finish their sample and keep them from starting another, before a fork
+    """
+    _sampler_locks_lock.acquire()
+    for lock in _sampler_locks:
+        lock.acquire()
+        _held_sampler_locks.append(lock)
+
+
+def _release_samplers():
+    """
+    Let the samplers run again after a fork, in the parent and the child
+    """
+    while _held_sampler_locks:
+        _held_sampler_locks.pop().release()
+    _sampler_locks_lock.release()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_hold_samplers, after_in_parent=_release_samplers,
+                        after_in_child=_release_samplers)
+
+
+def add_worker_rss(rss):
+    """
+    Count the peak RSS of worker processes in the peak of the stages in progress
+
+    The sampler only sees this process. A stage running its work in a process
+    pool passes the peak RSS its workers report, which is added to the current
+    RSS of this process. Does nothing outside a file_record.
+    """
+    sampler = _current_sampler.get()
+    if sampler is None:
+        return
+    with sampler['lock']:
+        rss += sampler['process'].memory_info().rss
+        for peak in sampler['peaks'].values():
+            peak[0] = max(peak[0], rss)
+
+
+@contextlib.contextmanager
+def measure(name, results=None, interval=RSS_SAMPLE_INTERVAL, sampler=None):
+    """
+    Measure the wall time, peak RSS and I/O bytes of the enclosed block
+
+    The peak is tracked by sampler, or by a sampler started for the block if
+    None. Yields the measurement dictionary, which is filled in (and appended
+    to results, if given) when the block exits.
+    """
+    with contextlib.ExitStack() as stack:
+        if sampler is None:
+            sampler = stack.enter_context(rss_sampler(interval))
+        process = sampler['process']
+        measurement = {'stage': name}
+        peak = [process.memory_info().rss]
+        with sampler['lock']:
+            sampler['peaks'][id(peak)] = peak
+        read_start, written_start = io_bytes(process)
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            wall = time.perf_counter() - start
+            with sampler['lock']:
+                del sampler['peaks'][id(peak)]
+            read_end, written_end = io_bytes(process)
+            measurement.update(wall=wall,
+                               peak_rss=max(peak[0], process.memory_info().rss),
+                               bytes_read=None if read_start is None else read_end - read_start,
+                               bytes_written=None if written_start is None else written_end - written_start)
+            if results is not None:
+                results.append(measurement)
+
+
+@contextlib.contextmanager
+def file_record(path, kind, **fields):
+    """
+    Collect the stages of one input file and log them as a JSON line on exit
+
+    An exception raised inside the block is recorded as a failure and
+    re-raised. Yields the record, or None when telemetry is off.
+    """
+    if log_path() is None:
+        yield None
+        return
+
+    record = {'run': os.environ.get(TELEMETRY_RUN_ENV),
+              'kind': kind,
+              'file': str(path),
+              'host': socket.gethostname(),
+              'pid': os.getpid(),
+              'status': 'done',
+              'error': None,
+              'started': time.time(),
+              'stages': {}}
+    record.update(fields)
+    token = _current_record.set(record)
+    try:
+        with rss_sampler() as sampler, measure('total', sampler=sampler) as total:
+            sampler_token = _current_sampler.set(sampler)
+            try:
+                yield record
+            finally:
+                _current_sampler.reset(sampler_token)
+    except BaseException as error:
+        record_error(error, record)
+        raise
+    finally:
+        _current_record.reset(token)
+        record['finished'] = time.time()
+        record.update({key: total.get(key) for key in ('wall', 'peak_rss', 'bytes_read', 'bytes_written')})
+        emit(record)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a stage of the file being processed; does nothing outside a file_record
+
+    A stage entered several times for the same file (e.g. reading each sweep)
+    is accumulated.
+    """
+    record = _current_record.get()
+    if record is None:
+        yield
+        return
+
+    with measure(name, sampler=_current_sampler.get()) as measurement:
+        yield
+    context_meter.digest_metric(name, measurement['wall'], 'seconds')
+
+    stages = record['stages']
+    if name not in stages:
+        stages[name] = {key: measurement[key] for key in ('wall', 'peak_rss', 'bytes_read', 'bytes_written')}
+        stages[name]['calls'] = 1
+        return
+    previous = stages[name]
+    previous['wall'] += measurement['wall']
+    previous['peak_rss'] = max(previous['peak_rss'], measurement['peak_rss'])
+    for key in ('bytes_read', 'bytes_written'):
+        if previous[key] is not None and measurement[key] is not None:
+            previous[key] += measurement[key]
+    previous['calls'] += 1
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_error(error, record=None):
+    """
+    Mark the current file as failed, keeping the error and its traceback
+
+    Use this where a failure is handled rather than raised, so it still shows
+    up in the log.
+    """
+    record = record if record is not None else _current_record.get()
+    if record is None:
+        return
+    record['status'] = 'failed'
+    record['error'] = f"{type(error).__name__}: {error}"
+    record['traceback'] = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+
+
+def emit(record, path=None):
+    """
+    Append a record to the telemetry log as one JSON line
+
+    Each record is a single write to a file opened for appending, so workers
+    can share the log.
+    """
+    path = path or log_path()
+    if path is None:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with open(path, 'a') as f:
+        f.write(line)
+
+
+def read_records(path, run=None):
+    """
+    Read the records of a telemetry log, only those of one run if given
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if run is None or record.get('run') == run:
+                records.append(record)
+    return records
+
+
+def summarize(records, percentiles=PERCENTILES):
+    """
+    Aggregate the records of a run into percentiles of each stage
+
+    Returns
+    -------
+    summary : dict
+        For each (kind, stage), and the 'total' of each kind, the number of
+        files, the wall time percentiles [s], the largest peak RSS [bytes] and
+        the total bytes read and written; plus the number of failed files of
+        each kind under 'failed'.
+    """
+    grouped = {}
+    failed = {}
+    for record in records:
+        kind = record['kind']
+        failed[kind] = failed.get(kind, 0) + (record['status'] != 'done')
+        stages = dict(record['stages'], total=record)
+        for name, measurement in stages.items():
+            if measurement.get('wall') is not None:
+                grouped.setdefault((kind, name), []).append(measurement)
+
+    summary = {'stages': {}, 'failed': failed}
+    for (kind, name), measurements in grouped.items():
+        walls = np.array([measurement['wall'] for measurement in measurements])
+        stats = {'files': len(measurements),
+                 'peak_rss': max(measurement['peak_rss'] for measurement in measurements)}
+        for percentile in percentiles:
+            stats[f"p{percentile}"] = float(np.percentile(walls, percentile))
+        stats['max'] = float(walls.max())
+        for key in ('bytes_read', 'bytes_written'):
+            values = [measurement[key] for measurement in measurements if measurement[key] is not None]
+            stats[key] = int(sum(values)) if values else None
+        summary['stages'][f"{kind}.{name}"] = stats
+    return summary
+
+
+def print_summary(summary):
+    """
+    Print the per-stage percentiles of a run
+    """
+    megabyte = 1024. * 1024.
+    stages = summary['stages']
+    if not stages:
+        print('no telemetry recorded')
+        return
+    percentiles = [key for key in next(iter(stages.values())) if key.startswith('p') and key != 'peak_rss']
+    print(f"{'stage':<28}{'files':>7}" + ''.join(f"{key + ' [s]':>10}" for key in percentiles + ['max']) +
+          f"{'peak RSS [MB]':>15}{'read [MB]':>11}{'written [MB]':>14}")
+    for name, stats in sorted(stages.items()):
+        read = '-' if stats['bytes_read'] is None else '%.1f' % (stats['bytes_read'] / megabyte)
+        written = '-' if stats['bytes_written'] is None else '%.1f' % (stats['bytes_written'] / megabyte)
+        print(f"{name:<28}{stats['files']:>7}" + ''.join(f"{stats[key]:>10.3f}" for key in percentiles + ['max']) +
+              f"{stats['peak_rss'] / megabyte:>15.1f}{read:>11}{written:>14}")
+    for kind, count in summary['failed'].items():
+        if count:
+            print(f"{kind}: {count} failed files")
+
+
+def performance_report(path=None):
+    """
+    Dask performance report context manager writing to path, or a no-op without a path
+    """
+    if path is None:
+        return contextlib.nullcontext()
+    return dask_performance_report(filename=path)
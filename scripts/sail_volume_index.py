@@ -0,0 +1,134 @@
+"""
+Index of the CSU X-Band PPI sweep files, grouped into complete volumes
+
+Sweep files are named like
+    gucxprecipradarS2.00.20220301.004845.raw.csu.sail-20220301-004845_278032_22_1_PPI.nc
+where the sweep time, scan number and tilt (the number before _PPI) are parsed
+once and stored in a SQLite index. Later runs, for this or any other month, only
+parse files that are not in the index yet.
+"""
+
+import datetime
+import os
+import re
+import sqlite3
+
+# Sweep filename pattern: ...sail-YYYYMMDD-HHMMSS_<scan>_<task>_<tilt>_PPI.nc
+SWEEP_PATTERN = re.compile(r'sail-(?P<date>\d{8})-(?P<time>\d{6})_(?P<scan>\d+)_(?P<task>\d+)_(?P<tilt>\d+)_PPI\.nc$')
+
+# Tilts making up one volume, in scan order
+VOLUME_TILTS = (1, 2, 4, 6, 8, 10, 12, 15)
+
+# Longest time between the first and last sweep of a volume
+MAX_VOLUME_SECONDS = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sweeps (
+    path TEXT PRIMARY KEY,
+    time TEXT,
+    scan INTEGER,
+    tilt INTEGER
+)
+"""
+
+
+def parse_sweep_filename(path):
+    """
+    Return the time (YYYYMMDDHHMMSS), scan number and tilt of a sweep file, or None
+    """
+    match = SWEEP_PATTERN.search(os.path.basename(path))
+    if match is None:
+        return None
+    return {'path': path,
+            'time': match['date'] + match['time'],
+            'scan': int(match['scan']),
+            'tilt': int(match['tilt'])}
+
+
+def open_index(path):
+    """
+    Open (creating if needed) the sweep index database
+    """
+    conn = sqlite3.connect(str(path), timeout=60)
+    conn.execute(SCHEMA)
+    conn.commit()
+    return conn
+
+
+def update_index(conn, paths):
+    """
+    Add the sweep files that are not in the index yet, returning how many were added
+    """
+    known = {row[0] for row in conn.execute("SELECT path FROM sweeps")}
+    new_sweeps = [sweep for sweep in map(parse_sweep_filename, set(paths) - known)
+                  if sweep is not None]
+    conn.executemany("INSERT INTO sweeps VALUES (:path, :time, :scan, :tilt)", new_sweeps)
+    conn.commit()
+    return len(new_sweeps)
+
+
+def _seconds(timestamp):
+    """
+    Seconds since the epoch for a YYYYMMDDHHMMSS string
+    """
+    return (datetime.datetime.strptime(timestamp, '%Y%m%d%H%M%S') -
+            datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def build_volumes(conn, prefix='', tilts=VOLUME_TILTS, max_seconds=MAX_VOLUME_SECONDS):
+    """
+    Group the indexed sweeps into volumes, in time order
+
+    A volume starts at a sweep of the first tilt and must be followed by the
+    remaining tilts in order, within max_seconds. Sweeps whose time starts with
+    prefix (e.g. '202203') are considered.
+
+    Returns
+    -------
+    volumes : list
+        Lists of sweep paths, one per complete volume.
+    incomplete : list
+        (sweep paths, reason) pairs for every volume that could not be completed.
+    """
+    rows = conn.execute("SELECT path, time, tilt FROM sweeps WHERE time LIKE ? ORDER BY time, scan",
+                        (prefix + '%',))
+
+    volumes = []
+    incomplete = []
+    current = []
+    broken = False
+    for path, timestamp, tilt in rows:
+        expected = tilts[len(current)] if current else tilts[0]
+        if tilt == expected and current:
+            current.append((path, timestamp))
+        elif tilt == tilts[0]:
+            if current:
+                incomplete.append(([p for p, _ in current],
+                                   f"missing tilt {tilts[len(current)]}"))
+            current = [(path, timestamp)]
+            broken = False
+        else:
+            if current:
+                incomplete.append(([p for p, _ in current] + [path],
+                                   f"expected tilt {expected}, found {tilt}"))
+            elif broken:
+                # Remaining sweeps of a volume that is already incomplete
+                incomplete[-1][0].append(path)
+            else:
+                incomplete.append(([path], f"tilt {tilt} without a base scan"))
+            broken = True
+            current = []
+            continue
+
+        if len(current) == len(tilts):
+            duration = _seconds(current[-1][1]) - _seconds(current[0][1])
+            if duration > max_seconds:
+                incomplete.append(([p for p, _ in current], f"volume spans {duration:.0f} s"))
+            else:
+                volumes.append([p for p, _ in current])
+            current = []
+
+    if current:
+        incomplete.append(([p for p, _ in current], f"missing tilt {tilts[len(current)]}"))
+
+    return volumes, incomplete
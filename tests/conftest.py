@@ -0,0 +1,10 @@
+"""
+Put the script and VAP directories on the path, as they are run as plain scripts
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ['scripts', os.path.join('vap', 'gucxprecipradarsquire.c1')]:
+    sys.path.insert(0, os.path.join(ROOT, directory))
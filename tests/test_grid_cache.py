@@ -0,0 +1,82 @@
+import numpy as np
+import pyart
+from scipy.spatial import cKDTree
+
+import grid_cache
+
+GRID_SHAPE = (3, 21, 21)
+GRID_LIMITS = ((200., 1200.), (-2500., 2500.), (-2500., 2500.))
+ROI = 250.
+
+
+def make_radar(azimuth_offset=1.3):
+    radar = pyart.testing.make_empty_ppi_radar(40, 72, 3)
+    radar.range['data'] = (np.arange(40) * 125. + 60.).astype('float32')
+    radar.azimuth['data'][:] = np.tile(np.arange(72) * 5. + azimuth_offset, 3)
+    radar.elevation['data'][:] = np.repeat([1.5, 4.3, 9.1], 72)
+    radar.fixed_angle['data'][:] = [1.5, 4.3, 9.1]
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+    rng = np.random.default_rng(2)
+    reflectivity = rng.normal(20., 5., (radar.nrays, radar.ngates)).astype('float32')
+    radar.add_field('DBZ', {'data': np.ma.masked_array(reflectivity, rng.random(reflectivity.shape) < 0.1)})
+    return radar
+
+
+def assert_matches_pyart(radar, index_map):
+    """
+    Compare the cached gather with grid_from_radars(weighting_function='Nearest'), up to equidistant ties
+    """
+    expected = pyart.map.grid_from_radars(radar, grid_shape=GRID_SHAPE, grid_limits=GRID_LIMITS,
+                                          weighting_function='Nearest', constant_roi=ROI)
+    result = grid_cache.grid_from_index_map(radar, index_map, GRID_SHAPE, GRID_LIMITS)
+    expected = expected.fields['DBZ']['data']
+    result = result.fields['DBZ']['data']
+    np.testing.assert_array_equal(np.ma.getmaskarray(result), np.ma.getmaskarray(expected))
+
+    # a grid point may only take another gate when its two nearest gates are equally far
+    differ = np.abs(result - expected).filled(0.) > 0.
+    gate_points = np.column_stack([radar.gate_z['data'].ravel(), radar.gate_y['data'].ravel(),
+                                   radar.gate_x['data'].ravel()])
+    grid_points = np.column_stack([axis.ravel() for axis in
+                                   np.meshgrid(*grid_cache.grid_coordinates(GRID_SHAPE, GRID_LIMITS),
+                                               indexing='ij')])
+    distance, _ = cKDTree(gate_points).query(grid_points[differ.ravel()], k=2)
+    assert differ.sum() <= 0.01 * differ.size
+    assert (distance[:, 1] - distance[:, 0] < 1e-2).all()
+
+
+def test_index_map_matches_pyart_nearest():
+    radar = make_radar()
+    assert_matches_pyart(radar, grid_cache.build_index_map(radar, GRID_SHAPE, GRID_LIMITS, ROI))
+
+
+def test_index_map_is_cached_and_rebuilt(monkeypatch, tmp_path):
+    builds = []
+    build_index_map = grid_cache.build_index_map
+
+    def counted_build(*args, **kwargs):
+        builds.append(args)
+        return build_index_map(*args, **kwargs)
+
+    monkeypatch.setattr(grid_cache, 'build_index_map', counted_build)
+    monkeypatch.setattr(grid_cache, '_loaded_maps', {})
+    radar = make_radar()
+    index_map = grid_cache.get_index_map(radar, GRID_SHAPE, GRID_LIMITS, ROI, cache_dir=tmp_path)
+    grid_cache._loaded_maps.clear()
+    cached = grid_cache.get_index_map(make_radar(azimuth_offset=1.4), GRID_SHAPE, GRID_LIMITS, ROI,
+                                      cache_dir=tmp_path)
+    assert len(builds) == 1 and len(list(tmp_path.glob('grid_index_*.npz'))) == 1
+    np.testing.assert_array_equal(cached['index'], index_map['index'])
+
+    # the azimuths drift beyond the tolerance: same fingerprint, new map
+    drifted = make_radar(azimuth_offset=1.3 + 2 * grid_cache.ANGLE_TOLERANCE)
+    rebuilt = grid_cache.get_index_map(drifted, GRID_SHAPE, GRID_LIMITS, ROI, cache_dir=tmp_path)
+    assert len(builds) == 2 and len(list(tmp_path.glob('grid_index_*.npz'))) == 1
+    assert (rebuilt['index'] != index_map['index']).any()
+    assert_matches_pyart(drifted, rebuilt)
+
+    grid_cache._loaded_maps.clear()
+    reloaded = grid_cache.get_index_map(drifted, GRID_SHAPE, GRID_LIMITS, ROI, cache_dir=tmp_path)
+    assert len(builds) == 2
+    np.testing.assert_array_equal(reloaded['index'], rebuilt['index'])
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import lowest_level
+
+use_numba = [False, pytest.param(True, marks=pytest.mark.skipif(lowest_level.numba is None,
+                                                                 reason="numba is not installed"))]
+
+
+def make_reference():
+    reference = np.full((4, 2, 3), np.nan)
+    reference[0, 0, 0] = 1.
+    reference[2, 0, 1] = 2.
+    reference[3, 0, 2] = 3.
+    reference[1:, 1, 0] = 4.
+    # column (1, 1) is empty, and (1, 2) has a single value at the top
+    reference[3, 1, 2] = 5.
+    return reference
+
+
+@pytest.mark.parametrize('numba', use_numba)
+def test_first_valid_level(numba):
+    level_index, has_valid = lowest_level.first_valid_level(make_reference(), use_numba=numba)
+    np.testing.assert_array_equal(level_index, [[0, 2, 3], [1, 0, 3]])
+    np.testing.assert_array_equal(has_valid, [[True, True, True], [True, False, True]])
+
+
+@pytest.mark.parametrize('numba', use_numba)
+def test_first_valid_level_masked_and_boolean(numba):
+    reference = make_reference()
+    masked = np.ma.masked_array(np.nan_to_num(reference, nan=-1.), mask=np.isnan(reference))
+    expected = lowest_level.first_valid_level(reference, use_numba=numba)
+    for other in [masked, ~np.isnan(reference)]:
+        result = lowest_level.first_valid_level(other, use_numba=numba)
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+
+
+@pytest.mark.parametrize('numba', use_numba)
+def test_gather_lowest_level(numba):
+    reference = make_reference()
+    other = np.arange(reference.size, dtype='int16').reshape(reference.shape)
+    level_index, has_valid = lowest_level.first_valid_level(reference, use_numba=numba)
+    out = lowest_level.gather_lowest_level({'ref': reference, 'other': other}, level_index, has_valid,
+                                           use_numba=numba)
+    np.testing.assert_array_equal(out['ref'], [[1., 2., 3.], [4., np.nan, 5.]])
+    assert out['other'].dtype == np.float32
+    np.testing.assert_array_equal(out['other'], [[0., 13., 20.], [9., np.nan, 23.]])
+
+
+def test_numba_matches_numpy():
+    if lowest_level.numba is None:
+        pytest.skip("numba is not installed")
+    rng = np.random.default_rng(0)
+    reference = np.where(rng.random((17, 40, 50)) < 0.7, np.nan, rng.normal(size=(17, 40, 50)))
+    fields = {'ref': reference, 'other': rng.normal(size=reference.shape).astype('float32')}
+    heights = np.arange(17) * 500.
+    numpy_out = lowest_level.lowest_valid_level(fields, 'ref', heights=heights)
+    numba_out = lowest_level.lowest_valid_level(fields, 'ref', heights=heights, use_numba=True)
+    assert set(numpy_out) == {'ref', 'other', 'lowest_height'}
+    for name in numpy_out:
+        np.testing.assert_array_equal(numba_out[name], numpy_out[name])
+
+
+def test_lowest_height_fill():
+    out = lowest_level.lowest_valid_level({'ref': make_reference()}, 'ref', heights=[0., 100., 200., 300.],
+                                          fill_height=-1.)
+    np.testing.assert_array_equal(out['lowest_height'], [[0., 200., 300.], [100., -1., 300.]])
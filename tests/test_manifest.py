@@ -0,0 +1,71 @@
+import manifest
+
+
+def result(path, output_path, status, error=None):
+    return {'input_path': str(path), 'output_path': str(output_path), 'status': status,
+            'error': error, 'started': 0., 'finished': 1., 'duration': 1.}
+
+
+def test_pending_files(tmp_path):
+    conn = manifest.open_manifest(tmp_path / 'manifest.sqlite')
+    done, failed, new = (tmp_path / name for name in ['done.nc', 'failed.nc', 'new.nc'])
+    for path in [done, failed, new]:
+        path.write_bytes(b'radar')
+    output = tmp_path / 'done.gridded.nc'
+    output.write_bytes(b'grid')
+    files = [str(done), str(failed), str(new)]
+
+    manifest.record_result(conn, result(done, output, 'done'), manifest.file_signature(done))
+    assert manifest.record_result(conn, result(failed, '', 'failed', 'boom'),
+                                  manifest.file_signature(failed)) == 1
+    assert manifest.pending_files(conn, files, max_attempts=2) == [str(failed), str(new)]
+
+    # a second failure of the same input reaches max_attempts
+    assert manifest.record_result(conn, result(failed, '', 'failed', 'boom'),
+                                  manifest.file_signature(failed)) == 2
+    assert manifest.pending_files(conn, files, max_attempts=2) == [str(new)]
+    assert manifest.summarize(conn) == {'done': 1, 'failed': 1}
+
+
+def test_changed_input_or_missing_output_is_pending(tmp_path):
+    conn = manifest.open_manifest(tmp_path / 'manifest.sqlite')
+    path = tmp_path / 'volume.nc'
+    path.write_bytes(b'radar')
+    output = tmp_path / 'volume.gridded.nc'
+    output.write_bytes(b'grid')
+    manifest.record_result(conn, result(path, output, 'done'), manifest.file_signature(path))
+    assert manifest.pending_files(conn, [str(path)]) == []
+
+    output.unlink()
+    assert manifest.pending_files(conn, [str(path)]) == [str(path)]
+
+    # a changed input also resets the attempt count
+    output.write_bytes(b'grid')
+    path.write_bytes(b'new radar data')
+    assert manifest.pending_files(conn, [str(path)]) == [str(path)]
+    assert manifest.record_result(conn, result(path, output, 'failed', 'boom'),
+                                  manifest.file_signature(path)) == 1
+
+
+def test_only_failures_in_a_row_count(tmp_path):
+    conn = manifest.open_manifest(tmp_path / 'manifest.sqlite')
+    path = tmp_path / 'volume.nc'
+    path.write_bytes(b'radar')
+    output = tmp_path / 'volume.gridded.nc'
+    output.write_bytes(b'grid')
+    signature = manifest.file_signature(path)
+    assert manifest.record_result(conn, result(path, output, 'done'), signature) == 0
+
+    # the output is removed, and the reruns fail twice
+    output.unlink()
+    assert manifest.pending_files(conn, [str(path)], max_attempts=3) == [str(path)]
+    assert manifest.record_result(conn, result(path, '', 'failed', 'boom'), signature) == 1
+    assert manifest.record_result(conn, result(path, '', 'failed', 'boom'), signature) == 2
+    assert manifest.pending_files(conn, [str(path)], max_attempts=3) == [str(path)]
+
+    # a success in between starts the count again
+    assert manifest.record_result(conn, result(path, output, 'done'), signature) == 0
+    assert manifest.record_result(conn, result(path, '', 'failed', 'boom'), signature) == 1
+    assert manifest.record_result(conn, result(path, '', 'failed', 'boom'), signature) == 2
+    assert manifest.record_result(conn, result(path, '', 'failed', 'boom'), signature) == 3
+    assert manifest.pending_files(conn, [str(path)], max_attempts=3) == []
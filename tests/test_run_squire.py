@@ -0,0 +1,53 @@
+import numpy as np
+import pyart
+import pytest
+
+run_squire = pytest.importorskip('run_squire_march_2022')
+
+
+@pytest.fixture(scope='module')
+def cmac_file(tmp_path_factory):
+    """
+    A CMAC-like volume holding the SQUIRE fields, with gaps so columns start at different levels
+    """
+    radar = pyart.testing.make_empty_ppi_radar(100, 90, 4)
+    radar.range['data'] = (np.arange(100) * 250. + 125.).astype('float32')
+    radar.azimuth['data'][:] = np.tile(np.arange(90) * 4. + 1.3, 4)
+    radar.elevation['data'][:] = np.repeat([1., 3., 6., 10.], 90)
+    radar.fixed_angle['data'][:] = [1., 3., 6., 10.]
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+
+    rng = np.random.default_rng(3)
+    shape = (radar.nrays, radar.ngates)
+    gaps = rng.random(shape) < 0.3
+    # the lowest sweep is blocked over a sector
+    gaps[:45] |= True
+    for name in run_squire.SQUIRE_FIELDS:
+        data = rng.normal(20., 8., shape).astype('float32')
+        radar.add_field(name, {'data': np.ma.masked_array(data, gaps | (rng.random(shape) < 0.05)),
+                               'units': 'dBZ' if 'reflectivity' in name or name == 'DBZ' else '1',
+                               'long_name': name})
+    path = tmp_path_factory.mktemp('cmac') / 'gucxprecipradarcmacS2.c1.20220314.000000.nc'
+    pyart.io.write_cfradial(str(path), radar)
+    return str(path)
+
+
+def test_surface_only_matches_full_grid(cmac_file, tmp_path, monkeypatch):
+    # the index maps are cached relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    limits = {'x_grid_limits': (-10_000., 10_000.), 'y_grid_limits': (-10_000., 10_000.),
+              'z_grid_limits': (500., 5_000.), 'grid_resolution': 250}
+    expected = run_squire.subset_lowest_vertical_level(
+        run_squire.grid_radar(cmac_file, fields=run_squire.SQUIRE_FIELDS, **limits))
+    result = run_squire.grid_lowest_level(cmac_file, **limits)
+
+    assert set(result.data_vars) == set(expected.data_vars)
+    assert 'lowest_height' in result
+    for name in list(expected.data_vars) + ['z', 'x', 'y', 'lat', 'lon']:
+        np.testing.assert_allclose(result[name].values, expected[name].values, rtol=1e-6, err_msg=name)
+    np.testing.assert_array_equal(result['time'].values, expected['time'].values)
+
+    # the test volume does exercise columns starting above the lowest level and empty columns
+    heights = result['lowest_height'].values
+    assert (heights > 500.).any() and (heights == 5_000.).any() and (heights == 500.).any()
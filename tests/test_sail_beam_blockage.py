@@ -0,0 +1,92 @@
+import numpy as np
+import pyart
+import pytest
+
+import sail_beam_blockage
+
+
+def make_radar(elevation=0.5):
+    radar = pyart.testing.make_empty_ppi_radar(6, 10, 2)
+    radar.azimuth['data'][:] = np.tile(np.arange(10) * 36., 2)
+    radar.elevation['data'][:] = np.repeat([elevation, elevation + 1.], 10)
+    radar.fixed_angle['data'][:] = [elevation, elevation + 1.]
+    radar.add_field('DBZ', {'data': np.ma.masked_array(np.full((20, 6), 20.))})
+    return radar
+
+
+@pytest.fixture
+def fake_blockage(monkeypatch, tmp_path):
+    """
+    Replace the wradlib calculation by a blockage map counting its calls
+    """
+    calls = []
+
+    def compute_beam_blockage(radar, dem_file, radar_height_offset, beam_width):
+        calls.append(radar)
+        cbb = np.tile(np.linspace(0., 1., radar.ngates), (radar.nrays, 1)).astype('float32')
+        # the DEM does not cover the last gate of the first ray
+        cbb[0, -1] = np.nan
+        return dict(sail_beam_blockage.sail_geometry_cache.scan_geometry(radar), pbb=cbb, cbb=cbb)
+
+    monkeypatch.setattr(sail_beam_blockage, 'compute_beam_blockage', compute_beam_blockage)
+    monkeypatch.setattr(sail_beam_blockage, '_loaded_maps', {})
+    dem_file = tmp_path / 'sail.tif'
+    dem_file.write_bytes(b'dem')
+    return calls, dem_file, tmp_path / 'cache'
+
+
+def test_blockage_is_cached(fake_blockage):
+    calls, dem_file, cache_dir = fake_blockage
+    blockage = sail_beam_blockage.get_beam_blockage(make_radar(), dem_file, cache_dir=cache_dir)
+    assert len(calls) == 1 and len(list(cache_dir.glob('beam_blockage_*.npz'))) == 1
+
+    # same process, then a new process that only has the file on disk
+    assert sail_beam_blockage.get_beam_blockage(make_radar(), dem_file, cache_dir=cache_dir) is blockage
+    sail_beam_blockage._loaded_maps.clear()
+    cached = sail_beam_blockage.get_beam_blockage(make_radar(), dem_file, cache_dir=cache_dir)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(cached['cbb'], blockage['cbb'])
+
+
+def test_new_geometry_is_computed(fake_blockage):
+    calls, dem_file, cache_dir = fake_blockage
+    sail_beam_blockage.get_beam_blockage(make_radar(), dem_file, cache_dir=cache_dir)
+
+    # another scan strategy gets its own map
+    sail_beam_blockage.get_beam_blockage(make_radar(elevation=2.), dem_file, cache_dir=cache_dir)
+    assert len(calls) == 2 and len(list(cache_dir.glob('beam_blockage_*.npz'))) == 2
+
+    # small drift, and azimuths wrapping around north, reuse it
+    radar = make_radar()
+    radar.azimuth['data'][0] = 359.9
+    radar.elevation['data'] += 0.1
+    sail_beam_blockage.get_beam_blockage(radar, dem_file, cache_dir=cache_dir)
+    assert len(calls) == 2
+
+    # drift within the fingerprint but beyond the tolerance replaces the map
+    radar = make_radar()
+    radar.azimuth['data'][3] += 2 * sail_beam_blockage.ANGLE_TOLERANCE
+    sail_beam_blockage.get_beam_blockage(radar, dem_file, cache_dir=cache_dir)
+    assert len(calls) == 3 and len(list(cache_dir.glob('beam_blockage_*.npz'))) == 2
+
+    # a different DEM is a different map
+    other_dem = dem_file.with_name('other.tif')
+    other_dem.write_bytes(b'other dem')
+    sail_beam_blockage.get_beam_blockage(make_radar(), other_dem, cache_dir=cache_dir)
+    assert len(calls) == 4
+
+
+def test_blocked_gates_are_flagged_and_masked(fake_blockage):
+    _, dem_file, cache_dir = fake_blockage
+    radar = make_radar()
+    blockage = sail_beam_blockage.get_beam_blockage(radar, dem_file, cache_dir=cache_dir)
+    sail_beam_blockage.add_blockage_fields(radar, blockage)
+    sail_beam_blockage.mask_blocked_gates(radar, blockage, fields=['DBZ'])
+
+    # only the last gate reaches the threshold, and the gate outside the DEM counts as blocked
+    expected = np.zeros((20, 6), dtype=bool)
+    expected[:, -1] = True
+    np.testing.assert_array_equal(radar.fields['cbb_flag']['data'], expected.astype('int8'))
+    np.testing.assert_array_equal(np.ma.getmaskarray(radar.fields['DBZ']['data']), expected)
+    assert np.ma.is_masked(radar.fields['cumulative_beam_blockage']['data'][0, -1])
+    np.testing.assert_array_equal(sail_beam_blockage.blockage_flags(np.array([np.nan, 0.5, 0.95])), [1, 0, 1])
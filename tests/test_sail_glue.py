@@ -0,0 +1,122 @@
+import netCDF4
+import numpy as np
+import pyart
+import pytest
+import xarray as xr
+
+import sail_benchmark
+import sail_glue
+import sail_telemetry
+import sail_volume_index
+
+
+@pytest.fixture(scope='module')
+def glued_file(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp('glue')
+    volumes = sail_benchmark.write_synthetic_sweeps(work_dir / 'nc_files', 1, rays=36, gates=20)
+    radars = sail_glue.read_sweeps(volumes[0])
+    radar = sail_glue.radar_glue(radars[0], radars[1:])
+    sail_glue.fix_radar_times(radar)
+    sail_glue.apply_glue_fill(radar)
+    path = str(work_dir / 'xprecipradar_guc_volume_20220301-000000.b1.nc')
+    sail_glue.write_volume(path, radar)
+    return path, radar
+
+
+def check_arm_times(path):
+    with netCDF4.Dataset(path) as dataset:
+        time = dataset['time'][:]
+        assert dataset['time'].units == sail_glue.GLUE_TIME_UNITS
+        base_time = int(dataset['base_time'][:])
+        time_offset = dataset['time_offset'][:]
+        assert dataset['time_offset'].units.startswith('seconds since ')
+    np.testing.assert_array_equal(np.round((base_time + time_offset) * 1000.), time)
+    return time
+
+
+def test_glued_arm_times(glued_file):
+    path, radar = glued_file
+    time = check_arm_times(path)
+    np.testing.assert_array_equal(time, radar.time['data'])
+    assert time[0] == np.datetime64('2022-03-01T00:00:00', 'ms').astype('int64')
+    assert (np.diff(time) > 0).all()
+
+
+def test_rewritten_volume_keeps_arm_times(glued_file, tmp_path):
+    path, _ = glued_file
+    radar = pyart.io.read(path)
+    assert radar.time['units'] == sail_glue.GLUE_TIME_UNITS
+    out_path = str(tmp_path / 'rewritten.nc')
+    sail_glue.write_volume(out_path, radar)
+    np.testing.assert_array_equal(check_arm_times(out_path), check_arm_times(path))
+    # the radar is left with the times it was written with
+    assert radar.time['units'] == sail_glue.GLUE_TIME_UNITS
+
+
+def test_epoch_milliseconds():
+    time = {'units': 'seconds since 2022-03-01T00:00:10Z', 'data': np.array([0., 0.5, 1.0004])}
+    expected = np.datetime64('2022-03-01T00:00:10', 'ms').astype('int64') + np.array([0, 500, 1000])
+    np.testing.assert_array_equal(sail_glue.epoch_milliseconds(time), expected)
+    ms_time = {'units': sail_glue.GLUE_TIME_UNITS, 'data': expected.astype('float64')}
+    np.testing.assert_array_equal(sail_glue.epoch_milliseconds(ms_time), expected)
+
+
+def test_deduplicate_times():
+    times = np.array([0, 0, 0, 1000, 1000, 2000, 2001])
+    np.testing.assert_array_equal(sail_glue.deduplicate_times(times), [0, 1, 2, 1000, 1001, 2000, 2001])
+    # repeats pushed into the next group are moved forward to stay strictly increasing
+    np.testing.assert_array_equal(sail_glue.deduplicate_times(np.array([5, 5, 5, 6]), offset=1), [5, 6, 7, 8])
+    assert sail_glue.deduplicate_times(np.array([], dtype='int64')).size == 0
+
+
+def test_fix_times():
+    counts = [3, 1, 4, 2, 1]
+    seconds = np.repeat(np.arange(len(counts)), counts)
+    times = np.datetime64('2022-03-01T00:00:00', 'ns') + seconds.astype('timedelta64[s]')
+    rank = np.concatenate([np.arange(count) for count in counts])
+    fixed = sail_glue.fix_times(xr.Dataset(coords={'time': times})).time.values
+    np.testing.assert_array_equal(fixed, times + rank.astype('timedelta64[ms]'))
+
+
+def test_granule_batch_carries_on(monkeypatch, tmp_path):
+    volumes = []
+    for volume in range(3):
+        sweeps = []
+        for sweep in range(2):
+            path = tmp_path / ('volume%d_sweep%d.nc' % (volume, sweep))
+            path.write_bytes(b'sweep')
+            sweeps.append(str(path))
+        volumes.append(sweeps)
+    # a sweep of the second volume went missing after indexing
+    (tmp_path / 'volume1_sweep1.nc').unlink()
+
+    calls = []
+
+    def fake_granule(volume, pool, prefetched, dem_file=None):
+        calls.append((volume, sorted(prefetched)))
+        if volume is volumes[0]:
+            raise RuntimeError('glue failed')
+
+    monkeypatch.setattr(sail_glue, 'granule', fake_granule)
+    sail_glue.granule_batch(volumes)
+    assert [volume for volume, _ in calls] == volumes
+    # the second volume is not read ahead, and the failed first volume's reads are dropped
+    assert calls[0][1] == []
+    assert calls[1][1] == sorted(volumes[2])
+    assert calls[2][1] == sorted(volumes[2])
+
+
+def test_granule_skips_short_volumes(monkeypatch, tmp_path, capsys):
+    glued = []
+    monkeypatch.setattr(sail_glue, 'glue_volume', lambda volume, *args: glued.append(volume))
+    monkeypatch.setenv(sail_telemetry.TELEMETRY_LOG_ENV, str(tmp_path / 'telemetry.jsonl'))
+    monkeypatch.setenv(sail_telemetry.TELEMETRY_RUN_ENV, 'test')
+    volume = [f"/data/nc_files/202203_nc/sweep_{tilt}_PPI.nc" for tilt in sail_volume_index.VOLUME_TILTS]
+
+    sail_glue.granule(volume[:-1])
+    assert glued == [] and 'SKIPPED' in capsys.readouterr().out
+    record, = sail_telemetry.read_records(tmp_path / 'telemetry.jsonl', 'test')
+    assert record['status'] == 'failed' and '7 sweeps' in record['error']
+
+    sail_glue.granule(volume)
+    assert glued == [volume]
@@ -0,0 +1,89 @@
+import numpy as np
+import pyart
+import pytest
+
+import sail_grid
+import sail_telemetry
+
+GRID_SHAPE = (3, 41, 41)
+GRID_LIMITS = ((500., 2500.), (-4000., 4000.), (-4000., 4000.))
+
+
+@pytest.fixture(scope='module')
+def radar():
+    radar = pyart.testing.make_empty_ppi_radar(60, 90, 3)
+    radar.range['data'] = np.arange(60, dtype='float32') * 100. + 50.
+    # rays mirrored about the x axis would tie for the nearest gate along y = 0
+    radar.azimuth['data'][:] = np.tile(np.arange(90) * 4. + 1.3, 3)
+    radar.elevation['data'][:] = np.repeat([2., 6., 12.], 90)
+    radar.fixed_angle['data'][:] = [2., 6., 12.]
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+    rng = np.random.default_rng(1)
+    reflectivity = 20. + 10. * np.sin(radar.gate_x['data'] / 1500.) + rng.normal(0., 2., (radar.nrays, radar.ngates))
+    mask = rng.random((radar.nrays, radar.ngates)) < 0.05
+    radar.add_field('DBZ', {'data': np.ma.masked_array(reflectivity.astype('float32'), mask)})
+    return radar
+
+
+def test_tile_slices():
+    slices = sail_grid.tile_slices(601, 4)
+    assert [(piece.start, piece.stop) for piece in slices] == [(0, 150), (150, 300), (300, 451), (451, 601)]
+
+
+def test_gate_roi(radar):
+    roi = sail_grid.gate_roi(radar)
+    distance = np.sqrt((radar.gate_altitude['data'] - radar.altitude['data'][0])**2 +
+                       radar.gate_x['data']**2 + radar.gate_y['data']**2)
+    np.testing.assert_allclose(roi, np.maximum(distance * np.tan(np.deg2rad(1.)), 250.), rtol=1e-5)
+    assert (sail_grid.gate_roi(radar, constant_roi=800.) == 800.).all()
+    assert sail_grid.gate_roi(radar, roi_func='dist') is None
+
+
+@pytest.mark.parametrize('weighting_function', ['Barnes2', 'Nearest'])
+def test_tiled_matches_monolithic(radar, weighting_function):
+    monolithic = pyart.map.grid_from_radars((radar,), GRID_SHAPE, GRID_LIMITS,
+                                            weighting_function=weighting_function)
+    tiled = sail_grid.tiled_grid_from_radar(radar, GRID_SHAPE, GRID_LIMITS, tiles=(3, 2), processes=1,
+                                            weighting_function=weighting_function)
+
+    expected = monolithic.fields['DBZ']['data']
+    result = tiled.fields['DBZ']['data']
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(tiled.x['data'], monolithic.x['data'])
+    # only the odd gate right at the edge of a radius of influence may differ
+    both = ~np.ma.getmaskarray(expected) & ~np.ma.getmaskarray(result)
+    assert (np.ma.getmaskarray(expected) != np.ma.getmaskarray(result)).sum() <= 2
+    assert (np.abs(result - expected)[both] > 1e-3).sum() <= 0.01 * both.sum()
+    np.testing.assert_allclose(result[both], expected[both], atol=1.)
+
+
+def test_processes_match(radar, monkeypatch, tmp_path):
+    serial = sail_grid.tiled_grid_from_radar(radar, GRID_SHAPE, GRID_LIMITS, tiles=(2, 2), processes=1)
+
+    worker_rss = []
+    add_worker_rss = sail_telemetry.add_worker_rss
+
+    def recorded_worker_rss(rss):
+        worker_rss.append(rss)
+        add_worker_rss(rss)
+
+    monkeypatch.setattr(sail_telemetry, 'add_worker_rss', recorded_worker_rss)
+    monkeypatch.setenv(sail_telemetry.TELEMETRY_LOG_ENV, str(tmp_path / 'telemetry.jsonl'))
+    monkeypatch.setenv(sail_telemetry.TELEMETRY_RUN_ENV, 'test')
+    with sail_telemetry.file_record('volume.nc', 'grid'):
+        with sail_telemetry.stage('grid'):
+            parallel = sail_grid.tiled_grid_from_radar(radar, GRID_SHAPE, GRID_LIMITS, tiles=(2, 2), processes=2)
+    np.testing.assert_array_equal(np.ma.getmaskarray(parallel.fields['DBZ']['data']),
+                                  np.ma.getmaskarray(serial.fields['DBZ']['data']))
+    np.testing.assert_array_equal(parallel.fields['DBZ']['data'].filled(0.), serial.fields['DBZ']['data'].filled(0.))
+
+    # the forked workers report their memory, counted in the stage on top of this process
+    record, = sail_telemetry.read_records(tmp_path / 'telemetry.jsonl', 'test')
+    assert len(worker_rss) == 1 and worker_rss[0] > 0
+    assert record['stages']['grid']['peak_rss'] >= worker_rss[0]
+
+
+def test_rejects_other_origins(radar):
+    with pytest.raises(ValueError):
+        sail_grid.tiled_grid_from_radar(radar, GRID_SHAPE, GRID_LIMITS, grid_origin=(39., -107.))
@@ -0,0 +1,52 @@
+import numpy as np
+import pyart
+import pytest
+
+import sail_io
+
+
+@pytest.fixture(scope='module')
+def cfradial_file(tmp_path_factory):
+    radar = pyart.testing.make_empty_ppi_radar(30, 36, 2)
+    rng = np.random.default_rng(5)
+    for name in ['DBZ', 'VEL', 'RHOHV']:
+        data = rng.normal(10., 5., (radar.nrays, radar.ngates))
+        radar.add_field(name, {'data': np.ma.masked_array(data, rng.random(data.shape) < 0.1),
+                               'units': '1', 'long_name': name})
+    path = tmp_path_factory.mktemp('cfradial') / 'volume.nc'
+    pyart.io.write_cfradial(str(path), radar)
+    return str(path)
+
+
+def test_read_only_requested_fields(cfradial_file):
+    radar = sail_io.read_radar(cfradial_file, ['DBZ', 'VEL', 'not_in_file'], lazy=True)
+    assert set(radar.fields) == {'DBZ', 'VEL'}
+    # nothing is decoded until a field is used
+    assert all(sail_io._lazy_variable(field) is not None for field in radar.fields.values())
+
+    full = pyart.io.read(cfradial_file)
+    np.testing.assert_array_equal(radar.fields['DBZ']['data'], full.fields['DBZ']['data'])
+    assert sail_io._lazy_variable(radar.fields['DBZ']) is None
+
+    radar = sail_io.read_radar(cfradial_file, ['RHOHV'], dtype='float32')
+    assert set(radar.fields) == {'RHOHV'} and radar.fields['RHOHV']['data'].dtype == np.float32
+    np.testing.assert_allclose(radar.fields['RHOHV']['data'], full.fields['RHOHV']['data'], rtol=1e-6)
+    lazy = sail_io.read_radar(cfradial_file, ['RHOHV'], dtype='float32', lazy=True)
+    assert lazy.fields['RHOHV']['data'].dtype == np.float32
+
+
+def test_read_gates_matches_full_read(cfradial_file):
+    full = pyart.io.read(cfradial_file)
+    # (site, sweep) pairs of rays and gates, with a ray used twice
+    rays = np.array([[3, 40], [3, 71], [20, 36]])
+    gates = np.array([[0, 29], [5, 7], [12, 12]])
+    for lazy in [True, False]:
+        radar = sail_io.read_radar(cfradial_file, lazy=lazy)
+        for name in ['DBZ', 'VEL']:
+            values = sail_io.read_gates(radar, name, rays, gates)
+            expected = full.fields[name]['data'][rays, gates]
+            assert values.shape == rays.shape
+            np.testing.assert_array_equal(np.ma.getmaskarray(values), np.ma.getmaskarray(expected))
+            np.testing.assert_array_equal(values.filled(0.), expected.filled(0.))
+        # the lazy fields are still not loaded
+        assert (sail_io._lazy_variable(radar.fields['DBZ']) is not None) == lazy
@@ -0,0 +1,76 @@
+import numpy as np
+import pyart
+import pytest
+
+import sail_kdp
+
+
+def make_radar():
+    radar = pyart.testing.make_empty_ppi_radar(60, 20, 2)
+    rng = np.random.default_rng(0)
+    shape = (radar.nrays, radar.ngates)
+    phidp = np.tile(np.linspace(0., 40., radar.ngates), (radar.nrays, 1))
+    # noisy gates at the far end of every ray
+    phidp[:, 45:] = rng.uniform(-180., 180., (radar.nrays, radar.ngates - 45))
+    fields = {'PHIDP': phidp,
+              'VEL': rng.normal(0., 1., shape),
+              'DBZ': np.full(shape, 30.),
+              'NCP': np.full(shape, 0.9),
+              'RHOHV': np.full(shape, 0.99)}
+    for name, data in fields.items():
+        radar.add_field(name, {'data': np.ma.masked_array(data.astype('float32'))})
+    radar.instrument_parameters = {'nyquist_velocity': {'data': np.full(radar.nrays, 20., dtype='float32')}}
+    return radar
+
+
+@pytest.fixture(autouse=True)
+def phidp_texture(monkeypatch):
+    """
+    Stand in for the wradlib PHIDP texture: high beyond gate 45, where PHIDP is noise
+    """
+    def texture_of_complex_phase(radar, phidp_field=None, phidp_texture_field=None):
+        texture = np.zeros((radar.nrays, radar.ngates), dtype='float32')
+        texture[:, 45:] = 100.
+        return {'data': np.ma.masked_array(texture)}
+
+    monkeypatch.setattr(pyart.retrieve, 'texture_of_complex_phase', texture_of_complex_phase)
+
+
+def test_texture_gatefilter_leaves_fields():
+    radar = make_radar()
+    fields = set(radar.fields)
+    gatefilter = sail_kdp.texture_gatefilter(radar)
+    assert set(radar.fields) == fields
+    assert gatefilter.gate_excluded[:, 45:].all() and not gatefilter.gate_excluded[:, 5:40].any()
+
+
+def test_volume_kdp_adds_only_its_fields():
+    radar = make_radar()
+    fields = set(radar.fields)
+    sail_kdp.volume_kdp(radar, method='maesaka')
+    assert set(radar.fields) == fields | {'kdp_maesaka', 'phidp_maesaka'}
+    excluded = sail_kdp.texture_gatefilter(radar).gate_excluded
+    np.testing.assert_array_equal(np.ma.getmaskarray(radar.fields['kdp_maesaka']['data']), excluded)
+
+
+def test_lp_gets_the_gate_filter(monkeypatch):
+    seen = []
+
+    def phase_proc_lp(radar, offset, phidp_field=None, **kwargs):
+        seen.append(np.ma.getmaskarray(radar.fields[phidp_field]['data']).copy())
+        field = {'data': radar.fields[phidp_field]['data'].filled(0.)}
+        return field, field
+
+    monkeypatch.setattr(pyart.correct, 'phase_proc_lp', phase_proc_lp)
+    radar = make_radar()
+    excluded = sail_kdp.texture_gatefilter(radar).gate_excluded
+    sail_kdp.volume_kdp(radar, method='lp')
+    np.testing.assert_array_equal(np.concatenate(seen), excluded)
+    # the volume PHIDP itself is left unmasked
+    assert not np.ma.getmaskarray(radar.fields['PHIDP']['data']).any()
+
+
+def test_unknown_method():
+    radar = make_radar()
+    with pytest.raises(ValueError):
+        sail_kdp.sweep_kdp(radar.extract_sweeps([0]), np.zeros((20, 60), dtype=bool), method='other')
@@ -0,0 +1,73 @@
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+import sail_output
+
+
+def squire_volume(time, value):
+    """
+    A SQUIRE-shaped volume: one time, a (y, x) grid, and constant coordinates
+    """
+    y = np.arange(4) * 1000.
+    x = np.arange(5) * 1000.
+    reflectivity = np.full((1, 4, 5), value, dtype='float64')
+    reflectivity[0, 0, 0] = np.nan
+    return xr.Dataset({'DBZ': (('time', 'y', 'x'), reflectivity),
+                       'gate_count': (('time', 'y', 'x'), np.full((1, 4, 5), 3, dtype='int64'))},
+                      coords={'time': [np.datetime64(time, 'ns')], 'y': y, 'x': x,
+                              'lat': (('y', 'x'), 38.9 + np.zeros((4, 5))),
+                              'lon': (('y', 'x'), -106.9 + np.zeros((4, 5)))})
+
+
+SCHEMA = {'variables': {'DBZ': {'encoding': {'dtype': 'int16', '_FillValue': -9999,
+                                             'scale_factor': 0.01}},
+                        'gate_count': {'encoding': {'dtype': 'int32', '_FillValue': -9999}}}}
+
+
+def test_netcdf_encoding_round_trip(tmp_path):
+    ds = squire_volume('2022-03-14T00:00', 21.5)
+    chunks = sail_output.OUTPUT_CHUNKS['xprecipradarsquire.c1']
+    path = sail_output.write_netcdf(ds, tmp_path / 'squire.nc', sail_output.output_encoding(ds, SCHEMA, chunks))
+    assert list(tmp_path.iterdir()) == [path]
+
+    with netCDF4.Dataset(path) as nc:
+        dbz = nc['DBZ']
+        assert dbz.dtype == np.int16 and dbz._FillValue == -9999
+        assert dbz.filters()['zlib'] and dbz.filters()['shuffle'] and dbz.filters()['complevel'] == 4
+        assert dbz.chunking() == [1, 4, 5]
+        assert nc['gate_count'].dtype == np.int32
+        assert nc['lat'].chunking() == [4, 5] and nc['lat'].filters()['zlib']
+    with xr.open_dataset(path) as written:
+        np.testing.assert_allclose(written['DBZ'].values, ds['DBZ'].values)
+
+
+def test_write_netcdf_leaves_no_partial_file(tmp_path):
+    ds = squire_volume('2022-03-14T00:00', 21.5)
+    with pytest.raises(Exception):
+        sail_output.write_netcdf(ds, tmp_path / 'squire.nc', {'DBZ': {'dtype': 'no such type'}})
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_append_to_store_overwrites_repeated_times(tmp_path):
+    pytest.importorskip('zarr')
+    store = str(tmp_path / 'squire.zarr')
+    encoding = sail_output.output_encoding(squire_volume('2022-03-14T00:00', 0.), SCHEMA,
+                                           sail_output.OUTPUT_CHUNKS['xprecipradarsquire.c1'])
+    sail_output.append_to_store(squire_volume('2022-03-14T00:05', 10.), store, encoding)
+    sail_output.append_to_store(squire_volume('2022-03-14T00:00', 20.), store, encoding)
+    # the first volume is processed again, with new values
+    sail_output.append_to_store(squire_volume('2022-03-14T00:05', 30.), store, encoding)
+
+    with sail_output.open_store(store) as ds:
+        np.testing.assert_array_equal(ds['time'].values,
+                                      np.array(['2022-03-14T00:00', '2022-03-14T00:05'], dtype='datetime64[ns]'))
+        np.testing.assert_allclose(ds['DBZ'].values[:, 1, 1], [20., 30.])
+        assert np.isnan(ds['DBZ'].values[:, 0, 0]).all()
+        assert ds['lat'].dims == ('y', 'x')
+
+        selected = sail_output.select_times(ds, '2022-03-14T00:03', '2022-03-14T00:05')
+        np.testing.assert_allclose(selected['DBZ'].values[:, 1, 1], [30.])
+        column = sail_output.select_point(ds, 38.9, -106.9)
+        assert column['DBZ'].dims == ('time',)
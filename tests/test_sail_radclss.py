@@ -0,0 +1,94 @@
+import numpy as np
+import pyart
+import pytest
+import xarray as xr
+
+import sail_radclss
+
+
+def minutes(values):
+    return np.datetime64('2022-03-14T00:00') + np.asarray(values).astype('timedelta64[m]')
+
+
+def test_window_bounds():
+    times = minutes([0, 1, 5, 6, 10, 20])
+    left, right = sail_radclss.window_bounds(times, minutes([0, 5, 12]))
+    # windows are (target, target + 5 min]
+    np.testing.assert_array_equal(left, [1, 3, 5])
+    np.testing.assert_array_equal(right, [3, 5, 5])
+
+
+@pytest.mark.parametrize('how, expected', [('sum', [3., np.nan, 4.]),
+                                           ('mean', [1.5, np.nan, 4.]),
+                                           ('max', [2., np.nan, 4.])])
+def test_window_reduce(how, expected):
+    values = np.array([1., 2., np.nan, 4., 5.])
+    out = sail_radclss.window_reduce(values, np.array([0, 2, 2]), np.array([2, 3, 4]), how)
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_window_reduce_profiles_and_empty_last_window():
+    values = np.arange(12, dtype='float64').reshape(4, 3)
+    out = sail_radclss.window_reduce(values, np.array([0, 4]), np.array([4, 4]), 'mean')
+    np.testing.assert_array_equal(out[0], values.mean(axis=0))
+    assert np.isnan(out[1]).all()
+    with pytest.raises(ValueError):
+        sail_radclss.window_reduce(values, np.array([0]), np.array([1]), 'median')
+
+
+def test_bin_to_radar_times_matches_resample():
+    rng = np.random.default_rng(0)
+    times = np.datetime64('2022-03-14T00:00') + np.arange(0, 3600, 10).astype('timedelta64[s]')
+    ground = xr.Dataset({'precip': ('time', rng.random(times.size)),
+                         'temp': ('time', rng.normal(size=times.size)),
+                         'qc': ('time', np.array(['ok'] * times.size)),
+                         'height': ('height', [100., 200.])},
+                        coords={'time': times})
+    radar_times = minutes(np.arange(0, 55, 5))
+    matched = sail_radclss.bin_to_radar_times(ground, radar_times, resample={'temp': 'mean'})
+    assert 'qc' not in matched and 'height' in matched
+
+    # right-closed 5 minute resampling, labelled with the window starts
+    resampled = ground.resample(time='5min', closed='right', label='left')
+    np.testing.assert_allclose(matched.precip.values, resampled.sum().precip.sel(time=radar_times).values)
+    np.testing.assert_allclose(matched.temp.values, resampled.mean().temp.sel(time=radar_times).values)
+
+
+def make_radar():
+    radar = pyart.testing.make_empty_ppi_radar(80, 120, 4)
+    radar.latitude['data'][:] = 38.898
+    radar.longitude['data'][:] = -106.943
+    radar.altitude['data'][:] = 3137.
+    radar.range['data'] = (np.arange(80) * 100. + 50.).astype('float32')
+    radar.azimuth['data'][:] = np.tile(np.arange(120) * 3. + 0.7, 4)
+    radar.elevation['data'][:] = np.repeat([1., 3., 6., 10.], 120)
+    radar.fixed_angle['data'][:] = [1., 3., 6., 10.]
+    radar.time['data'] = np.arange(radar.nrays, dtype='float64') * 0.25
+    radar.init_gate_x_y_z()
+    radar.init_gate_altitude()
+    radar.init_gate_longitude_latitude()
+    rng = np.random.default_rng(4)
+    for name in ['DBZ', 'VEL']:
+        data = rng.normal(10., 5., (radar.nrays, radar.ngates))
+        radar.add_field(name, {'data': np.ma.masked_array(data, rng.random(data.shape) < 0.05),
+                               'units': '1', 'long_name': name})
+    return radar
+
+
+def test_extract_columns_matches_get_field_location():
+    radar = make_radar()
+    # the last site is 9 km north, beyond the last gate
+    lats = [38.92, 38.898, 38.87, 38.898 + 9. / 111.2]
+    lons = [-106.95, -106.90, -106.98, -106.94]
+    lookup = sail_radclss.column_lookup(radar, lats, lons)
+    ds = sail_radclss.extract_columns(radar, lookup, lats, lons, ['a', 'b', 'c', 'edge'])
+
+    # get_field_location picks the gate before the nearest one, so the edge site takes the second to last
+    assert (lookup['gates'][3] == radar.ngates - 2).all()
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        column = pyart.util.columnsect.get_field_location(radar, lat, lon).interp(height=ds['height'].values)
+        for name in ['DBZ', 'VEL']:
+            np.testing.assert_allclose(ds[name].values[i], column[name].values, err_msg=name)
+        offsets = ds['time_offset'].values[i] - column['time_offset'].values
+        assert np.all(np.isnat(offsets) | (np.abs(offsets) < np.timedelta64(1, 'us')))
+        assert np.isfinite(ds['DBZ'].values[i]).any()
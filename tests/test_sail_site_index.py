@@ -0,0 +1,141 @@
+import sqlite3
+
+import numpy as np
+import pytest
+import xarray as xr
+
+import sail_site_index
+
+SITES = [{'name': 'north', 'source': 'test', 'latitude': 39.02, 'longitude': -107.0},
+         {'name': 'center', 'source': 'test', 'latitude': 39.0, 'longitude': -107.0},
+         {'name': 'same cell', 'source': 'test', 'latitude': 39.0001, 'longitude': -107.0001},
+         {'name': 'far', 'source': 'test', 'latitude': 41.0, 'longitude': -107.0}]
+
+
+def gridded(time, offset=0.):
+    y = np.arange(-5, 6) * 1000.
+    x = np.arange(-5, 6) * 1000.
+    grid_x, grid_y = np.meshgrid(x, y)
+    lat = 39.0 + grid_y / sail_site_index.METERS_PER_DEGREE
+    lon = -107.0 + grid_x / (sail_site_index.METERS_PER_DEGREE * np.cos(np.deg2rad(39.)))
+    reflectivity = offset + np.arange(121, dtype='float32').reshape(1, 11, 11)
+    reflectivity[0, 5, 5] = np.nan if offset else reflectivity[0, 5, 5]
+    return xr.Dataset({'DBZ': (('time', 'y', 'x'), reflectivity),
+                       'snow_rate': (('time', 'y', 'x'), reflectivity / 10.)},
+                      coords={'time': [np.datetime64(time, 'ns')], 'y': y, 'x': x,
+                              'lat': (('y', 'x'), lat), 'lon': (('y', 'x'), lon)})
+
+
+@pytest.fixture
+def index(tmp_path):
+    sail_site_index._resolved.clear()
+    conn = sail_site_index.open_index(tmp_path / 'sites.sqlite')
+    sail_site_index.store_sample(conn, sail_site_index.sample_dataset(gridded('2022-03-14T00:00'), SITES))
+    sail_site_index.store_sample(conn, sail_site_index.sample_dataset(gridded('2022-03-14T00:05', 1000.),
+                                                                      SITES))
+    yield conn
+    conn.close()
+
+
+def test_resolve_sites():
+    y, x, distance = sail_site_index.resolve_sites(gridded('2022-03-14'), SITES)
+    np.testing.assert_array_equal(y, [7, 5, 5, -1])
+    np.testing.assert_array_equal(x, [5, 5, 5, -1])
+    assert distance[1] < 1. and distance[3] > 200000.
+
+
+def test_query(index):
+    ds = sail_site_index.query(index)
+    assert ds.sizes == {'time': 2, 'site': 4}
+    assert list(ds.data_vars) == ['DBZ', 'snow_rate']
+    np.testing.assert_array_equal(ds['DBZ'].sel(site='north'), [82., 1082.])
+    # sites sharing a cell share samples, missing values come back as NaN
+    np.testing.assert_array_equal(ds['DBZ'].sel(site='center'), ds['DBZ'].sel(site='same cell'))
+    assert ds['DBZ'].sel(site='center').values[0] == 60. and np.isnan(ds['DBZ'].sel(site='center').values[1])
+    assert np.isnan(ds['DBZ'].sel(site='far')).all()
+
+    ds = sail_site_index.query(index, sites=['north'], fields=['snow_rate'], start='2022-03-14T00:03')
+    assert ds.sizes == {'time': 1, 'site': 1}
+    np.testing.assert_allclose(ds['snow_rate'].values, [[108.2]], rtol=1e-6)
+
+
+def test_query_nothing(index):
+    ds = sail_site_index.query(index, sites=[])
+    assert ds.sizes == {'time': 2, 'site': 0}
+    ds = sail_site_index.query(index, fields=[])
+    assert len(ds.data_vars) == 0 and ds.sizes['site'] == 4
+
+
+def test_store_replaces_volume(index):
+    sail_site_index.store_sample(index, sail_site_index.sample_dataset(gridded('2022-03-14T00:00', 2000.),
+                                                                       SITES))
+    ds = sail_site_index.query(index, sites=['north'], fields=['DBZ'])
+    np.testing.assert_array_equal(ds['DBZ'].values[:, 0], [2082., 1082.])
+
+
+def test_grids_kept_apart(index):
+    # a coarser product on its own grid, with a volume at the same time as the first grid
+    coarse = gridded('2022-03-14T00:00', 5000.).isel(y=slice(1, None, 2), x=slice(1, None, 2))
+    sail_site_index.store_sample(index, sail_site_index.sample_dataset(coarse, SITES))
+    with pytest.raises(ValueError, match='2 grids'):
+        sail_site_index.query(index)
+
+    fine = sail_site_index.grid_fingerprint(gridded('2022-03-14'))
+    ds = sail_site_index.query(index, sites=['north', 'far'], fields=['DBZ'], grid=fine)
+    np.testing.assert_array_equal(ds['DBZ'].sel(site='north'), [82., 1082.])
+
+    ds = sail_site_index.query(index, sites=['north', 'far'], fields=['DBZ'],
+                               grid=sail_site_index.grid_fingerprint(coarse))
+    assert ds.sizes == {'time': 1, 'site': 2}
+    np.testing.assert_array_equal(ds['DBZ'].sel(site='north'), [5082.])
+    assert np.isnan(ds['distance'].sel(site='far'))
+
+
+class ImmediateFuture:
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+class Completed(list):
+    def add(self, future):
+        self.append(future)
+
+
+class ImmediateClient:
+    def submit(self, function, *args, pure=True, **kwargs):
+        return ImmediateFuture(function(*args, **kwargs))
+
+
+def test_run_files_carries_on_when_storing_fails(monkeypatch, tmp_path, capsys):
+    run_squire = pytest.importorskip('run_squire_march_2022')
+    files = []
+    for name in ['first.nc', 'second.nc']:
+        files.append(str(tmp_path / name))
+        (tmp_path / name).write_bytes(b'volume')
+
+    def process_file(file, out_dir, store=None, dem_file=None, sites=None):
+        sample = sail_site_index.sample_dataset(gridded('2022-03-14T00:00'), SITES, path=file)
+        return {'input_path': file, 'output_path': file + '.out', 'status': 'done', 'error': None,
+                'started': 0., 'finished': 1., 'duration': 1., 'site_sample': sample}
+
+    def store_sample(conn, sample):
+        if sample['path'].endswith('first.nc'):
+            conn.execute("INSERT INTO volumes VALUES (?, ?, ?)", (sample['time'], sample['grid'], sample['path']))
+            raise sqlite3.OperationalError('database is locked')
+        store(conn, sample)
+
+    store = sail_site_index.store_sample
+    monkeypatch.setattr(run_squire, 'process_file', process_file)
+    monkeypatch.setattr(run_squire, 'as_completed', Completed)
+    monkeypatch.setattr(sail_site_index, 'store_sample', store_sample)
+    run_squire.run_files(ImmediateClient(), files, str(tmp_path), str(tmp_path / 'manifest.sqlite'),
+                         site_index=str(tmp_path / 'sites.sqlite'))
+
+    assert 'FAILURE storing site samples' in capsys.readouterr().out
+    conn = sail_site_index.open_index(tmp_path / 'sites.sqlite')
+    # the partial insert of the failed file was rolled back, the second file was stored
+    assert [row[0] for row in conn.execute("SELECT path FROM volumes")] == [files[1]]
+    conn.close()
@@ -0,0 +1,88 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+import sail_telemetry
+
+
+@pytest.fixture
+def telemetry_log(monkeypatch, tmp_path):
+    path = tmp_path / 'telemetry.jsonl'
+    monkeypatch.setenv(sail_telemetry.TELEMETRY_LOG_ENV, str(path))
+    monkeypatch.setenv(sail_telemetry.TELEMETRY_RUN_ENV, 'test')
+    return path
+
+
+def test_one_sampler_per_file(monkeypatch, telemetry_log):
+    samplers = []
+    rss_sampler = sail_telemetry.rss_sampler
+
+    def counted_sampler(*args, **kwargs):
+        samplers.append(args)
+        return rss_sampler(*args, **kwargs)
+
+    monkeypatch.setattr(sail_telemetry, 'rss_sampler', counted_sampler)
+    with sail_telemetry.file_record('volume.nc', 'test'):
+        for _ in range(3):
+            with sail_telemetry.stage('read'):
+                pass
+        with sail_telemetry.stage('grid'):
+            with sail_telemetry.stage('write'):
+                pass
+    assert len(samplers) == 1
+
+    record, = sail_telemetry.read_records(telemetry_log, 'test')
+    assert record['status'] == 'done'
+    assert record['stages']['read']['calls'] == 3
+    assert set(record['stages']) == {'read', 'grid', 'write'}
+
+
+def test_stage_peaks_from_the_shared_sampler(telemetry_log):
+    size = 200 * 1024 * 1024
+    with sail_telemetry.file_record('volume.nc', 'test'):
+        with sail_telemetry.stage('small'):
+            pass
+        with sail_telemetry.stage('large'):
+            data = np.ones(size // 8)
+            time.sleep(5 * sail_telemetry.RSS_SAMPLE_INTERVAL)
+            del data
+
+    record, = sail_telemetry.read_records(telemetry_log, 'test')
+    stages = record['stages']
+    assert stages['large']['peak_rss'] - stages['small']['peak_rss'] > size / 2
+    assert record['peak_rss'] >= stages['large']['peak_rss']
+
+
+def test_measure_without_sampler():
+    results = []
+    with sail_telemetry.measure('alone', results) as measurement:
+        pass
+    assert results == [measurement]
+    assert measurement['peak_rss'] > 0 and measurement['wall'] >= 0
+
+
+def test_failure_is_recorded(telemetry_log):
+    with pytest.raises(ValueError):
+        with sail_telemetry.file_record('volume.nc', 'test'):
+            with sail_telemetry.stage('read'):
+                raise ValueError('bad volume')
+
+    record, = (json.loads(line) for line in open(telemetry_log))
+    assert record['status'] == 'failed' and record['error'] == 'ValueError: bad volume'
+
+
+def test_worker_rss_counts_in_the_stages(telemetry_log):
+    worker_rss = 64 * 1024 ** 3
+    with sail_telemetry.file_record('volume.nc', 'test'):
+        with sail_telemetry.stage('read'):
+            pass
+        with sail_telemetry.stage('grid'):
+            sail_telemetry.add_worker_rss(worker_rss)
+
+    record, = sail_telemetry.read_records(telemetry_log, 'test')
+    assert record['stages']['grid']['peak_rss'] > worker_rss > record['stages']['read']['peak_rss']
+    assert record['peak_rss'] > worker_rss
+    # outside a file record it does nothing
+    sail_telemetry.add_worker_rss(worker_rss)
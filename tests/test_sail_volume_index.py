@@ -0,0 +1,83 @@
+import datetime
+
+import sail_volume_index
+
+START = datetime.datetime(2022, 3, 1, 0, 48, 45)
+
+
+def sweep_name(seconds, tilt, scan=278032):
+    time = START + datetime.timedelta(seconds=seconds)
+    return (f"/data/gucxprecipradarS2.00.{time:%Y%m%d.%H%M%S}.raw.csu.sail-{time:%Y%m%d-%H%M%S}"
+            f"_{scan}_22_{tilt}_PPI.nc")
+
+
+def volume_names(start, tilts=sail_volume_index.VOLUME_TILTS, step=30):
+    return [sweep_name(start + step * number, tilt) for number, tilt in enumerate(tilts)]
+
+
+def build(paths, **kwargs):
+    conn = sail_volume_index.open_index(':memory:')
+    sail_volume_index.update_index(conn, paths)
+    return sail_volume_index.build_volumes(conn, **kwargs)
+
+
+def test_parse_sweep_filename():
+    sweep = sail_volume_index.parse_sweep_filename(sweep_name(0, 4))
+    assert (sweep['time'], sweep['scan'], sweep['tilt']) == ('20220301004845', 278032, 4)
+    assert sail_volume_index.parse_sweep_filename('/data/gucxprecipradarS2.00.20220301.004845.raw.nc') is None
+    assert sail_volume_index.parse_sweep_filename('/data/sail-20220301-004845_278032_22_1_RHI.nc') is None
+
+
+def test_complete_volumes():
+    first = volume_names(0)
+    second = volume_names(600)
+    volumes, incomplete = build(first + second + ['/data/not_a_sweep.nc'])
+    assert volumes == [first, second]
+    assert incomplete == []
+
+
+def test_missing_tilt():
+    tilts = [tilt for tilt in sail_volume_index.VOLUME_TILTS if tilt != 6]
+    broken = volume_names(0, tilts)
+    complete = volume_names(600)
+    volumes, incomplete = build(broken + complete)
+    assert volumes == [complete]
+    assert incomplete == [(broken, 'expected tilt 6, found 8')]
+
+    # a volume cut short by the next one, or by the end of the month
+    last = volume_names(1200)[:2]
+    volumes, incomplete = build(broken[:3] + complete + last)
+    assert volumes == [complete]
+    assert incomplete == [(broken[:3], 'missing tilt 6'), (last, 'missing tilt 4')]
+
+
+def test_volume_too_long():
+    slow = volume_names(0, step=90)
+    volumes, incomplete = build(slow)
+    assert volumes == []
+    assert incomplete == [(slow, 'volume spans 630 s')]
+    assert build(slow, max_seconds=630)[0] == [slow]
+
+
+def test_repeated_and_out_of_order_tilts():
+    tilts = sail_volume_index.VOLUME_TILTS
+    repeated = volume_names(0, tilts[:3] + tilts[2:])
+    complete = volume_names(600)
+    volumes, incomplete = build(repeated + complete)
+    assert volumes == [complete]
+    # the rest of the broken volume is kept with it, up to the next base scan
+    assert incomplete == [(repeated, 'expected tilt 6, found 4')]
+
+    swapped = volume_names(0, tilts[:2] + (tilts[3], tilts[2]) + tilts[4:])
+    volumes, incomplete = build(swapped)
+    assert volumes == []
+    assert incomplete == [(swapped, 'expected tilt 4, found 6')]
+
+    orphans = volume_names(0, tilts[2:4])
+    assert build(orphans)[1] == [(orphans, 'tilt 4 without a base scan')]
+
+
+def test_month_prefix():
+    march = volume_names(0)
+    april = [name.replace('20220301', '20220401') for name in volume_names(0)]
+    assert build(march + april, prefix='202204')[0] == [april]
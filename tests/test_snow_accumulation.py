@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import snow_accumulation
+
+START = np.datetime64('2022-03-14T00:00:00', 's')
+
+
+def write_volume(directory, minutes, rate):
+    """
+    Write a SQUIRE file holding a uniform snow rate [mm/h] on a small grid
+    """
+    time = START + np.timedelta64(int(minutes * 60), 's')
+    values = np.full((1, 2, 3), rate, dtype='float32')
+    ds = xr.Dataset({'snow_rate_ws88diw': (('time', 'y', 'x'), values)},
+                    coords={'time': [time.astype('datetime64[ns]')],
+                            'y': [0., 1000.], 'x': [0., 1000., 2000.],
+                            'lat': (('y', 'x'), np.full((2, 3), 38.9)),
+                            'lon': (('y', 'x'), np.full((2, 3), -106.9))})
+    stamp = time.astype(object).strftime('%Y%m%d.%H%M%S')
+    path = directory / f"gucxprecipradarsquireS2.c1.{stamp}.gridded.nc"
+    ds.to_netcdf(path)
+    return path
+
+
+def read_total(out_dir, kind, stamp):
+    with xr.open_dataset(out_dir / f"squire_snowfall.{kind}.{stamp}.nc") as ds:
+        return (float(ds['snow_rate_ws88diw_accumulated'].values.mean()),
+                float(ds['observed_time'].values[0]), float(ds['missing_time'].values[0]))
+
+
+def test_interval_split_at_the_hour(tmp_path):
+    # the rate rises linearly from 0 to 3 mm/h between 00:50 and 01:05
+    write_volume(tmp_path, 50, 0.)
+    write_volume(tmp_path, 65, 3.)
+    out_dir = tmp_path / 'out'
+    snow_accumulation.accumulate(snow_accumulation.list_volumes(tmp_path), out_dir)
+
+    first, observed, _ = read_total(out_dir, 'hourly', '20220314.000000')
+    second, _, _ = read_total(out_dir, 'hourly', '20220314.010000')
+    assert observed == 600.
+    np.testing.assert_allclose([first, second], [1. / 6., 2.5 * 5. / 60.])
+    np.testing.assert_allclose(read_total(out_dir, 'event', '20220314.005000')[0], 1.5 * 0.25)
+
+
+def test_gaps_and_missing_rates(tmp_path):
+    write_volume(tmp_path, 0, 2.)
+    write_volume(tmp_path, 10, 2.)
+    write_volume(tmp_path, 40, 2.)
+    write_volume(tmp_path, 50, np.nan)
+    out_dir = tmp_path / 'out'
+    snow_accumulation.accumulate(snow_accumulation.list_volumes(tmp_path), out_dir, max_interval=900)
+
+    # the 30 minute gap is missing time, and the volume without echo counts as no snowfall
+    total, observed, missing = read_total(out_dir, 'event', '20220314.000000')
+    assert (observed, missing) == (1200., 1800.)
+    np.testing.assert_allclose(total, 2. / 6. + 1. / 6.)
+
+
+def test_resume_matches_a_single_run(tmp_path):
+    input_dir = tmp_path / 'in'
+    input_dir.mkdir()
+    for minutes in range(0, 130, 10):
+        write_volume(input_dir, minutes, 1. + minutes / 60.)
+    files = snow_accumulation.list_volumes(input_dir)
+    event = snow_accumulation.event_key(input_dir)
+
+    snow_accumulation.accumulate(files, tmp_path / 'single')
+    checkpoint = tmp_path / 'resumed' / 'checkpoint.npz'
+    snow_accumulation.accumulate(files[:5], tmp_path / 'resumed', checkpoint=checkpoint, event=event)
+    snow_accumulation.accumulate(files, tmp_path / 'resumed', checkpoint=checkpoint, event=event)
+
+    for kind, stamp in [('hourly', '20220314.000000'), ('hourly', '20220314.010000'),
+                        ('daily', '20220314.000000'), ('event', '20220314.000000')]:
+        assert read_total(tmp_path / 'resumed', kind, stamp) == read_total(tmp_path / 'single', kind, stamp)
+
+
+def test_checkpoint_of_another_event(tmp_path):
+    input_dir = tmp_path / 'in'
+    input_dir.mkdir()
+    for minutes in (0, 10):
+        write_volume(input_dir, minutes, 1.)
+    files = snow_accumulation.list_volumes(input_dir)
+    checkpoint = tmp_path / 'out' / 'checkpoint.npz'
+    snow_accumulation.accumulate(files, tmp_path / 'out', checkpoint=checkpoint,
+                                 event=snow_accumulation.event_key(input_dir, '2022-03-14T00:00'))
+
+    other_event = snow_accumulation.event_key(input_dir, '2022-03-15T00:00')
+    with pytest.raises(ValueError, match='another event'):
+        snow_accumulation.accumulate(files, tmp_path / 'out', checkpoint=checkpoint, event=other_event)
@@ -0,0 +1,55 @@
+import numpy as np
+import pyart
+import xarray as xr
+
+import snow_rate
+
+
+def direct_rate(dbz, A, B, swe_ratio=snow_rate.DEFAULT_SWE_RATIO):
+    return swe_ratio * (10. ** (dbz / 10.) / A) ** (1. / B)
+
+
+def test_snow_rates_match_direct_inversion():
+    dbz = np.array([[-10., 0., 15.], [25., 35., 45.]])
+    rates = snow_rate.snow_rates(dbz, dtype='float64')
+    assert rates.shape == (len(snow_rate.ZS_RELATIONSHIPS),) + dbz.shape
+    for k, coefficients in enumerate(snow_rate.ZS_RELATIONSHIPS.values()):
+        np.testing.assert_allclose(rates[k], direct_rate(dbz, coefficients['A'], coefficients['B']), rtol=1e-12)
+
+    float32 = snow_rate.snow_rates(dbz)
+    assert float32.dtype == np.float32
+    np.testing.assert_allclose(float32, rates, rtol=1e-5)
+
+
+def test_snow_rates_masks_and_swe_ratio():
+    dbz = np.ma.masked_array([10., 20., np.nan], mask=[False, True, False])
+    rates = snow_rate.snow_rates(dbz, relationships={'test': {'A': 100., 'B': 2.}}, swe_ratio=10.)
+    np.testing.assert_array_equal(rates.mask, [[False, True, False]])
+    np.testing.assert_allclose(rates[0, 0], 10. * (10. / 100.) ** 0.5, rtol=1e-6)
+    assert np.isnan(rates[0, 2])
+
+    per_relationship = snow_rate.snow_rates(np.array([20.]), ['ws2012', 'ws88diw'], swe_ratio=[1., 2.])
+    np.testing.assert_allclose(per_relationship[:, 0], [direct_rate(20., 110., 2., 1.),
+                                                        direct_rate(20., 40., 2., 2.)], rtol=1e-6)
+
+
+def test_add_snow_fields():
+    radar = pyart.testing.make_empty_ppi_radar(5, 4, 1)
+    dbz = np.ma.masked_less(np.linspace(-5., 40., 20).reshape(4, 5), 0.)
+    radar.add_field('DBZ', {'data': dbz})
+    snow_rate.add_snow_fields(radar)
+    for name in snow_rate.CMAC_RELATIONSHIPS:
+        field = radar.fields[snow_rate.field_name(name)]
+        coefficients = snow_rate.ZS_RELATIONSHIPS[name]
+        assert (field['A'], field['B']) == (coefficients['A'], coefficients['B'])
+        np.testing.assert_array_equal(np.ma.getmaskarray(field['data']), dbz.mask)
+        np.testing.assert_allclose(field['data'], direct_rate(dbz, coefficients['A'], coefficients['B']),
+                                   rtol=1e-5)
+
+
+def test_add_snow_variables():
+    ds = xr.Dataset({'DBZ': (('y', 'x'), np.array([[10., np.nan], [20., 30.]]))})
+    snow_rate.add_snow_variables(ds, relationships=['m2009_1'])
+    expected = direct_rate(ds.DBZ.values, 67., 1.28)
+    np.testing.assert_allclose(ds.snow_rate_m2009_1.values, expected, rtol=1e-5)
+    assert ds.snow_rate_m2009_1.attrs['units'] == 'mm/h'
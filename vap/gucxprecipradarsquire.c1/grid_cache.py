@@ -0,0 +1,258 @@
+"""
+Cached gate-to-grid index maps for nearest-neighbor gridding of the CSU X-Band radar
+
+The scan strategy at S2 barely changes between volumes, so the KD-tree search done
+by pyart.map.grid_from_radars(weighting_function='Nearest') finds the same neighbors every time.
+Here the search is done once per scan geometry, the gate index and distance for each
+grid point are stored on disk, and every new volume is gridded with a single gather.
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pyart
+import xarray as xr
+from scipy.spatial import cKDTree
+
+import lowest_level
+import sail_geometry_cache
+
+# Directory holding the index maps between runs
+GRID_CACHE_DIR = Path(os.getenv("SQUIRE_GRID_CACHE", "cache/grid_index"))
+
+# Maximum drift in the scan geometry before the cached index map is rebuilt
+ANGLE_TOLERANCE = sail_geometry_cache.ANGLE_TOLERANCE  # degrees
+RANGE_TOLERANCE = sail_geometry_cache.RANGE_TOLERANCE  # meters
+
+# Index maps already loaded within this process, keyed by cache path
+_loaded_maps = {}
+
+
+def grid_coordinates(grid_shape, grid_limits):
+    """
+    Return the z, y, x coordinates of the grid points, matching pyart
+    """
+    return [np.linspace(limits[0], limits[1], points)
+            for points, limits in zip(grid_shape, grid_limits)]
+
+
+def scan_fingerprint(radar, grid_shape, grid_limits, roi):
+    """
+    Create a key describing the scan strategy and grid of a radar volume
+    """
+    return sail_geometry_cache.fingerprint(radar, [list(grid_shape),
+                                                   [list(limits) for limits in grid_limits],
+                                                   float(roi)])
+
+
+def build_index_map(radar, grid_shape, grid_limits, roi=250.):
+    """
+    Find the nearest radar gate within the radius of influence for each grid point
+
+    Returns a dictionary with the flat gate index (-1 where no gate is within
+    the radius of influence) and distance for each grid point, along with the
+    scan geometry used to check whether the map still applies to a new volume.
+    """
+    gate_points = np.column_stack([radar.gate_z['data'].ravel(),
+                                   radar.gate_y['data'].ravel(),
+                                   radar.gate_x['data'].ravel()])
+
+    z, y, x = grid_coordinates(grid_shape, grid_limits)
+    grid_z, grid_y, grid_x = np.meshgrid(z, y, x, indexing='ij')
+    grid_points = np.column_stack([grid_z.ravel(), grid_y.ravel(), grid_x.ravel()])
+
+    tree = cKDTree(gate_points)
+    distance, nearest = tree.query(grid_points, k=1, distance_upper_bound=roi)
+
+    # cKDTree flags missing neighbors with an infinite distance
+    found = np.isfinite(distance)
+    index = np.full(grid_points.shape[0], -1, dtype=np.int64)
+    index[found] = nearest[found]
+    distance = np.where(found, distance, np.nan)
+
+    return dict(sail_geometry_cache.scan_geometry(radar),
+                index=index.reshape(grid_shape),
+                distance=distance.astype(np.float32).reshape(grid_shape))
+
+
+def get_index_map(radar, grid_shape, grid_limits, roi=250.,
+                  cache_dir=GRID_CACHE_DIR,
+                  angle_tolerance=ANGLE_TOLERANCE,
+                  range_tolerance=RANGE_TOLERANCE):
+    """
+    Load the index map for this scan geometry, rebuilding it if missing or out of tolerance
+    """
+    fingerprint = scan_fingerprint(radar, grid_shape, grid_limits, roi)
+    return sail_geometry_cache.get_cached(Path(cache_dir) / f"grid_index_{fingerprint}.npz", _loaded_maps, radar,
+                                          lambda: build_index_map(radar, grid_shape, grid_limits, roi),
+                                          angle_tolerance, range_tolerance)
+
+
+def grid_from_index_map(radar, index_map, grid_shape, grid_limits, fields=None):
+    """
+    Grid a radar using a precomputed index map, returning a pyart Grid
+
+    The output matches pyart.map.grid_from_radars(weighting_function='Nearest') up to
+    equidistant ties, where the two may pick different gates; grid points
+    without a gate inside the radius of influence, or whose nearest gate is
+    masked, are masked.
+    """
+    if fields is None:
+        fields = list(radar.fields.keys())
+
+    flat_index = index_map['index'].ravel()
+    has_gate = flat_index >= 0
+    gates = flat_index[has_gate]
+
+    grid_fields = {}
+    for field in fields:
+        radar_field = radar.fields[field]
+        gate_values = np.ma.getdata(radar_field['data']).ravel()
+        gate_mask = np.ma.getmaskarray(radar_field['data']).ravel()
+
+        values = np.zeros(flat_index.shape, dtype=np.float32)
+        mask = np.ones(flat_index.shape, dtype=bool)
+        values[has_gate] = gate_values[gates]
+        mask[has_gate] = gate_mask[gates]
+
+        grid_field = {key: value for key, value in radar_field.items() if key != 'data'}
+        grid_field['_FillValue'] = pyart.config.get_fillvalue()
+        grid_field['data'] = np.ma.masked_array(values.reshape(grid_shape),
+                                                mask.reshape(grid_shape))
+        grid_fields[field] = grid_field
+
+    return _create_grid(radar, grid_fields, grid_shape, grid_limits)
+
+
+def grid_to_dataset(grid, fields=None):
+    """
+    Wrap selected fields of a pyart Grid in an xarray Dataset without copying them
+
+    Unlike Grid.to_xarray, which fills a new array for every field, each field
+    here shares the buffer of the gridded masked array: masked points are set
+    to the field's fill value in place, and xarray turns them into NaN lazily,
+    only for the parts of the dataset that are read. The coordinates are those
+    of grid_lowest_level (time, z, y, x, lat and lon), with a numpy datetime.
+    """
+    if fields is None:
+        fields = list(grid.fields.keys())
+
+    lon, lat = grid.get_point_longitude_latitude()
+    time = pyart.util.datetime_from_grid(grid,
+                                         only_use_cftime_datetimes=False,
+                                         only_use_python_datetimes=True)
+    coords = {'time': ('time', [np.datetime64(time)]),
+              'z': ('z', grid.z['data'], pyart.config.get_metadata('z')),
+              'y': ('y', grid.y['data'], pyart.config.get_metadata('y')),
+              'x': ('x', grid.x['data'], pyart.config.get_metadata('x')),
+              'lat': (('y', 'x'), lat),
+              'lon': (('y', 'x'), lon)}
+
+    data_vars = {}
+    for field in fields:
+        grid_field = grid.fields[field]
+        data = grid_field['data']
+        attrs = {key: value for key, value in grid_field.items() if key not in ['data', 'coordinates']}
+        if np.ma.isMaskedArray(data):
+            fill_value = attrs.setdefault('_FillValue', pyart.config.get_fillvalue())
+            values = np.ma.getdata(data)
+            np.copyto(values, fill_value, where=np.ma.getmaskarray(data), casting='unsafe')
+        else:
+            attrs.pop('_FillValue', None)
+            values = data
+        data_vars[field] = (('time', 'z', 'y', 'x'), values[np.newaxis], attrs)
+
+    ds = xr.decode_cf(xr.Dataset(data_vars, coords=coords),
+                      decode_times=False, decode_coords=False, decode_timedelta=False)
+    # Output encodings come from the DOD, not from the gridding fill value
+    for variable in ds.variables.values():
+        variable.encoding = {}
+    return ds
+
+
+def lowest_level_from_index_map(radar, index_map, fields, reference, use_numba=False):
+    """
+    Map gates straight to the lowest valid grid level of each column
+
+    Instead of gridding every field on every level, only the validity of the
+    reference field is checked on the (z, y, x) index map; the remaining fields
+    are gathered from the radar gates at the selected level alone.
+
+    Returns
+    -------
+    level_index : array
+        (y, x) index of the lowest grid level with a valid reference gate.
+    has_valid : array
+        (y, x) flag marking columns with at least one valid level.
+    lowest : dict
+        Mapping of field name to (y, x) float32 values, NaN where missing.
+    """
+    index = index_map['index']
+    has_gate = index >= 0
+
+    reference_data = radar.fields[reference]['data']
+    gate_valid = (~np.ma.getmaskarray(reference_data).ravel() &
+                  np.isfinite(np.ma.getdata(reference_data).ravel()))
+    valid = has_gate & gate_valid[np.where(has_gate, index, 0)]
+
+    level_index, has_valid = lowest_level.first_valid_level(valid, use_numba=use_numba)
+
+    # Gate feeding each column at the selected level
+    column_gate = np.take_along_axis(index, level_index[np.newaxis], axis=0)[0]
+    column_has_gate = column_gate >= 0
+    column_gate = np.where(column_has_gate, column_gate, 0)
+
+    lowest = {}
+    for field in fields:
+        data = radar.fields[field]['data']
+        values = np.ma.getdata(data).ravel()[column_gate].astype(np.float32)
+        missing = np.ma.getmaskarray(data).ravel()[column_gate] | ~column_has_gate
+        values[missing] = np.nan
+        lowest[field] = values
+
+    return level_index, has_valid, lowest
+
+
+def _create_grid(radar, fields, grid_shape, grid_limits):
+    """
+    Wrap gridded fields in a pyart Grid, using the radar as the grid origin
+    """
+    get_metadata = pyart.config.get_metadata
+
+    time = get_metadata('grid_time')
+    time['data'] = np.array([radar.time['data'][0]])
+    time['units'] = radar.time['units']
+
+    origin_latitude = get_metadata('origin_latitude')
+    origin_latitude['data'] = radar.latitude['data']
+    origin_longitude = get_metadata('origin_longitude')
+    origin_longitude['data'] = radar.longitude['data']
+    origin_altitude = get_metadata('origin_altitude')
+    origin_altitude['data'] = radar.altitude['data']
+
+    z_coords, y_coords, x_coords = grid_coordinates(grid_shape, grid_limits)
+    x = get_metadata('x')
+    x['data'] = x_coords
+    y = get_metadata('y')
+    y['data'] = y_coords
+    z = get_metadata('z')
+    z['data'] = z_coords
+
+    radar_latitude = get_metadata('radar_latitude')
+    radar_latitude['data'] = radar.latitude['data']
+    radar_longitude = get_metadata('radar_longitude')
+    radar_longitude['data'] = radar.longitude['data']
+    radar_altitude = get_metadata('radar_altitude')
+    radar_altitude['data'] = radar.altitude['data']
+    radar_time = get_metadata('radar_time')
+    radar_time['data'] = np.array([radar.time['data'][0]])
+    radar_time['units'] = radar.time['units']
+
+    return pyart.core.Grid(time, fields, dict(radar.metadata),
+                           origin_latitude, origin_longitude, origin_altitude,
+                           x, y, z,
+                           radar_latitude=radar_latitude,
+                           radar_longitude=radar_longitude,
+                           radar_altitude=radar_altitude,
+                           radar_time=radar_time)
@@ -0,0 +1,175 @@
+"""
+Lowest valid vertical level extraction for gridded radar fields
+
+Finds the first level (from the bottom of the grid) holding a valid value in each
+column with one pass over a boolean mask, then gathers every requested field at
+that level into 2-D outputs. Works on plain (z, y, x) arrays, so it can be used on
+the output of grid_radar or directly on pyart Grid fields.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _as_float(field):
+    """
+    Return a field as a floating point array with masked values set to NaN
+    """
+    field = np.asanyarray(field)
+    if not np.issubdtype(field.dtype, np.floating):
+        field = field.astype(np.result_type(field.dtype, np.float32))
+    return np.ma.filled(field, np.nan) if np.ma.isMaskedArray(field) else field
+
+
+def _first_valid_level_numpy(valid):
+    """
+    Index of the first True along the leading axis, and whether any exists
+    """
+    # argmax on a boolean array stops at the first True for each column
+    level_index = valid.argmax(axis=0)
+    has_valid = np.take_along_axis(valid, level_index[np.newaxis], axis=0)[0]
+    return level_index, has_valid
+
+
+def _gather_numpy(field, level_index, out):
+    """
+    Copy field[level_index[j, i], j, i] into out
+    """
+    out[...] = np.take_along_axis(field, level_index[np.newaxis], axis=0)[0]
+    return out
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _first_valid_level_numba(valid):
+        nz, ny, nx = valid.shape
+        level_index = np.zeros((ny, nx), dtype=np.int64)
+        has_valid = np.zeros((ny, nx), dtype=np.bool_)
+        for j in range(ny):
+            for i in range(nx):
+                # Walk up the column and stop at the first valid level
+                for k in range(nz):
+                    if valid[k, j, i]:
+                        level_index[j, i] = k
+                        has_valid[j, i] = True
+                        break
+        return level_index, has_valid
+
+    @numba.njit(cache=True)
+    def _gather_numba(field, level_index, out):
+        ny, nx = level_index.shape
+        for j in range(ny):
+            for i in range(nx):
+                out[j, i] = field[level_index[j, i], j, i]
+        return out
+
+
+def first_valid_level(reference, use_numba=False):
+    """
+    Find the lowest level holding a valid value in each column
+
+    Parameters
+    ----------
+    reference : array
+        (z, y, x) array used to decide validity. NaN and masked values are
+        invalid; a boolean array is used as the validity mask directly.
+    use_numba : bool
+        Use the compiled kernel, which stops each column at its first valid
+        level. Falls back to NumPy when Numba is not installed.
+
+    Returns
+    -------
+    level_index : array
+        (y, x) index of the lowest valid level; 0 for columns without data.
+    has_valid : array
+        (y, x) boolean flag marking columns with at least one valid level.
+    """
+    if reference.dtype == bool:
+        valid = np.asarray(reference)
+    else:
+        valid = ~np.isnan(_as_float(reference))
+
+    if use_numba and numba is not None:
+        return _first_valid_level_numba(np.ascontiguousarray(valid))
+    return _first_valid_level_numpy(valid)
+
+
+def gather_lowest_level(fields, level_index, has_valid=None, out=None, use_numba=False):
+    """
+    Gather each field at the given level index
+
+    Parameters
+    ----------
+    fields : dict
+        Mapping of field name to (z, y, x) array.
+    level_index : array
+        (y, x) level index from first_valid_level.
+    has_valid : array, optional
+        (y, x) flag from first_valid_level; columns without data are set to NaN.
+    out : dict, optional
+        Preallocated (y, x) arrays to write into, keyed by field name.
+    use_numba : bool
+        Use the compiled gather kernel when Numba is installed.
+
+    Returns
+    -------
+    out : dict
+        Mapping of field name to the (y, x) values at the lowest valid level.
+    """
+    if out is None:
+        out = {}
+
+    for name, field in fields.items():
+        data = _as_float(field)
+        if name not in out:
+            out[name] = np.empty(level_index.shape, dtype=data.dtype)
+
+        if use_numba and numba is not None:
+            _gather_numba(data, level_index, out[name])
+        else:
+            _gather_numpy(data, level_index, out[name])
+
+        if has_valid is not None:
+            out[name][~has_valid] = np.nan
+
+    return out
+
+
+def lowest_valid_level(fields, reference, heights=None, fill_height=None, use_numba=False):
+    """
+    Subset a set of gridded fields to the lowest level with valid data in each column
+
+    Parameters
+    ----------
+    fields : dict
+        Mapping of field name to (z, y, x) array.
+    reference : str or array
+        Field name (or (z, y, x) array) used to decide which levels are valid.
+    heights : array, optional
+        1-D level heights; when given, a 'lowest_height' field is added.
+    fill_height : float, optional
+        Height reported for columns without valid data. NaN if not given.
+    use_numba : bool
+        Use the compiled kernels when Numba is installed.
+
+    Returns
+    -------
+    out : dict
+        Mapping of field name to (y, x) values at the lowest valid level.
+    """
+    if isinstance(reference, str):
+        reference = fields[reference]
+
+    level_index, has_valid = first_valid_level(reference, use_numba=use_numba)
+    out = gather_lowest_level(fields, level_index, has_valid, use_numba=use_numba)
+
+    if heights is not None:
+        lowest_height = np.asarray(heights, dtype=np.float64)[level_index]
+        lowest_height[~has_valid] = np.nan if fill_height is None else fill_height
+        out['lowest_height'] = lowest_height
+
+    return out
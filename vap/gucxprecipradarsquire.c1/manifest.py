@@ -0,0 +1,116 @@
+"""
+SQLite manifest of the SQUIRE processing state for each input file
+
+Each row records the input file, its size and modification time, the output
+path, the status of the last attempt, its error and timings, and the number of
+failures in a row since the input last changed or was last processed. Only the process
+scheduling the work writes to the manifest, so no locking between workers is
+needed.
+"""
+
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    input_path TEXT PRIMARY KEY,
+    input_size INTEGER,
+    input_mtime_ns INTEGER,
+    output_path TEXT,
+    status TEXT,
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
+    started REAL,
+    finished REAL,
+    duration REAL
+)
+"""
+
+UPSERT = """
+INSERT INTO files (input_path, input_size, input_mtime_ns, output_path, status,
+                   attempts, error, started, finished, duration)
+VALUES (:input_path, :input_size, :input_mtime_ns, :output_path, :status,
+        CASE WHEN :status = 'done' THEN 0 ELSE 1 END, :error, :started, :finished, :duration)
+ON CONFLICT(input_path) DO UPDATE SET
+    attempts = CASE WHEN excluded.status = 'done' THEN 0
+                    WHEN files.status = 'failed'
+                     AND files.input_size = excluded.input_size
+                     AND files.input_mtime_ns = excluded.input_mtime_ns
+                    THEN files.attempts + 1 ELSE 1 END,
+    input_size = excluded.input_size,
+    input_mtime_ns = excluded.input_mtime_ns,
+    output_path = excluded.output_path,
+    status = excluded.status,
+    error = excluded.error,
+    started = excluded.started,
+    finished = excluded.finished,
+    duration = excluded.duration
+"""
+
+
+def open_manifest(path):
+    """
+    Open (creating if needed) the manifest database
+    """
+    conn = sqlite3.connect(str(path), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    conn.commit()
+    return conn
+
+
+def file_signature(path):
+    """
+    Return the (size, mtime in ns) used to detect changed input files
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def pending_files(conn, files, max_attempts=3):
+    """
+    Return the input files that still need to be processed
+
+    A file is skipped when its last run succeeded, the input has not changed
+    since and the output still exists, or when it has already failed
+    max_attempts times in a row without the input changing.
+    """
+    rows = {row[0]: row[1:] for row in conn.execute(
+        "SELECT input_path, input_size, input_mtime_ns, output_path, status, attempts FROM files")}
+
+    pending = []
+    for file in files:
+        if file not in rows:
+            pending.append(file)
+            continue
+
+        size, mtime_ns, output_path, status, attempts = rows[file]
+        if (size, mtime_ns) != file_signature(file):
+            pending.append(file)
+        elif status == 'done' and output_path and os.path.exists(output_path):
+            continue
+        elif status == 'failed' and attempts >= max_attempts:
+            continue
+        else:
+            pending.append(file)
+    return pending
+
+
+def record_result(conn, result, signature):
+    """
+    Store the outcome of processing a file, returning the number of failures in a row
+
+    A success resets the count, as does a change of the input file.
+    """
+    row = dict(result, input_size=signature[0], input_mtime_ns=signature[1])
+    conn.execute(UPSERT, row)
+    conn.commit()
+    return conn.execute("SELECT attempts FROM files WHERE input_path = ?",
+                        (result['input_path'],)).fetchone()[0]
+
+
+def summarize(conn):
+    """
+    Count the files in the manifest by status
+    """
+    return dict(conn.execute("SELECT status, COUNT(*) FROM files GROUP BY status"))
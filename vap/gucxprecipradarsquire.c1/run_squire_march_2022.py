@@ -1,17 +1,42 @@
 #!/usr/bin/python
 
+import argparse
+import itertools
+import sys
+import time
+
 import pyart
 import matplotlib.pyplot as plt
 import numpy as np
 import glob
 import xarray as xr
 from pathlib import Path
-from distributed import Client, LocalCluster, wait
+from distributed import Client, LocalCluster, Lock, as_completed, wait
 import dask
-import act
 import gc
 import matplotlib as mpl
-import dask.bag as db
+
+# The DOD and other shared SAIL helpers live in the top-level scripts directory
+sys.path.append(str(Path(__file__).resolve().parents[2] / "scripts"))
+import sail_beam_blockage
+import sail_dod
+import sail_io
+import sail_output
+import sail_site_index
+import sail_telemetry
+
+import grid_cache
+import lowest_level
+import manifest
+import snow_rate
+
+# Datastream of the SQUIRE output files
+DATASTREAM = 'xprecipradarsquire.c1'
+
+# Fields of the CMAC files used by SQUIRE; the first snow field is the reference
+# for the lowest valid level
+SQUIRE_FIELDS = ([snow_rate.field_name(name) for name in snow_rate.CMAC_RELATIONSHIPS] +
+                 ['corrected_reflectivity', 'DBZ', 'rain_rate_A', 'gate_id'])
 
 def compute_number_of_points(extent, resolution):
     """
@@ -19,124 +44,473 @@ def compute_number_of_points(extent, resolution):
     """
     return int((extent[1] - extent[0])/resolution) + 1
 
+@sail_telemetry.timed('blockage')
+def mask_terrain_blockage(radar, dem_file):
+    """
+    Mask the gates blocked by terrain, using the cached blockage map of the scan strategy
+    """
+    blockage = sail_beam_blockage.get_beam_blockage(radar, dem_file)
+    return sail_beam_blockage.mask_blocked_gates(radar, blockage)
+
 def grid_radar(file,
                x_grid_limits=(-20_000.,20_000.),
                y_grid_limits=(-20_000.,20_000.),
                z_grid_limits = (500.,5_000.),
                grid_resolution = 250,
-
+               use_cache=True,
+               dem_file=None,
+               fields=None,
                ):
     """
     Grid the radar using some provided parameters
+
+    With use_cache, the nearest-neighbor lookup is read from the on-disk
+    gate-to-grid index cache instead of rebuilding the KD-tree each volume.
+    With dem_file, gates blocked by terrain are masked before gridding.
+    With fields (e.g. SQUIRE_FIELDS), only those of the fields in the file are
+    read (as float32) and gridded, and they are wrapped in the dataset without
+    copies (grid_cache.grid_to_dataset) instead of through grid.to_xarray().
     """
 
     try:
-        radar = pyart.io.read(file)
+        with sail_telemetry.stage('read'):
+            if fields is not None:
+                radar = sail_io.read_radar(file, fields, dtype='float32')
+            else:
+                radar = pyart.io.read(file)
     except KeyError:
         print('Issue with reading latitude for ', file)
+        raise
 
+    if dem_file is not None:
+        mask_terrain_blockage(radar, dem_file)
 
     x_grid_points = compute_number_of_points(x_grid_limits, grid_resolution)
     y_grid_points = compute_number_of_points(y_grid_limits, grid_resolution)
     z_grid_points = compute_number_of_points(z_grid_limits, grid_resolution)
 
-    grid = pyart.map.grid_from_radars(radar,
-                                      grid_shape=(z_grid_points,
-                                                  y_grid_points,
-                                                  x_grid_points),
-                                      grid_limits=(z_grid_limits,
-                                                   y_grid_limits,
-                                                   x_grid_limits),
-                                      method='nearest',
-                                      constant_roi=250,
-                                     )
+    grid_shape = (z_grid_points, y_grid_points, x_grid_points)
+    grid_limits = (z_grid_limits, y_grid_limits, x_grid_limits)
+
+    if fields is not None:
+        fields = [field for field in fields if field in radar.fields]
+
+    with sail_telemetry.stage('grid'):
+        if use_cache:
+            index_map = grid_cache.get_index_map(radar, grid_shape, grid_limits, roi=250)
+            grid = grid_cache.grid_from_index_map(radar, index_map, grid_shape, grid_limits, fields=fields)
+        else:
+            grid = pyart.map.grid_from_radars(radar,
+                                              grid_shape=grid_shape,
+                                              grid_limits=grid_limits,
+                                              weighting_function='Nearest',
+                                              constant_roi=250,
+                                              fields=fields,
+                                             )
+        if fields is not None:
+            ds = grid_cache.grid_to_dataset(grid, fields)
+        else:
+            ds = grid.to_xarray()
+            # Py-ART stores the grid time as a cftime date; use a numpy datetime, as
+            # grid_lowest_level does, so the DOD time encoding applies when writing
+            time = pyart.util.datetime_from_radar(radar,
+                                                  only_use_cftime_datetimes=False,
+                                                  only_use_python_datetimes=True)
+            ds['time'] = ('time', [np.datetime64(time)], ds['time'].attrs)
     del radar
-    return grid.to_xarray()
+    return ds
 
 
-def subset_lowest_vertical_level(ds, additional_fields=["corrected_reflectivity"]):
+@sail_telemetry.timed('lowest_level')
+def subset_lowest_vertical_level(ds, additional_fields=["corrected_reflectivity"], use_numba=False,
+                                 snow_relationships=None, reflectivity_field='DBZ',
+                                 swe_ratio=snow_rate.DEFAULT_SWE_RATIO):
     """
     Filter the dataset based on the lowest vertical level
+
+    The lowest level with a valid value of the first snow field is found for each
+    column with a single pass over its validity mask, and every subset field is
+    gathered at that level without building any extra (z, y, x) temporaries.
+
+    With snow_relationships (names from snow_rate.ZS_RELATIONSHIPS), the snow
+    fields are not read from the grid: the lowest level is found from the
+    reflectivity, and every snow_rate_<name> field is computed from it in one call.
     """
-    snow_fields = [var for var in list(ds.variables) if "snow" in var] + additional_fields
+    if snow_relationships is None:
+        snow_fields = [var for var in list(ds.variables) if "snow" in var] + additional_fields
+        reference_field = snow_fields[0]
+    else:
+        snow_fields = additional_fields
+        reference_field = reflectivity_field
+    subset_fields = list(dict.fromkeys(snow_fields + [reflectivity_field, 'DBZ', 'rain_rate_A',
+                                                      'corrected_reflectivity', 'gate_id']))
 
-    # Create a new 4-d height field
-    ds["lowest_height"] = (ds.z * (ds[snow_fields[0]]/ds[snow_fields[0]])).fillna(5_000)
+    # Find the lowest valid level for each column, for each time in the dataset
+    heights = ds.z.values
+    subset = {name: [] for name in subset_fields + ['lowest_height', 'z']}
+    attrs = {name: ds[name].attrs for name in subset_fields if name in ds}
+    for time_index in range(ds.sizes['time']):
+        volume = ds.isel(time=time_index)
+        level_index, has_valid = lowest_level.first_valid_level(volume[reference_field].values,
+                                                                use_numba=use_numba)
+        lowest = lowest_level.gather_lowest_level({name: volume[name].values for name in subset_fields},
+                                                  level_index,
+                                                  use_numba=use_numba)
+        if snow_relationships is not None:
+            rates = snow_rate.snow_rates(lowest[reflectivity_field], snow_relationships, swe_ratio,
+                                         dtype=lowest[reflectivity_field].dtype)
+            names, A, B, swe = snow_rate.coefficients(snow_relationships, swe_ratio)
+            for k, name in enumerate(names):
+                lowest[snow_rate.field_name(name)] = rates[k]
+                attrs[snow_rate.field_name(name)] = snow_rate.snow_rate_attrs(name, A[k], B[k], swe[k])
+                subset.setdefault(snow_rate.field_name(name), [])
+        for name in lowest:
+            subset[name].append(lowest[name])
 
-    # Find the minimum height index
-    min_index = ds.lowest_height.argmin(dim='z',
-                                        skipna=True)
+        # Columns without valid data report the top of the search (5 km)
+        subset['z'].append(heights[level_index])
+        subset['lowest_height'].append(np.where(has_valid, heights[level_index], 5_000))
 
-    # Subset our snow fields based on this new index and the lowest height + reflectivity
-    subset_ds = ds[snow_fields + ['lowest_height', 'DBZ', 'rain_rate_A', 'corrected_reflectivity', 'gate_id']].isel(z=min_index)
+    # Keep the horizontal coordinates (time, y, x, lat, lon) of the gridded dataset
+    coords = {name: coord for name, coord in ds.coords.items() if 'z' not in coord.dims}
+    coords['z'] = (('time', 'y', 'x'), np.stack(subset.pop('z')), ds.z.attrs)
+    subset_ds = xr.Dataset({name: (('time', 'y', 'x'), np.stack(values), attrs.get(name, {}))
+                            for name, values in subset.items()},
+                           coords=coords)
 
-    ds["lowest_height"] = ds.lowest_height.where(ds.lowest_height < 10_000, other=np.nan)
     ds.close()
     del ds
 
     return subset_ds
 
 
-def setup_output_dataset(ds, datastream='xprecipradarsquire.c1', preload_dod=True):
-    dims = {'time':1, 'x':ds.y.shape[0], 'y':ds.x.shape[0]}
-    if not preload_dod:
-        out_ds = act.io.create_obj_from_arm_dod(datastream, set_dims=dims, version='1.0')
-        out_ds.to_netcdf('xprecipradarsquire.c1.dod.nc')
+def grid_lowest_level(file,
+                      x_grid_limits=(-20_000.,20_000.),
+                      y_grid_limits=(-20_000.,20_000.),
+                      z_grid_limits = (500.,5_000.),
+                      grid_resolution = 250,
+                      additional_fields=["corrected_reflectivity"],
+                      use_numba=False,
+                      dem_file=None,
+                      ):
+    """
+    Grid the radar straight to the lowest valid level of each column
+
+    This "surface-only" mode produces the same dataset as running
+    subset_lowest_vertical_level on the output of grid_radar, without
+    gridding the full volume first. Only the fields used by SQUIRE are read,
+    as float32.
+    """
+    with sail_telemetry.stage('read'):
+        radar = sail_io.read_radar(file, SQUIRE_FIELDS + list(additional_fields), dtype='float32')
+    if dem_file is not None:
+        mask_terrain_blockage(radar, dem_file)
+
+    x_grid_points = compute_number_of_points(x_grid_limits, grid_resolution)
+    y_grid_points = compute_number_of_points(y_grid_limits, grid_resolution)
+    z_grid_points = compute_number_of_points(z_grid_limits, grid_resolution)
+
+    grid_shape = (z_grid_points, y_grid_points, x_grid_points)
+    grid_limits = (z_grid_limits, y_grid_limits, x_grid_limits)
+    z, y, x = grid_cache.grid_coordinates(grid_shape, grid_limits)
+
+    snow_fields = [field for field in radar.fields if "snow" in field] + additional_fields
+    subset_fields = list(dict.fromkeys(snow_fields + ['DBZ', 'rain_rate_A', 'corrected_reflectivity', 'gate_id']))
+
+    # Walk each column up from the lowest level, stopping at the first valid snow gate
+    with sail_telemetry.stage('grid'):
+        index_map = grid_cache.get_index_map(radar, grid_shape, grid_limits, roi=250)
+        level_index, has_valid, lowest = grid_cache.lowest_level_from_index_map(radar,
+                                                                                index_map,
+                                                                                subset_fields,
+                                                                                snow_fields[0],
+                                                                                use_numba=use_numba)
+
+    # Columns without valid data report the top of the search, as in subset_lowest_vertical_level
+    lowest['lowest_height'] = np.where(has_valid, z[level_index], z_grid_limits[1])
+
+    # Match the coordinates of grid.to_xarray() after subsetting
+    lon, lat = pyart.core.cartesian_to_geographic_aeqd(*np.meshgrid(x, y),
+                                                       radar.longitude['data'][0],
+                                                       radar.latitude['data'][0])
+    time = pyart.util.datetime_from_radar(radar,
+                                          only_use_cftime_datetimes=False,
+                                          only_use_python_datetimes=True)
+    coords = {'time': ('time', [np.datetime64(time)]),
+              'y': ('y', y, pyart.config.get_metadata('y')),
+              'x': ('x', x, pyart.config.get_metadata('x')),
+              'lat': (('y', 'x'), lat),
+              'lon': (('y', 'x'), lon),
+              'z': (('time', 'y', 'x'), z[level_index][np.newaxis], pyart.config.get_metadata('z'))}
+
+    data_vars = {}
+    for name, values in lowest.items():
+        attrs = {key: value for key, value in radar.fields.get(name, {}).items()
+                 if key not in ['data', '_FillValue', 'coordinates']}
+        data_vars[name] = (('time', 'y', 'x'), values[np.newaxis], attrs)
+
+    del radar
+    return xr.Dataset(data_vars, coords=coords)
+
+
+@sail_telemetry.timed('conform')
+def setup_output_dataset(ds, datastream=DATASTREAM, preload_dod=True):
+    """
+    Make the dataset compliant with the DOD of the datastream
+
+    The DOD is loaded once per worker process; with preload_dod it is read
+    from the file bundled in data/meta, otherwise from the ARM DOD service.
+    """
+    if preload_dod:
+        schema = sail_dod.load_dod(datastream)
     else:
-        out_ds = xr.open_dataset('xprecipradarsquire.c1.dod.nc')
-    # Create an empty dataset to write to
-    new_ds = xr.Dataset()
-    for variable in out_ds.variables:
-        new_ds[variable] = ds[variable]
-        new_ds[variable].attrs = out_ds[variable].attrs
-
-    # Make sure the attributes match
-    new_ds.attrs = out_ds.attrs
+        dims = (('time', 1), ('x', ds.x.shape[0]), ('y', ds.y.shape[0]))
+        schema = sail_dod.load_dod_from_arm(datastream, dims)
+
+    new_ds = sail_dod.apply_dod(ds, schema)
     ds.close()
-    out_ds.close()
-    del out_ds
     del ds
     return new_ds
 
-def run_squire(file):
+def run_squire(file, out_dir="data", surface_only=True, store=None, store_lock=None, dem_file=None):
     """
-    Runs the SQUIRE workflow
+    Runs the SQUIRE workflow, returning the path of the output file
+
+    With surface_only, gates are mapped straight to the lowest valid level of
+    each column instead of gridding and then subsetting the full volume. With
+    store, the volume is also appended to that monthly Zarr store, holding
+    store_lock while writing. With dem_file, gates blocked by terrain are
+    masked first.
     """
 
     # Read the file, and grid to a cartesian grid
-    try:
-        ds = grid_radar(file)
+    if surface_only:
+        ds = grid_lowest_level(file, dem_file=dem_file)
+        out_ds = ds
+    else:
+        ds = grid_radar(file, dem_file=dem_file, fields=SQUIRE_FIELDS)
 
         # Subset the lowest vertical level
         out_ds = subset_lowest_vertical_level(ds)
 
-        # Make sure the dataset is compliant to metadata standards
-        compliant_ds = setup_output_dataset(out_ds)
+    # Make sure the dataset is compliant to metadata standards
+    compliant_ds = setup_output_dataset(out_ds)
+
+    # Create an output path
+    out_path = f"{out_dir}/{Path(file).stem}.gridded.nc"
 
-        # Create an output path
-        out_path = f"data/{Path(file).stem}.gridded.nc"
+    # Write the dataset to a compressed netcdf file, encoded as the DOD specifies
+    encoding = sail_output.output_encoding(compliant_ds, sail_dod.load_dod(DATASTREAM),
+                                           sail_output.OUTPUT_CHUNKS[DATASTREAM])
+    with sail_telemetry.stage('write'):
+        sail_output.write_netcdf(compliant_ds, out_path, encoding)
+    if store is not None:
+        with sail_telemetry.stage('store'):
+            sail_output.append_to_store(compliant_ds, store, encoding, lock=store_lock)
 
-        # Write the dataset to a netcdf file in the specified directory
-        compliant_ds.to_netcdf(out_path)
+    # Close and delete everything
+    compliant_ds.close()
+
+    del ds
+    del out_ds
+    del compliant_ds
+    gc.collect()
 
-        # Close and delete everything
-        compliant_ds.close()
+    return out_path
 
-        del ds
-        del out_ds
-        del compliant_ds
-        gc.collect()
+def process_file(file, out_dir="data", store=None, dem_file=None, sites=None):
+    """
+    Run SQUIRE on a single file, capturing the outcome and timings for the manifest
 
-    except:
-        pass
+    With telemetry configured, the stages of the file are also logged. With
+    sites (from sail_site_index.read_kml_sites), the output is also sampled at
+    the sites, for the site index.
+    """
+    result = {'input_path': file,
+              'output_path': None,
+              'status': 'done',
+              'error': None,
+              'started': time.time()}
+    try:
+        # Workers appending to the same store take turns through a cluster-wide lock
+        store_lock = Lock(f"squire-store-{store}") if store is not None else None
+        with sail_telemetry.file_record(file, 'squire'):
+            result['output_path'] = run_squire(file, out_dir, store=store, store_lock=store_lock,
+                                               dem_file=dem_file)
+            if sites is not None:
+                with sail_telemetry.stage('sites'):
+                    result['site_sample'] = sail_site_index.sample_file(result['output_path'], sites)
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = f"{type(error).__name__}: {error}"
+    result['finished'] = time.time()
+    result['duration'] = result['finished'] - result['started']
+    return result
+
+def run_files(client, files, out_dir, manifest_path, max_in_flight=40, max_attempts=3, store=None,
+              dem_file=None, site_index=None):
+    """
+    Process files on the cluster, skipping finished work recorded in the manifest
+
+    At most max_in_flight files are submitted at once; a new file is submitted
+    as each one finishes, and failures are resubmitted until max_attempts.
+    With site_index, the values of each output at the KML sites are stored in
+    that SQLite database (see sail_site_index).
+    """
+    conn = manifest.open_manifest(manifest_path)
+    site_conn = sail_site_index.open_index(site_index) if site_index is not None else None
+    sites = sail_site_index.read_kml_sites() if site_index is not None else None
+    todo = manifest.pending_files(conn, files, max_attempts=max_attempts)
+    print(f"{len(todo)} of {len(files)} files to process")
+
+    queue = iter(todo)
+    in_flight = {}
+    signatures = {}
+    completed = as_completed()
+
+    def submit(file):
+        signatures[file] = manifest.file_signature(file)
+        future = client.submit(process_file, file, out_dir, store=store, dem_file=dem_file, sites=sites,
+                               pure=False)
+        in_flight[future] = file
+        completed.add(future)
+
+    for file in itertools.islice(queue, max_in_flight):
+        submit(file)
+
+    for future in completed:
+        file = in_flight.pop(future)
+        try:
+            result = future.result()
+        except Exception as error:
+            # The worker itself died (e.g. out of memory); record it like any other failure
+            now = time.time()
+            result = {'input_path': file, 'output_path': None, 'status': 'failed',
+                      'error': f"{type(error).__name__}: {error}",
+                      'started': now, 'finished': now, 'duration': 0.}
+
+        attempts = manifest.record_result(conn, result, signatures.pop(file))
+        if result.get('site_sample') is not None:
+            try:
+                sail_site_index.store_sample(site_conn, result['site_sample'])
+            except Exception as error:
+                # The output is done; its samples can be added later with sail_site_index.py --files
+                site_conn.rollback()
+                print('FAILURE storing site samples', file, f"{type(error).__name__}: {error}")
+        if result['status'] == 'failed':
+            print('FAILURE', file, result['error'])
+            if attempts < max_attempts:
+                submit(file)
+                continue
+
+        next_file = next(queue, None)
+        if next_file is not None:
+            submit(next_file)
+
+    print(manifest.summarize(conn))
+    conn.close()
+    if site_conn is not None:
+        site_conn.close()
 
 if __name__ == "__main__":
-    cluster = LocalCluster(n_workers=20, processes=True, threads_per_worker=1)
-    files = sorted(glob.glob("/gpfs/wolf/atm124/proj-shared/gucxprecipradarcmacS2.c1/ppi/202203/gucxprecipradarcmacS2.c1.202203*"))
-    with Client(cluster) as c:
+    parser = argparse.ArgumentParser(
+            description="Creation of SQUIRE files for SAIL")
+
+    parser.add_argument("--month",
+                        default="202203",
+                        dest='month',
+                        type=str,
+                        help="Month to process in YYYYMM format"
+    )
+    parser.add_argument("--out-dir",
+                        default="data",
+                        dest='out_dir',
+                        type=str,
+                        help="Directory to write the SQUIRE files to"
+    )
+    parser.add_argument("--manifest",
+                        default=None,
+                        dest='manifest',
+                        type=str,
+                        help="Manifest database (default: <out-dir>/squire_manifest_<month>.sqlite)"
+    )
+    parser.add_argument("--workers",
+                        default=20,
+                        dest='workers',
+                        type=int,
+                        help="Number of Dask workers"
+    )
+    parser.add_argument("--max-in-flight",
+                        default=40,
+                        dest='max_in_flight',
+                        type=int,
+                        help="Maximum number of files submitted at once"
+    )
+    parser.add_argument("--append-store",
+                        default=False,
+                        dest='append_store',
+                        action='store_true',
+                        help="Append each volume to <out-dir>/squire_<month>.zarr as it is processed"
+    )
+    parser.add_argument("--zarr",
+                        default=False,
+                        dest='zarr',
+                        action='store_true',
+                        help="Also combine the month into <out-dir>/squire_<month>_combined.zarr"
+    )
+    parser.add_argument("--max-attempts",
+                        default=3,
+                        dest='max_attempts',
+                        type=int,
+                        help="Number of times a failing file is attempted"
+    )
+    parser.add_argument("--dem",
+                        default=None,
+                        dest='dem',
+                        type=str,
+                        help="DEM GeoTIFF; gates blocked by terrain are masked before gridding"
+    )
+    parser.add_argument("--site-index",
+                        default=None,
+                        dest='site_index',
+                        type=str,
+                        help="SQLite database to store the values of each volume at the KML sites in"
+    )
+    parser.add_argument("--telemetry",
+                        default=None,
+                        dest='telemetry',
+                        type=str,
+                        help="Append per-file stage timings, memory and I/O to this JSON lines file"
+    )
+    parser.add_argument("--performance-report",
+                        default=None,
+                        dest='performance_report',
+                        type=str,
+                        help="Write a Dask performance report of the run to this HTML file"
+    )
+    args = parser.parse_args()
+
+    manifest_path = args.manifest or f"{args.out_dir}/squire_manifest_{args.month}.sqlite"
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+    # Workers started from here on log a JSON line per file
+    run = sail_telemetry.configure(args.telemetry) if args.telemetry else None
+
+    cluster = LocalCluster(n_workers=args.workers, processes=True, threads_per_worker=1)
+    files = sorted(glob.glob(f"/gpfs/wolf/atm124/proj-shared/gucxprecipradarcmacS2.c1/ppi/{args.month}/gucxprecipradarcmacS2.c1.{args.month}*"))
+    with Client(cluster) as c, sail_telemetry.performance_report(args.performance_report):
         print(c)
-        for interval in np.arange(0, len(files), 100):
-            file_bag = db.from_sequence(files[interval-100:interval], 5)
-            computation = file_bag.map(run_squire)
-            computation.compute()
-            print("done with ", interval)
+        run_files(c, files, args.out_dir, manifest_path,
+                  max_in_flight=args.max_in_flight,
+                  max_attempts=args.max_attempts,
+                  store=f"{args.out_dir}/squire_{args.month}.zarr" if args.append_store else None,
+                  dem_file=args.dem,
+                  site_index=args.site_index)
+    if run is not None:
+        sail_telemetry.print_summary(sail_telemetry.summarize(sail_telemetry.read_records(args.telemetry, run)))
+
+    if args.zarr:
+        store = sail_output.combine_month(glob.glob(f"{args.out_dir}/*.{args.month}*.gridded.nc"),
+                                          f"{args.out_dir}/squire_{args.month}_combined.zarr",
+                                          sail_dod.load_dod(DATASTREAM),
+                                          sail_output.OUTPUT_CHUNKS[DATASTREAM])
+        print("wrote", store)
@@ -0,0 +1,424 @@
+"""
+Streaming snowfall accumulation from the SQUIRE output files
+
+The SQUIRE files of an event are read one at a time, in time order, and each
+snow_rate_* field [mm/h] is integrated over the actual interval between
+consecutive volumes, with the rate varying linearly across the interval
+(trapezoidal rule). Intervals longer than max_interval are not integrated and
+count as missing time. Only running 2-D accumulators are kept in memory: one
+each for the current hour, the current day and the whole event. Every hour
+and day is written out as soon as it is complete, so memory stays the same
+however long the event is.
+
+The accumulators are saved to a checkpoint, and a run that is interrupted
+resumes after the last volume it integrated. The checkpoint records the
+event it belongs to (input directory, time range and maximum interval), and
+a checkpoint of another event is never resumed. Gates without a valid snow rate
+(no echo) count as no snowfall.
+
+Usage:
+
+    python snow_accumulation.py --input-dir data --out-dir snowfall \\
+        --start 2022-03-14T00:00 --end 2022-03-15T00:00
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import re
+from pathlib import Path
+import sys
+
+import numpy as np
+import xarray as xr
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / "scripts"))
+import sail_output
+
+import snow_rate
+
+# Longest interval between volumes that is still integrated
+MAX_INTERVAL = 900  # seconds
+
+# Volumes integrated between checkpoints
+CHECKPOINT_EVERY = 1
+
+# Length of the periods written out as they complete; the event spans the whole run
+PERIODS = {'hourly': 3600, 'daily': 86400}
+
+# Units of the period times and their bounds in the output files
+TIME_UNITS = 'seconds since 1970-01-01T00:00:00'
+
+# Volume time in the name of a SQUIRE file, e.g. ...c1.20220314.123000.gridded.nc
+FILE_TIME = re.compile(r"(\d{8})\.(\d{6})\.gridded\.nc$")
+
+
+def volume_time_from_name(path):
+    """
+    Return the volume time in a SQUIRE file name as seconds since 1970, or None
+    """
+    match = FILE_TIME.search(os.path.basename(path))
+    if match is None:
+        return None
+    time = datetime.datetime.strptime(''.join(match.groups()), '%Y%m%d%H%M%S')
+    return int(time.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def to_seconds(time):
+    """
+    Convert a time (string, datetime or datetime64) to seconds since 1970
+    """
+    return int(np.datetime64(time, 's').astype('int64'))
+
+
+def list_volumes(input_dir, start=None, end=None):
+    """
+    List the SQUIRE files of a directory between two times (inclusive), in time order
+    """
+    files = glob.glob(os.path.join(input_dir, '*.gridded.nc'))
+    times = {file: volume_time_from_name(file) for file in files}
+    files = [file for file in files if times[file] is not None]
+    if start is not None:
+        files = [file for file in files if times[file] >= to_seconds(start)]
+    if end is not None:
+        files = [file for file in files if times[file] <= to_seconds(end)]
+    return sorted(files, key=lambda file: (times[file], file))
+
+
+def event_key(input_dir, start=None, end=None, max_interval=MAX_INTERVAL):
+    """
+    Describe an event for its checkpoint: the input directory, time range and maximum interval
+    """
+    return {'input_dir': os.path.abspath(input_dir),
+            'start': None if start is None else to_seconds(start),
+            'end': None if end is None else to_seconds(end),
+            'max_interval': float(max_interval)}
+
+
+def read_volume(path, fields=None):
+    """
+    Read the volume time and snow rates [mm/h] of a SQUIRE file
+
+    Returns the time in seconds since 1970, a dictionary of 2-D float64 rates
+    with missing values set to zero, and the (y, x) grid coordinates.
+    """
+    with xr.open_dataset(path) as ds:
+        if fields is None:
+            fields = [name for name in ds.data_vars if name.startswith('snow_rate_')]
+        time = to_seconds(ds['time'].values[0])
+        rates = {field: np.nan_to_num(ds[field].values[0].astype('float64'), nan=0.)
+                 for field in fields}
+        grid = {name: ds[name].values for name in ('x', 'y', 'lat', 'lon')}
+    return time, rates, grid
+
+
+def period_start(time, kind):
+    """
+    Start of the hourly or daily period holding a time [s since 1970]
+    """
+    return time - time % PERIODS[kind]
+
+
+def new_period(start, fields, shape):
+    """
+    Empty accumulator of a period
+    """
+    return {'start': start,
+            'observed': 0.,
+            'missing': 0.,
+            'totals': {field: np.zeros(shape) for field in fields}}
+
+
+def new_state(time, rates, grid):
+    """
+    Start the accumulation at the first volume of an event
+    """
+    fields = list(rates)
+    shape = grid['lat'].shape
+    periods = {kind: new_period(period_start(time, kind), fields, shape) for kind in PERIODS}
+    periods['event'] = new_period(time, fields, shape)
+    return {'fields': fields,
+            'grid': grid,
+            'time': time,
+            'rates': rates,
+            'volumes': 1,
+            'periods': periods}
+
+
+def period_dataset(state, kind):
+    """
+    Build the dataset of the totals of a period
+    """
+    period = state['periods'][kind]
+    start = period['start']
+    end = start + PERIODS[kind] if kind in PERIODS else state['time']
+    grid = state['grid']
+    bounds = np.array([[start, end]], dtype='datetime64[s]').astype('datetime64[ns]')
+
+    data_vars = {}
+    for field in state['fields']:
+        relationship = snow_rate.ZS_RELATIONSHIPS.get(field[len('snow_rate_'):], {})
+        attrs = {'long_name': f"{kind.capitalize()} snowfall accumulation of {field}",
+                 'units': 'mm',
+                 'comment': ('Snowfall rate integrated over the observed time of the period;'
+                             + ' gates without a valid rate count as no snowfall')}
+        if relationship:
+            attrs.update(relationship=relationship['long_name'], A=relationship['A'], B=relationship['B'])
+        data_vars[f"{field}_accumulated"] = (('time', 'y', 'x'), period['totals'][field][np.newaxis], attrs)
+    data_vars['time_bounds'] = (('time', 'bound'), bounds)
+    data_vars['observed_time'] = (('time',), [period['observed']],
+                                  dict(long_name='Time covered by volumes no further apart than the'
+                                                 + ' maximum interval', units='s'))
+    data_vars['missing_time'] = (('time',), [period['missing']],
+                                 dict(long_name='Time in gaps longer than the maximum interval', units='s'))
+
+    coords = {'time': ('time', bounds[:, 0], dict(long_name=f"Start of the {kind} period",
+                                                  bounds='time_bounds')),
+              'y': ('y', grid['y']),
+              'x': ('x', grid['x']),
+              'lat': (('y', 'x'), grid['lat']),
+              'lon': (('y', 'x'), grid['lon'])}
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def write_period(state, kind, out_dir):
+    """
+    Write the totals of a period, returning the path, or None if no volume covered it
+    """
+    period = state['periods'][kind]
+    if period['observed'] == 0:
+        return None
+    ds = period_dataset(state, kind)
+    stamp = np.datetime64(period['start'], 's').astype(datetime.datetime).strftime('%Y%m%d.%H%M%S')
+    path = f"{out_dir}/squire_snowfall.{kind}.{stamp}.nc"
+    encoding = sail_output.output_encoding(ds)
+    for name in ('time', 'time_bounds'):
+        encoding.setdefault(name, {})['units'] = TIME_UNITS
+    return sail_output.write_netcdf(ds, path, encoding)
+
+
+def advance_periods(state, time, out_dir):
+    """
+    Write out the hourly and daily periods that end at or before time and start new ones
+    """
+    shape = state['grid']['lat'].shape
+    for kind, length in PERIODS.items():
+        if time >= state['periods'][kind]['start'] + length:
+            write_period(state, kind, out_dir)
+            state['periods'][kind] = new_period(period_start(time, kind), state['fields'], shape)
+
+
+def integrate(state, time, rates, out_dir, max_interval=MAX_INTERVAL):
+    """
+    Integrate the snow rates from the previous volume to this one
+
+    The interval is split at the hour boundaries so each part is added to the
+    period it falls in; periods that complete are written out.
+    """
+    start = state['time']
+    interval = time - start
+    gap = interval > max_interval
+    previous = state['rates']
+
+    piece_start = start
+    while piece_start < time:
+        advance_periods(state, piece_start, out_dir)
+        piece_end = min(time, period_start(piece_start, 'hourly') + PERIODS['hourly'])
+        duration = piece_end - piece_start
+        periods = state['periods'].values()
+        if gap:
+            for period in periods:
+                period['missing'] += duration
+        else:
+            # Integral of the linearly varying rate over the piece, from its value at the midpoint
+            weight = (0.5 * (piece_start + piece_end) - start) / interval
+            hours = duration / 3600.
+            for period in periods:
+                period['observed'] += duration
+            for field in state['fields']:
+                increment = hours * ((1. - weight) * previous[field] + weight * rates[field])
+                for period in periods:
+                    period['totals'][field] += increment
+        piece_start = piece_end
+    advance_periods(state, time, out_dir)
+
+    state['time'] = time
+    state['rates'] = rates
+    state['volumes'] += 1
+
+
+def save_checkpoint(state, path):
+    """
+    Save the accumulation state, through a temporary file so a crash never leaves a partial checkpoint
+    """
+    arrays = {'fields': np.array(state['fields']),
+              'event': json.dumps(state.get('event')),
+              'time': state['time'],
+              'volumes': state['volumes']}
+    arrays.update({f"grid/{name}": values for name, values in state['grid'].items()})
+    arrays.update({f"rates/{field}": values for field, values in state['rates'].items()})
+    for kind, period in state['periods'].items():
+        arrays.update({f"{kind}/start": period['start'],
+                       f"{kind}/observed": period['observed'],
+                       f"{kind}/missing": period['missing']})
+        arrays.update({f"{kind}/totals/{field}": values for field, values in period['totals'].items()})
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_checkpoint(path):
+    """
+    Load the accumulation state saved by save_checkpoint
+    """
+    with np.load(path) as saved:
+        fields = saved['fields'].tolist()
+        state = {'fields': fields,
+                 'event': json.loads(str(saved['event'])) if 'event' in saved.files else None,
+                 'grid': {name: saved[f"grid/{name}"] for name in ('x', 'y', 'lat', 'lon')},
+                 'time': int(saved['time']),
+                 'rates': {field: saved[f"rates/{field}"] for field in fields},
+                 'volumes': int(saved['volumes']),
+                 'periods': {}}
+        for kind in list(PERIODS) + ['event']:
+            state['periods'][kind] = {'start': int(saved[f"{kind}/start"]),
+                                      'observed': float(saved[f"{kind}/observed"]),
+                                      'missing': float(saved[f"{kind}/missing"]),
+                                      'totals': {field: saved[f"{kind}/totals/{field}"] for field in fields}}
+    return state
+
+
+def accumulate(files, out_dir, max_interval=MAX_INTERVAL, checkpoint=None,
+               checkpoint_every=CHECKPOINT_EVERY, fields=None, event=None):
+    """
+    Accumulate the snowfall of a time ordered list of SQUIRE files
+
+    Parameters
+    ----------
+    files : list
+        SQUIRE files of the event, in time order (see list_volumes).
+    out_dir : str
+        Directory to write the hourly, daily and event totals to.
+    max_interval : float
+        Longest interval between volumes that is integrated [s].
+    checkpoint : str, optional
+        Checkpoint file. If it exists, the accumulation resumes from it and
+        skips the volumes already integrated; a checkpoint saved for another
+        event raises a ValueError.
+    checkpoint_every : int
+        Number of volumes integrated between checkpoints.
+    fields : list, optional
+        Snow rate fields to accumulate; all snow_rate_* fields by default.
+    event : dict, optional
+        The event being accumulated (see event_key), saved in the checkpoint.
+
+    Returns
+    -------
+    event_path : str
+        Path of the event totals, or None if no volumes were integrated.
+    """
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    state = None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        state = load_checkpoint(checkpoint)
+        if state['event'] != event:
+            raise ValueError(f"{checkpoint} was saved for another event ({state['event']}, not {event});"
+                             + " remove it or use another checkpoint")
+        print(f"Resuming after {state['volumes']} volumes from {checkpoint}")
+
+    since_checkpoint = 0
+    for file in files:
+        # Skip integrated volumes by name, without opening them
+        name_time = volume_time_from_name(file)
+        if state is not None and name_time is not None and name_time <= state['time']:
+            continue
+
+        time, rates, grid = read_volume(file, fields if state is None else state['fields'])
+        if state is None:
+            state = new_state(time, rates, grid)
+            state['event'] = event
+        elif time <= state['time']:
+            print('Skipping out of order volume', file)
+            continue
+        elif grid['lat'].shape != state['grid']['lat'].shape:
+            raise ValueError(f"{file} is not on the grid of the previous volumes")
+        else:
+            integrate(state, time, rates, out_dir, max_interval)
+
+        since_checkpoint += 1
+        if checkpoint is not None and since_checkpoint >= checkpoint_every:
+            save_checkpoint(state, checkpoint)
+            since_checkpoint = 0
+
+    if state is None:
+        return None
+    if checkpoint is not None:
+        save_checkpoint(state, checkpoint)
+
+    # The last hour and day are written as far as they were observed
+    for kind in PERIODS:
+        write_period(state, kind, out_dir)
+    return write_period(state, 'event', out_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description="Hourly, daily and event snowfall totals from SQUIRE files")
+
+    parser.add_argument("--input-dir",
+                        default="data",
+                        dest='input_dir',
+                        type=str,
+                        help="Directory holding the SQUIRE files"
+    )
+    parser.add_argument("--out-dir",
+                        default="snowfall",
+                        dest='out_dir',
+                        type=str,
+                        help="Directory to write the snowfall totals to"
+    )
+    parser.add_argument("--start",
+                        default=None,
+                        dest='start',
+                        type=str,
+                        help="Start of the event, e.g. 2022-03-14T00:00 (default: first file)"
+    )
+    parser.add_argument("--end",
+                        default=None,
+                        dest='end',
+                        type=str,
+                        help="End of the event, e.g. 2022-03-15T00:00 (default: last file)"
+    )
+    parser.add_argument("--max-interval",
+                        default=MAX_INTERVAL,
+                        dest='max_interval',
+                        type=float,
+                        help="Longest interval between volumes that is integrated, in seconds"
+    )
+    parser.add_argument("--checkpoint",
+                        default=None,
+                        dest='checkpoint',
+                        type=str,
+                        help="Checkpoint file to resume from (default: <out-dir>/snowfall_checkpoint.npz)"
+    )
+    parser.add_argument("--checkpoint-every",
+                        default=CHECKPOINT_EVERY,
+                        dest='checkpoint_every',
+                        type=int,
+                        help="Number of volumes between checkpoints"
+    )
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or f"{args.out_dir}/snowfall_checkpoint.npz"
+    files = list_volumes(args.input_dir, args.start, args.end)
+    print(f"{len(files)} SQUIRE files to accumulate")
+    event_path = accumulate(files, args.out_dir, max_interval=args.max_interval,
+                            checkpoint=checkpoint, checkpoint_every=args.checkpoint_every,
+                            event=event_key(args.input_dir, args.start, args.end, args.max_interval))
+    print('Event totals written to', event_path)
@@ -0,0 +1,178 @@
+"""
+Snowfall rate from reflectivity for many Z(S) relationships at once
+
+Each relationship Z = A * S**B is inverted to S = swe_ratio * (Z / A)**(1 / B).
+Reflectivity is converted from dBZ once, to the natural log of linear Z, and
+every relationship is evaluated in one broadcast over a leading 'relationship'
+axis:
+
+    S_k = exp(ln(Z) / B_k + ln(swe_ratio_k) - ln(A_k) / B_k)
+
+Works on plain (masked) arrays, on Py-ART Radar objects and on gridded
+xarray datasets. The coefficients are those of literature-methods-notes.md;
+the relationships in the CMAC files are listed in CMAC_RELATIONSHIPS.
+"""
+
+import numpy as np
+import xarray as xr
+
+# Z = A * S**B relationships for dry snow
+ZS_RELATIONSHIPS = {
+    'ws2012': {'A': 110., 'B': 2., 'long_name': 'Wolf and Snider (2012)'},
+    'ws88dhp': {'A': 130., 'B': 2., 'long_name': 'WSR 88D High Plains'},
+    'ws88diw': {'A': 40., 'B': 2., 'long_name': 'WSR 88D Intermountain West'},
+    'm2009_1': {'A': 67., 'B': 1.28, 'long_name': 'Matrosov et al.(2009) Braham(1990) 1'},
+    'm2009_2': {'A': 114., 'B': 1.39, 'long_name': 'Matrosov et al.(2009) Braham(1990) 2'},
+    'm2009_3': {'A': 136., 'B': 1.3, 'long_name': 'Matrosov et al.(2009) Braham(1990) 3'},
+    'm2009_4': {'A': 28., 'B': 1.44, 'long_name': 'Matrosov et al.(2009) Braham(1990) 4'},
+    'm2009_5': {'A': 36., 'B': 1.56, 'long_name': 'Matrosov et al.(2009) Braham(1990) 5'},
+    'm2009_6': {'A': 48., 'B': 1.45, 'long_name': 'Matrosov et al.(2009) Braham(1990) 6'},
+    'm1992_1': {'A': 410., 'B': 1.6, 'long_name': 'Matrosov (1992) 1'},
+    'm1992_2': {'A': 340., 'B': 1.75, 'long_name': 'Matrosov (1992) 2'},
+    'm1992_3': {'A': 240., 'B': 1.95, 'long_name': 'Matrosov (1992) 3'},
+    'bw1985': {'A': 229., 'B': 1.65, 'long_name': 'Boucher and Wieler (1985)'},
+    'f1990': {'A': 427., 'B': 1.09, 'long_name': 'Fujiyoshi et al. (1990)'},
+    'p1975': {'A': 1050., 'B': 2., 'long_name': 'Puhakka (1975)'},
+    'ss1970': {'A': 1780., 'B': 2.21, 'long_name': 'Sekhon and Srivastava (1970)'},
+}
+
+# Relationships stored in the CMAC files, as snow_rate_<name>
+CMAC_RELATIONSHIPS = ['ws2012', 'ws88diw', 'm2009_1', 'm2009_2']
+
+# Snow water equivalent ratio of the CMAC snow fields (the notebooks use 8.5)
+DEFAULT_SWE_RATIO = 13.699
+
+SNOW_RATE_ATTRS = {'units': 'mm/h',
+                   'standard_name': 'snowfall_rate',
+                   'valid_min': 0,
+                   'valid_max': 500}
+
+
+def field_name(relationship):
+    """
+    Name of the snow rate field of a relationship, as in the CMAC files
+    """
+    return 'snow_rate_' + relationship
+
+
+def coefficients(relationships=None, swe_ratio=DEFAULT_SWE_RATIO):
+    """
+    Return the names and the A, B and SWE ratio arrays of a set of relationships
+
+    relationships is a list of names from ZS_RELATIONSHIPS (all of them by
+    default), or a dictionary of name to {'A': ..., 'B': ...}. swe_ratio is
+    a single value or one per relationship.
+    """
+    if relationships is None:
+        relationships = ZS_RELATIONSHIPS
+    if not isinstance(relationships, dict):
+        relationships = {name: ZS_RELATIONSHIPS[name] for name in relationships}
+
+    names = list(relationships)
+    A = np.array([relationships[name]['A'] for name in names], dtype='float64')
+    B = np.array([relationships[name]['B'] for name in names], dtype='float64')
+    swe = np.broadcast_to(np.asarray(swe_ratio, dtype='float64'), A.shape)
+    return names, A, B, swe
+
+
+def snow_rates(dbz, relationships=None, swe_ratio=DEFAULT_SWE_RATIO, dtype='float32', out=None):
+    """
+    Evaluate every relationship on a reflectivity array in one broadcast
+
+    Parameters
+    ----------
+    dbz : array
+        Reflectivity in dBZ, any shape; masked and NaN values stay missing.
+    relationships : list or dict, optional
+        Relationships to evaluate, see coefficients.
+    swe_ratio : float or array
+        Snow water equivalent ratio, one value or one per relationship.
+    dtype : str or numpy.dtype
+        Floating point type of the result.
+    out : array, optional
+        Preallocated (relationship,) + dbz.shape array to write into.
+
+    Returns
+    -------
+    rates : array
+        Snowfall rates [mm/h] with a leading relationship axis; masked where
+        the reflectivity is masked.
+    """
+    names, A, B, swe = coefficients(relationships, swe_ratio)
+    mask = np.ma.getmaskarray(dbz) if np.ma.isMaskedArray(dbz) else None
+    dtype = np.dtype(dtype) if out is None else out.dtype
+
+    # ln(Z) from dBZ, computed once for all relationships
+    log_z = np.ma.filled(np.ma.asarray(dbz, dtype=dtype), np.nan) * dtype.type(np.log(10.) / 10.)
+
+    shape = (len(names),) + (1,) * log_z.ndim
+    slope = (1. / B).astype(dtype).reshape(shape)
+    offset = (np.log(swe) - np.log(A) / B).astype(dtype).reshape(shape)
+    if out is None:
+        out = np.empty((len(names),) + log_z.shape, dtype=dtype)
+    np.multiply(log_z, slope, out=out)
+    np.add(out, offset, out=out)
+    np.exp(out, out=out)
+
+    if mask is not None and mask.any():
+        return np.ma.masked_array(out, mask=np.broadcast_to(mask, out.shape))
+    return out
+
+
+def snow_rate_attrs(relationship, A, B, swe_ratio):
+    """
+    Field metadata of a snow rate, as in the CMAC files
+    """
+    long_name = ZS_RELATIONSHIPS.get(relationship, {}).get('long_name', relationship)
+    return dict(SNOW_RATE_ATTRS, long_name='Snowfall rate from Z using ' + long_name,
+                swe_ratio=float(swe_ratio), A=float(A), B=float(B))
+
+
+def add_snow_fields(radar, relationships=CMAC_RELATIONSHIPS, reflectivity_field='DBZ',
+                    swe_ratio=DEFAULT_SWE_RATIO, dtype='float32', replace_existing=True):
+    """
+    Add snow_rate_<name> fields to a Py-ART Radar for every relationship
+
+    The fields are views into one stacked array, so no per-field copies are
+    made. Returns the radar.
+    """
+    names, A, B, swe = coefficients(relationships, swe_ratio)
+    rates = snow_rates(radar.fields[reflectivity_field]['data'], relationships, swe_ratio, dtype)
+    for k, name in enumerate(names):
+        field = snow_rate_attrs(name, A[k], B[k], swe[k])
+        field['data'] = rates[k]
+        radar.add_field(field_name(name), field, replace_existing=replace_existing)
+    return radar
+
+
+def snow_rate_dataarray(ds, relationships=CMAC_RELATIONSHIPS, reflectivity_field='DBZ',
+                        swe_ratio=DEFAULT_SWE_RATIO, dtype='float32'):
+    """
+    Snowfall rates of a gridded dataset, stacked along a 'relationship' dimension
+
+    A, B and swe_ratio are returned as coordinates along 'relationship'.
+    """
+    names, A, B, swe = coefficients(relationships, swe_ratio)
+    reflectivity = ds[reflectivity_field]
+    rates = snow_rates(reflectivity.values, relationships, swe_ratio, dtype)
+    return xr.DataArray(np.ma.filled(rates, np.nan),
+                        dims=('relationship',) + reflectivity.dims,
+                        coords=dict(reflectivity.coords, relationship=names, A=('relationship', A),
+                                    B=('relationship', B), swe_ratio=('relationship', swe)),
+                        attrs=dict(SNOW_RATE_ATTRS, long_name='Snowfall rate from Z'),
+                        name='snow_rate')
+
+
+def add_snow_variables(ds, relationships=CMAC_RELATIONSHIPS, reflectivity_field='DBZ',
+                       swe_ratio=DEFAULT_SWE_RATIO, dtype='float32'):
+    """
+    Add snow_rate_<name> variables to a gridded dataset for every relationship
+
+    The variables share the memory of one stacked array. Returns the dataset.
+    """
+    stacked = snow_rate_dataarray(ds, relationships, reflectivity_field, swe_ratio, dtype)
+    for k, name in enumerate(stacked['relationship'].values):
+        ds[field_name(name)] = (ds[reflectivity_field].dims, stacked.values[k],
+                                snow_rate_attrs(name, stacked.A.values[k], stacked.B.values[k],
+                                                stacked.swe_ratio.values[k]))
+    return ds